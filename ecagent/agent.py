@@ -16,12 +16,17 @@
 
 import os
 import sys
+import ast
 import simplejson as json
 import zlib, base64
+import hashlib
+import copy
+import re
 from time import time
+from math import ceil
 
 # Twisted imports
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, succeed
 from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
 from twisted.internet.error import ProcessTerminated, ProcessDone
@@ -29,6 +34,22 @@ from twisted.words.xish.domish import Element
 
 # Local
 from ecagent.client import Client
+from ecagent.manifest import PluginManifest, inspect_plugin, plugin_info
+import ecagent.scheduler as scheduler
+import ecagent.cache as cache
+import ecagent.buffer as buffer
+import ecagent.frames as frames
+import ecagent.workers as workers
+import ecagent.inline as inline
+import ecagent.serializer as serializer
+import ecagent.pipeline as pipeline
+import ecagent.store as store
+import ecagent.transfer as transfer
+import ecagent.relay as relay
+import ecagent.local as local
+import ecagent.session as session
+import ecagent.load as load
+import ecagent.startup as startup
 import ecagent.twlogging as log
 
 
@@ -42,10 +63,19 @@ except:
     pass
 
 _CERTIFICATE_FILE = '../config/xmpp_cert.pub'
+_MANIFEST_FILE = '../config/plugins.manifest'
+_STORE_PATH = '../store'
+
+# Scheduler plugin name prefix for commands run by the agent itself: each
+# has its own per plugin limit, long transfers don't hold up agent.stats
+_BUILTIN_PLUGIN = '__builtin__:'
 
 _E_RUNNING_COMMAND = 253
 _E_COMMAND_NOT_DEFINED = 252
 _E_UNVERIFIED_COMMAND = 251
+_E_MISSING_PAYLOAD = 250
+_E_DEADLINE_EXPIRED = 249
+_E_UNKNOWN_SESSION = 248
 
 _FINAL_OUTPUT_STRING = '[__response__]'
 
@@ -55,17 +85,34 @@ AGENT_VERSION_PROTOCOL = 1
 FLUSH_MIN_LENGTH = 5
 FLUSH_TIME = 5
 
+# <command stream="delta">: partial results only carry new output
+STREAM_DELTA = 'delta'
+
+# Handled by the agent: set up and drop HMAC session keys
+SESSION_NONCE = 'session.nonce'
+SESSION_OPEN = 'session.open'
+SESSION_CLOSE = 'session.close'
+
+# Commands accepted in a <batch> or <pipeline>
+MAX_BATCH_COMMANDS = 50
+
+# Characters not allowed in XML 1.0 text
+_XML_INVALID_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
 class SMAgent:
     def __init__(self, config):
         reactor.callWhenRunning(self._checkConfig)
         self.config = config
 
     def _checkConfig(self):
+        startup.timer.begin('uuid')
         d = self.config.check_uuid()
         d.addCallback(self._onConfigChecked)
         d.addErrback(self._onConfigCheckFailed)
 
     def _onConfigChecked(self, success):
+        startup.timer.end('uuid')
+
         # Ok, now everything should be correctly configured,
         # let's start the party.
         if success:
@@ -86,6 +133,7 @@ class SMAgentXMPP(Client):
         self.config = config
 
         log.info("Setting up certificate")
+        startup.timer.begin('certificate')
         self.public_key = None
         try:
             if Crypto.version_info[:2] >= (2, 2):
@@ -99,19 +147,99 @@ class SMAgentXMPP(Client):
         if not self.public_key:
             log.warn('PyCrypto not available or version is < 2.2: Please upgrade: http://www.pycrypto.org/')
 
+        startup.timer.end('certificate')
+
         log.info("Loading commands...")
-        self.command_runner = CommandRunner(config['Plugins'])
+
+        # [XMPP] max_concurrent_messages limited commands before the scheduler
+        max_concurrent = None
+        if 'max_concurrent_messages' in config['XMPP']:
+            log.warn("[XMPP] max_concurrent_messages is deprecated, use [Plugins] max_concurrent_commands")
+            if 'max_concurrent_commands' not in config['Plugins']:
+                max_concurrent = config['XMPP'].as_int('max_concurrent_messages')
+
+        self.command_runner = CommandRunner(config['Plugins'], max_concurrent)
+        self.max_batch_commands = int(config['Plugins'].get('max_batch_commands', MAX_BATCH_COMMANDS))
+
+        # Load published in presence for dispatchers
+        self._load = load.LoadPublisher(
+            self.command_runner.get_stats,
+            self.send_presence,
+            int(config['XMPP'].get('load_interval', load.DEFAULT_INTERVAL)),
+            int(config['XMPP'].get('load_commands_delta', load.DEFAULT_COMMANDS_DELTA)),
+            float(config['XMPP'].get('load_loadavg_delta', load.DEFAULT_LOADAVG_DELTA)),
+        )
+        self._load.start()
+
+        # Session keys: HMAC checked commands after an RSA signed session.open
+        self._sessions = session.SessionKeys(
+            int(config['Plugins'].get('session_max_ttl', session.MAX_TTL)),
+        )
+
+        # Retransmitted messages are answered, not run again
+        self._dedup = cache.DedupWindow(
+            int(config['Plugins'].get('dedup_ttl', cache.DEFAULT_DEDUP_TTL)),
+            int(config['Plugins'].get('dedup_max_size', cache.DEFAULT_DEDUP_MAX_SIZE)),
+            int(config['Plugins'].get('dedup_max_running', cache.DEFAULT_DEDUP_MAX_RUNNING)),
+        )
+
+        # Local command API, sharing the command runner
+        if config['Plugins'].get('local_socket'):
+            self._local_api = local.LocalAPI(
+                self.command_runner,
+                os.path.join(os.path.dirname(__file__), config['Plugins']['local_socket']),
+                config['Plugins'].get('local_socket_mode', local.DEFAULT_MODE),
+                config['Plugins'].get('local_socket_group') or None,
+                config['Plugins'].as_list('local_commands') if config['Plugins'].get('local_commands') else [],
+            )
+            self._local_api.listen()
+
+        # Signature checks and result serialization run off the reactor thread
+        self._serializer = serializer.Serializer(
+            int(config['Plugins'].get('serializer_threads', serializer.DEFAULT_THREADS)),
+            int(config['Plugins'].get('serializer_min_size', serializer.DEFAULT_MIN_SIZE)),
+        )
+
+        # Relay mode: other agents reach the server through this one
+        self._relay = None
+        relay_listen = config['XMPP'].get('relay_listen')
+        if relay_listen:
+            relay_secret = config['XMPP'].get('relay_secret')
+            if relay_secret:
+                self._relay = relay.RelayServer(
+                    self,
+                    relay_secret,
+                    int(config['XMPP'].get('relay_max_queued_size', relay.MAX_QUEUED_SIZE))
+                )
+
+            else:
+                log.error("Relay mode needs a relay_secret, not starting it")
 
         log.debug("Loading XMPP...")
         observers = [
             ('/iq', self.__onIq),
         ]
+        if self._relay:
+            observers.append(('/presence', self._relay.onPresence))
+
         Client.__init__(self,
                         self.config['XMPP'],
                         observers,
                         resource='ecm_agent-%d' % AGENT_VERSION_PROTOCOL
         )
 
+        if self._relay:
+            self._relay.listen(relay_listen)
+
+    def presence(self):
+        presence = Client.presence(self)
+        self._load.decorate(presence)
+
+        if self._relay:
+            self._relay.decorate(presence)
+
+        return presence
+
     def __onIq(self, msg):
         """
         A new IQ message has been received and we should process it.
@@ -122,6 +250,9 @@ class SMAgentXMPP(Client):
         log.debug("q Message received: \n%s" % msg.toXml())
         log.debug("Message type: %s" % message_type)
 
+        if self._relay and self._relay.route(msg):
+            return
+
         if message_type == 'set':
             #Parse and check message format
             message = IqMessage(msg)
@@ -144,19 +275,64 @@ class SMAgentXMPP(Client):
     def _processCommand(self, message):
         log.debug('Process Command')
 
+        if not self.command_runner.loaded:
+            log.info("Command %s queued until plugins are loaded" % message.command)
+            self.command_runner.when_ready().addCallback(lambda _: self._processCommand(message))
+            return
+
+        message.dedup_key = self._dedup.key(message.from_, message.id, self._message_signature(message))
+        entry = self._dedup.received(message.dedup_key)
+        if entry is not None:
+            return self._onDuplicate(entry, message)
+
+        if message.pipeline:
+            return self._processPipeline(message)
+
+        if message.batch is not None:
+            return self._processBatch(message)
+
         if self.public_key:
-            if not self._verify_message(message):
-                log.critical('[RSA CHECK: Failed] Command from %s has bad signature (Ignored)' % message.from_)
-                result = (_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0)
-                self._onCallFinished(result, message)
-                return
+            d = self._serializer.submit(message.id, self._verify_message, (message,),
+                                        size=self._verify_size(message.session))
+            d.addCallback(self._onMessageVerified, message)
+            d.addErrback(self._onCallFailed, message=message)
+            return d
+
         else:
             # No public key, RSA functions are not available on this system
             log.warn('[RSA CHECK: No available] WARNING: Running unverified Command from %s' % message.from_)
 
+        return self._runCommand(message)
+
+    def _onMessageVerified(self, verified, message):
+        if verified is None:
+            log.warn('[HMAC CHECK: Unknown session] Command from %s ignored' % message.from_)
+            result = (_E_UNKNOWN_SESSION, '', 'Unknown or expired session', 0)
+            self._onCallFinished(result, message)
+            return
+
+        if not verified:
+            log.critical('[RSA CHECK: Failed] Command from %s has bad signature (Ignored)' % message.from_)
+            result = (_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0)
+            self._onCallFinished(result, message)
+            return
+
+        return self._runCommand(message)
+
+    def _runCommand(self, message):
+        # Checked once verified: unauthenticated commands get no deadline answer
+        if message.deadline and message.deadline <= time():
+            self._onCallFinished(self.command_runner._expired_result(message.command, message.deadline), message)
+            return
+
+        if message.command in (SESSION_NONCE, SESSION_OPEN, SESSION_CLOSE):
+            self._onCallFinished(self._session_command(message), message)
+            return
+
         flush_callback = self._Flush
         message.command_replaced = message.command.replace('.', '_')
-        d = self.command_runner.run_command(message.command_replaced, message.command_args, flush_callback, message)
+        d = self.command_runner.run_command(message.command_replaced, message.command_args, flush_callback, message,
+                                            message.deadline)
 
         if d:
             d.addCallbacks(self._onCallFinished, self._onCallFailed,
@@ -172,13 +348,206 @@ class SMAgentXMPP(Client):
 
         return
 
+    def _session_command(self, message):
+        sender = message.from_.split('/')[0]
+
+        if message.command == SESSION_CLOSE:
+            return (0, json.dumps(self._sessions.close(sender, message.command_args.get('session'))), '', 0)
+
+        if message.session or not self.public_key:
+            return (_E_UNVERIFIED_COMMAND, '', "%s must be RSA signed" % message.command, 0)
+
+        if message.command == SESSION_NONCE:
+            return (0, json.dumps({'nonce': self._sessions.nonce(sender)}), '', 0)
+
+        try:
+            session_id, encrypted_key, expires = self._sessions.open(
+                sender, message.command_args.get('nonce'), self.public_key,
+                int(message.command_args.get('ttl', session.DEFAULT_TTL)))
+
+        except (ValueError, session.SessionError) as e:
+            return (_E_RUNNING_COMMAND, '', "ERROR: Invalid session: %s" % e, 0)
+
+        return (0, json.dumps({'session': session_id, 'key': encrypted_key, 'expires': int(expires)}), '', 0)
+
+    @staticmethod
+    def _verify_size(session_id):
+        # HMAC checks are cheap: no thread pool round trip
+        return 0 if session_id else None
+
+    @staticmethod
+    def _message_signature(message):
+        if message.batch is None:
+            return message.signature
+
+        return ','.join([command.signature for command in message.batch + getattr(message, 'rollback', [])])
+
+    def _onDuplicate(self, entry, message):
+        if entry.running:
+            log.info("Duplicate of running command %s (id: %s), waiting for its result"
+                     % (message.command, message.id))
+
+        elif entry.result:
+            log.info("Duplicate of command %s (id: %s), sending its result again" % (message.command, message.id))
+            self.send(entry.result)
+
+        else:
+            log.warn("Duplicate of command %s (id: %s) ignored, its result was too large to keep"
+                     % (message.command, message.id))
+
+    def _processBatch(self, message):
+        log.debug('Process Batch (%i commands)' % len(message.batch))
+
+        if len(message.batch) > self.max_batch_commands:
+            log.warn("Batch from %s ignored: %i commands (max: %i)"
+                     % (message.from_, len(message.batch), self.max_batch_commands))
+            result = (_E_RUNNING_COMMAND, '', "Too many commands in batch (max: %i)" % self.max_batch_commands, 0)
+            self._onCallFinished(result, message)
+            return
+
+        if not self.public_key:
+            log.warn('[RSA CHECK: No available] WARNING: Running unverified Batch from %s' % message.from_)
+
+        # Commands run concurrently, limits are applied by the command scheduler
+        d = DeferredList([self._runBatchCommand(message, index, command)
+                          for index, command in enumerate(message.batch)])
+        d.addCallback(self._onBatchFinished, message)
+        return d
+
+    def _onBatchFinished(self, _, message):
+        message.commands = message.batch
+        self._onCallFinished((0, '', '', 0), message)
+
+    def _runBatchCommand(self, message, index, command):
+        if not self.public_key:
+            return maybeDeferred(self._onBatchCommandVerified, True, message, command)
+
+        # Commands in a batch are checked in parallel
+        d = self._serializer.submit((message.id, index), self._verify_command,
+                                    (message, command.command, command.command_args, command.signature,
+                                     command.session),
+                                    size=self._verify_size(command.session))
+        d.addCallback(self._onBatchCommandVerified, message, command)
+        d.addErrback(self._onBatchCommandFailed, command)
+        return d
+
+    def _onBatchCommandVerified(self, verified, message, command):
+        if verified is None:
+            log.warn('[HMAC CHECK: Unknown session] Command %s from %s ignored' % (command.command, message.from_))
+            command.result = (_E_UNKNOWN_SESSION, '', 'Unknown or expired session', 0)
+            return
+
+        if not verified:
+            log.critical('[RSA CHECK: Failed] Command %s from %s has bad signature (Ignored)'
+                         % (command.command, message.from_))
+            command.result = (_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0)
+            return
+
+        d = self.command_runner.run_command(command.command.replace('.', '_'), command.command_args,
+                                            deadline=message.deadline)
+        if not d:
+            log.info("Command Ignored: Unknown command: %s" % command.command)
+            command.result = (_E_RUNNING_COMMAND, '', "Unknown command: %s" % command.command, 0)
+            return
+
+        d.addCallback(self._onBatchCommandFinished, command)
+        d.addErrback(self._onBatchCommandFailed, command)
+        return d
+
+    def _processPipeline(self, message):
+        log.debug('Process Pipeline (%i steps)' % len(message.batch))
+        steps = message.batch + message.rollback
+
+        if len(steps) > self.max_batch_commands:
+            log.warn("Pipeline from %s ignored: %i steps (max: %i)"
+                     % (message.from_, len(steps), self.max_batch_commands))
+            result = (_E_RUNNING_COMMAND, '', "Too many steps in pipeline (max: %i)" % self.max_batch_commands, 0)
+            self._onCallFinished(result, message)
+            return
+
+        try:
+            message.pipeline = pipeline.Pipeline(message.batch, lambda step: self._runPipelineStep(step, message),
+                                                 message.on_failure, message.rollback,
+                                                 lambda step: self._onStepProgress(step, message))
+
+        except pipeline.PipelineError as e:
+            log.warn("Invalid pipeline from %s: %s" % (message.from_, e))
+            self._onCallFinished((_E_RUNNING_COMMAND, '', "Invalid pipeline: %s" % e, 0), message)
+            return
+
+        if not self.public_key:
+            log.warn('[RSA CHECK: No available] WARNING: Running unverified Pipeline from %s' % message.from_)
+            return self._runPipeline(message)
+
+        # Every step is checked before the first one runs
+        d = DeferredList([self._serializer.submit((message.id, index), self._verify_command,
+                                                  (message, step.command, step.command_args, step.signature,
+                                                   step.session),
+                                                  size=self._verify_size(step.session))
+                          for index, step in enumerate(steps)], consumeErrors=True)
+        d.addCallback(self._onPipelineVerified, message)
+        return d
+
+    def _onPipelineVerified(self, results, message):
+        if any([success and verified is None for (success, verified) in results]):
+            log.warn('[HMAC CHECK: Unknown session] Pipeline from %s ignored' % message.from_)
+            self._onCallFinished((_E_UNKNOWN_SESSION, '', 'Unknown or expired session', 0), message)
+            return
+
+        if not all([success and verified for (success, verified) in results]):
+            log.critical('[RSA CHECK: Failed] Pipeline from %s has bad signatures (Ignored)' % message.from_)
+            self._onCallFinished((_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0), message)
+            return
+
+        return self._runPipeline(message)
+
+    def _runPipeline(self, message):
+        d = message.pipeline.run()
+        d.addCallback(self._onPipelineFinished, message)
+        d.addErrback(self._onCallFailed, message=message)
+        return d
+
+    def _runPipelineStep(self, step, message):
+        d = self.command_runner.run_command(step.command.replace('.', '_'), step.command_args,
+                                            deadline=message.deadline)
+        if not d:
+            return (_E_RUNNING_COMMAND, '', "Unknown command: %s" % step.command, 0)
+
+        d.addCallback(lambda result: result[:4])
+        return d
+
+    def _onStepProgress(self, step, message):
+        if step.state == pipeline.PENDING or not self.writable():
+            # Final result has every step
+            return
+
+        # Copy: step is updated again while the partial result is serialized
+        message.commands = [copy.copy(step)]
+        self._send((None, '', '', 0, 1), message)
+
+    def _onPipelineFinished(self, success, message):
+        message.commands = message.batch + [step for step in message.rollback if step.state != pipeline.PENDING]
+        self._onCallFinished((0 if success else 1, '', '', 0), message)
+
+    def _onBatchCommandFinished(self, result, command):
+        command.result = result[:4]
+
+    def _onBatchCommandFailed(self, failure, command):
+        log.error("Batch command %s failed: %s" % (command.command, failure.getErrorMessage()))
+        command.result = (2, '', failure.getErrorMessage(), 0)
+
     def _onCallFinished(self, result, message):
         log.debug('Call Finished')
         self._send(result, message)
 
     def _Flush(self, result, message):
         log.debug('Flush Message')
-        self._send(result, message)
+        if not self.writable():
+            # Partial results wait while the connection is congested
+            log.debug('Connection busy, delaying partial result')
+            return False
+
+        return self._send(result, message)
 
     def _onCallFailed(self, failure, *argv, **kwargs):
         log.error("onCallFailed")
@@ -191,7 +560,38 @@ class SMAgentXMPP(Client):
     def _send(self, result, message):
         log.debug('Send Response')
         message.toResult(*result)
-        self.send(message.toEtree())
+
+        # Serialize a snapshot: message is updated again by later results
+        snapshot = copy.copy(message)
+
+        # Compressed stream: don't compress twice
+        snapshot.plain_output = self.compressed
+        d = self._serializer.submit(message.id, snapshot.toXml, size=snapshot.output_length())
+
+        # Timed out results are final too, with no retvalue
+        final = (len(result) < 5 or not result[4]) and hasattr(message, 'dedup_key')
+        if final:
+            d.addCallback(self._sendFinal, message)
+
+        else:
+            d.addCallback(self.send)
+
+        d.addErrback(self._onSendFailed, message, final)
+        return d
+
+    def _sendFinal(self, data, message):
+        self.send(data)
+
+        # One result for each duplicate received while it was running
+        for _ in range(self._dedup.finished(message.dedup_key, data)):
+            self.send(data)
+
+    def _onSendFailed(self, failure, message, final=False):
+        log.error("Unable to send result for %s: %s" % (message.command, failure.getErrorMessage()))
+
+        if final:
+            # Retransmissions would otherwise wait for a result never sent
+            self._dedup.forget(message.dedup_key)
 
     def _read_pub_key(self):
         log.debug('Reading public certificate')
@@ -208,16 +608,38 @@ class SMAgentXMPP(Client):
         return public_key
 
     def _verify_message(self, message):
+        return self._verify_command(message, message.command, message.command_args, message.signature,
+                                    message.session)
+
+    def _verify_command(self, message, command, command_args, signature, session_id=None):
+        """
+        RSA check of signature, or HMAC check with the session_id key.
+        Returns None if the session is unknown or has expired.
+        """
         args_encoded = ''
-        for arg in sorted(message.command_args.keys()):
-            args_encoded += arg + ':' + message.command_args[arg] + ':'
+        for arg in sorted(command_args.keys()):
+            args_encoded += arg + ':' + command_args[arg] + ':'
 
         text = message.from_.split('/')[0] + '::' + \
                message.to.split('/')[0] + '::' + \
-               message.command + '::' + \
+               command + '::' + \
                args_encoded
 
-        return self._rsa_verify(text, message.signature, message.command, message.from_)
+        if session_id:
+            return self._hmac_verify(text, signature, command, message.from_, session_id)
+
+        return self._rsa_verify(text, signature, command, message.from_)
+
+    def _hmac_verify(self, text, signature, command, sender, session_id):
+        verified = self._sessions.verify(sender.split('/')[0], session_id, text, signature)
+
+        if verified:
+            log.debug("[HMAC CHECK: OK] command: %s - from: %s" % (command, sender))
+
+        elif verified is not None:
+            log.error("[HMAC CHECK: Error] %s - from: %s" % (command, sender))
+
+        return verified
 
     def _rsa_verify(self, text, signature, command, sender):
         def _emsa_pkcs1_v1_5_encode(M, emLen):
@@ -250,7 +672,7 @@ class SMAgentXMPP(Client):
 
 
 class CommandRunner():
-    def __init__(self, config):
+    def __init__(self, config, max_concurrent=None):
         if sys.platform.startswith("win32"):
             self._python_runner = config['python_interpreter_windows']
             self.command_paths = [
@@ -265,6 +687,7 @@ class CommandRunner():
 
         self.timeout = int(config['timeout'])
         self.timeout_dc = None
+        self.max_output_memory = int(config.get('max_output_memory', buffer.DEFAULT_MAX_MEMORY))
 
         self.env = os.environ
         self.env['DEBIAN_FRONTEND'] = 'noninteractive'
@@ -278,43 +701,340 @@ class CommandRunner():
         log.debug("ENV: %s" % self.env)
         #reactor.callLater(0, self._loadCommands)
         self._commands = {}
+
+        # Results cache, TTLs from [[cache_ttl]] override the plugin ones
+        self._cache = cache.ResultCache(int(config.get('cache_max_size', cache.DEFAULT_MAX_SIZE)))
+        for command_name, ttl in config.get('cache_ttl', {}).items():
+            self._cache.set_ttl(command_name, int(ttl))
+
+        # Identical read-only commands (cached or listed in coalesce_commands)
+        # running at the same time share one execution
+        self._coalesce = set(config.as_list('coalesce_commands') if config.get('coalesce_commands') else [])
+        self._in_flight = {}
+
+        # Commands not run because their deadline expired
+        self._expired = 0
+
+        # Payloads referenced by sha256 in command arguments
+        self._store = store.PayloadStore(
+            os.path.join(os.path.dirname(__file__), config.get('store_path', _STORE_PATH)),
+            int(config.get('store_max_size', store.DEFAULT_MAX_SIZE)),
+        )
+
+        # Commands run by the agent itself
+        self._builtins = {
+            'agent_stats': self._agent_stats,
+            'file_transfer': self._file_transfer,
+            'store_check': self._store_check,
+            'store_upload': self._store_upload,
+        }
+
+        # Commands wait for plugin discovery (when_ready)
+        self.loaded = False
+        self._waiting = []
+
+        self._manifest = PluginManifest(os.path.join(os.path.dirname(__file__), _MANIFEST_FILE))
         reactor.callWhenRunning(self._load_commands)
 
+        max_low = config.get('max_concurrent_low')
+        self._scheduler = scheduler.CommandScheduler(
+            max_concurrent or int(config.get('max_concurrent_commands', scheduler.DEFAULT_MAX_CONCURRENT)),
+            int(config.get('max_concurrent_per_plugin', scheduler.DEFAULT_MAX_PER_PLUGIN)),
+            max_low and int(max_low),
+            config.as_list('priority_high') if config.get('priority_high') else [],
+            config.as_list('priority_low') if config.get('priority_low') else [],
+        )
+
+        # Warm worker pools for plugins listed in worker_plugins
+        self._pools = {}
+        self._load_pools(config)
+
+        # Read-only commands listed in inline_commands run in-process
+        self._inline = None
+        if config.get('inline_commands'):
+            self._inline = inline.InlineRunner(config.as_list('inline_commands'),
+                                               int(config.get('inline_timeout', inline.DEFAULT_TIMEOUT)),
+                                               int(config.get('inline_threads', inline.DEFAULT_THREADS)))
+
+    def _load_pools(self, config):
+        if not config.get('worker_plugins'):
+            return
+
+        pool_size = int(config.get('worker_pool_size', workers.DEFAULT_POOL_SIZE))
+        max_requests = int(config.get('worker_max_requests', workers.DEFAULT_MAX_REQUESTS))
+        idle_timeout = int(config.get('worker_idle_timeout', workers.DEFAULT_IDLE_TIMEOUT))
+
+        for path in self.command_paths:
+            for plugin in config.as_list('worker_plugins'):
+                full_filename = os.path.join(path, plugin)
+                if not os.path.isfile(full_filename):
+                    continue
+
+                pool = workers.WorkerPool(full_filename, self._python_runner, self.env,
+                                          size=pool_size, max_requests=max_requests, idle_timeout=idle_timeout)
+                self._pools[full_filename] = pool
+                reactor.callWhenRunning(pool.start)
+                reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+
+    def when_ready(self):
+        """ Deferred fired once plugin commands are loaded """
+        d = Deferred()
+        if self.loaded:
+            d.callback(None)
+
+        else:
+            self._waiting.append(d)
+
+        return d
+
     def _load_commands(self):
+        startup.timer.begin('plugins')
+        pending = []
+
         for path in self.command_paths:
             log.debug("Processing dir: %s" % path)
             try:
                 if os.path.isdir(path):
-                    for filename in os.listdir(path):
-                        if not filename.startswith('plugin_'):
+                    self._manifest.check_base(path)
+
+                    for full_filename in plugin_files(path):
+                        filename = os.path.basename(full_filename)
+
+                        info = self._manifest.get(full_filename)
+                        if info is None:
+                            info = inspect_plugin(full_filename)
+                            if info is not None:
+                                self._manifest.set(full_filename, info)
+
+                        if info is not None:
+                            log.debug("  Plugin %s loaded from manifest." % filename)
+                            self._add_commands(info, full_filename)
                             continue
 
+                        # Unable to inspect plugin, ask it for its commands
                         log.debug("  Queuing plugin %s for process." % filename)
-                        full_filename = os.path.join(path, filename)
                         d = self._run_process(full_filename, '', [])
                         d.addCallback(self._add_command, filename=full_filename)
+                        pending.append(d)
             except:
                 print sys.exc_info()
 
+        self._manifest.save()
+
+        d = DeferredList(pending, consumeErrors=True)
+        d.addCallback(self._commands_loaded)
+
+    def _commands_loaded(self, _):
+        startup.timer.end('plugins')
+        log.info("%i commands loaded" % len(self._commands))
+
+        self.loaded = True
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
     def _add_command(self, data, **kwargs):
         (exit_code, stdout, stderr, timeout_called) = data
 
         if exit_code == 0:
+            commands = {}
+            cache_ttl = {}
             for line in stdout.splitlines():
-                self._commands[line.split()[0]] = kwargs['filename']
-                log.debug("Command %s added" % line.split()[0])
+                # command_name ['arg1', 'arg2'] [cache ttl]
+                command_name, _, command_args = line.partition(' ')
+                if not command_name:
+                    continue
+
+                command_args, _, ttl = command_args.rpartition(']')
+                try:
+                    commands[command_name] = ast.literal_eval(command_args + ']')
+
+                except:
+                    commands[command_name] = []
+
+                if ttl.strip().isdigit():
+                    cache_ttl[command_name] = int(ttl)
+
+            info = plugin_info(commands, cache_ttl)
+            self._add_commands(info, kwargs['filename'])
+            self._manifest.set(kwargs['filename'], info)
+            self._manifest.save()
 
         else:
             log.error('Error adding commands from %s: %s'
                     % (kwargs['filename'], data))
 
-    def run_command(self, command, command_args, flush_callback=None, message=None):
+    def _add_commands(self, info, filename):
+        for command_name in info['commands']:
+            self._commands[command_name] = filename
+            log.debug("Command %s added" % command_name)
+
+        for command_name, ttl in info['cache_ttl'].items():
+            self._cache.set_ttl(command_name, ttl, override=False)
+
+    def run_command(self, command, command_args, flush_callback=None, message=None, deadline=None):
+        """
+        Returns a Deferred fired with the command result, or None for an
+        unknown command. Commands not started before deadline (unix time)
+        are answered with _E_DEADLINE_EXPIRED and their timeout is capped to
+        the time left.
+        """
+        if deadline and deadline <= time():
+            return succeed(self._expired_result(command, deadline))
+
+        if command in self._builtins:
+            return self._scheduler.submit(command, _BUILTIN_PLUGIN + command, self._builtins[command],
+                                          command_args, flush_callback, message)
+
         if command in self._commands:
-            log.debug("executing %s with args: %s" % (command, command_args))
-            return self._run_process(self._commands[command], command, command_args, flush_callback, message)
+            missing = self._store.missing(command_args)
+            if missing:
+                log.info("%s payloads not stored: %s" % (command, ', '.join(missing)))
+                return succeed(self._missing_result(missing))
+
+            cache_key = self._cache.key(command, command_args)
+            if self._cache.ttl(command):
+                result = self._cache.get(cache_key)
+                if result:
+                    log.debug("%s result from cache" % command)
+                    return succeed(result)
+
+            # Identical command already running: share its result, unless
+            # that one can expire before this one's deadline
+            coalesce = self._cache.ttl(command) or command in self._coalesce
+            in_flight_key = cache.command_key(command, command_args, ())
+            in_flight = coalesce and self._in_flight.get(in_flight_key)
+            if in_flight and (not in_flight[0] or (deadline and deadline <= in_flight[0])):
+                log.debug("%s already running, waiting for its result" % command)
+                d = Deferred()
+                in_flight[1].append(d)
+                return d
+
+            log.debug("queuing %s with args: %s" % (command, command_args))
+            filename = self._commands[command]
+            d = self._scheduler.submit(command, filename, self._execute,
+                                       command, command_args, filename, flush_callback, message, deadline)
+
+            if self._cache.ttl(command):
+                d.addCallback(self._cache_result, command, cache_key)
+
+            if coalesce and not in_flight:
+                self._in_flight[in_flight_key] = (deadline, [])
+                d.addBoth(self._in_flight_finished, in_flight_key)
+            return d
         return
 
-    def _run_process(self, filename, command_name, command_args, flush_callback=None, message=None):
+    def get_stats(self):
+        stats = self._scheduler.stats()
+        stats['cache'] = self._cache.stats()
+        stats['store'] = self._store.stats()
+        stats['expired'] = self._expired
+        stats['startup'] = startup.timer.stats()
+        return stats
+
+    def _agent_stats(self, command_args, flush_callback=None, message=None):
+        """ Scheduler, caches, store and startup phase timings """
+        return (0, json.dumps(self.get_stats()), '', 0)
+
+    def _file_transfer(self, command_args, flush_callback=None, message=None):
+        """ Streams a file (file, offset, length, chunk_size, idle_timeout) as partial results """
+        if not flush_callback:
+            return (_E_RUNNING_COMMAND, '', "ERROR: file.transfer can only run as a single command", 0)
+
+        try:
+            length = command_args.get('length')
+            file_transfer = transfer.FileTransfer(
+                command_args['file'],
+                lambda result: flush_callback(result, message),
+                int(command_args.get('offset', 0)),
+                int(length) if length else None,
+                int(command_args.get('chunk_size', transfer.DEFAULT_CHUNK_SIZE)),
+                int(command_args.get('idle_timeout', transfer.IDLE_TIMEOUT)),
+            )
+
+        except (KeyError, ValueError, transfer.TransferError) as e:
+            return (_E_RUNNING_COMMAND, '', "ERROR: Invalid transfer: %s" % e, 0)
+
+        return file_transfer.start()
+
+    def _store_check(self, command_args, flush_callback=None, message=None):
+        """ Digests (comma separated sha256 argument) the store doesn't have """
+        digests = [digest.strip() for digest in command_args.get('sha256', '').split(',') if digest.strip()]
+        missing = [digest for digest in digests if not self._store.has(digest)]
+        return (0, json.dumps({'missing': missing}), '', 0)
+
+    def _store_upload(self, command_args, flush_callback=None, message=None):
+        """ Stores a chunk (base64 data) of the payload sha256 at offset """
+        try:
+            digest = command_args['sha256']
+            received = self._store.put_chunk(digest, int(command_args.get('offset', 0)),
+                                             base64.b64decode(command_args.get('data', '')),
+                                             int(command_args['total']))
+
+        except (KeyError, ValueError, TypeError, store.StoreError) as e:
+            return (_E_RUNNING_COMMAND, '', "ERROR: Invalid upload: %s" % e, 0)
+
+        retval = {
+            'sha256': digest,
+            'received': received,
+            'complete': received == int(command_args['total']),
+        }
+        return (0, json.dumps(retval), '', 0)
+
+    @staticmethod
+    def _missing_result(missing):
+        return (_E_MISSING_PAYLOAD, json.dumps({'missing': missing}), '', 0)
+
+    def _expired_result(self, command, deadline):
+        log.info("%s not run: deadline expired %.1fs ago" % (command, time() - deadline))
+        self._expired += 1
+        return expired_result(deadline)
+
+    def _cache_result(self, result, command, cache_key):
+        self._cache.set(cache_key, command, result)
+        return result
+
+    def _in_flight_finished(self, result, in_flight_key):
+        # Waiters didn't stream: they only get the final result fields
+        shared = result[:4] if isinstance(result, tuple) else result
+        for d in self._in_flight.pop(in_flight_key)[1]:
+            d.callback(shared)
+        return result
+
+    def _execute(self, command, command_args, filename, flush_callback=None, message=None, deadline=None):
+        log.debug("executing %s with args: %s" % (command, command_args))
+
+        # Could have waited in the scheduler queue past its deadline
+        if deadline and deadline <= time():
+            return self._expired_result(command, deadline)
+
+        # Payloads are read when the command starts (could be evicted while queued)
+        command_args, missing = self._store.resolve(command_args)
+        if missing:
+            return self._missing_result(missing)
+        if self._inline and self._inline.can_run(command, filename):
+            return self._inline.run(command, command_args, filename, self._get_timeout(command_args, deadline))
+
+        if filename in self._pools:
+            return self._pools[filename].run(command, command_args, self._get_timeout(command_args, deadline))
+
+        return self._run_process(filename, command, command_args, flush_callback, message, deadline)
+
+    def _get_timeout(self, command_args, deadline=None):
+        # Set timeout from command
+        if 'timeout' in command_args:
+            timeout = int(command_args['timeout'])
+
+        else:
+            timeout = self.timeout
+
+        # Not longer than the caller waits
+        if deadline:
+            timeout = min(timeout, max(int(ceil(deadline - time())), 1))
+
+        return timeout
+
+    def _run_process(self, filename, command_name, command_args, flush_callback=None, message=None, deadline=None):
         ext = os.path.splitext(filename)[1]
         if ext in ('.py', '.pyw', '.pyc'):
             command = self._python_runner
@@ -322,14 +1042,15 @@ class CommandRunner():
             # -u: sets unbuffered output
             args = [command, '-u', '-W ignore::DeprecationWarning', filename, command_name]
 
+            # Python plugins send their result on a dedicated fd
+            framed = frames.FRAMES_AVAILABLE and bool(command_name)
+
         else:
             command = filename
             args = [command, command_name]
+            framed = False
 
-        # Set timeout from command
-        cmd_timeout = self.timeout
-        if 'timeout' in command_args:
-            cmd_timeout = int(command_args['timeout'])
+        cmd_timeout = self._get_timeout(command_args, deadline)
 
         if command_name:
             log.info("Running %s from %s (timeout: %i)" % (command_name, filename, cmd_timeout))
@@ -337,17 +1058,30 @@ class CommandRunner():
         else:
             log.info("[INIT] Loading commands from %s" % filename)
 
-        crp = CommandRunnerProcess(cmd_timeout, command_args, flush_callback, message)
+        crp = CommandRunnerProcess(cmd_timeout, command_args, flush_callback, message,
+                                   self.max_output_memory, framed)
         d = crp.getDeferredResult()
-        reactor.spawnProcess(crp, command, args, env=self.env)
+
+        if framed:
+            reactor.spawnProcess(crp, command, args, env=frames.framed_env(self.env), childFDs=frames.child_fds())
+
+        else:
+            reactor.spawnProcess(crp, command, args, env=self.env)
 
         return d
 
 
 class CommandRunnerProcess(ProcessProtocol):
-    def __init__(self, timeout, command_args, flush_callback=None, message=None):
-        self.stdout = ""
-        self.stderr = ""
+    def __init__(self, timeout, command_args, flush_callback=None, message=None,
+                 max_memory=buffer.DEFAULT_MAX_MEMORY, framed=False):
+        # framed: result comes as a frame on frames.RESULT_FD and stdout
+        # is only progress output, else it's found after _FINAL_OUTPUT_STRING
+        self.framed = framed
+        self.frame_decoder = frames.FrameDecoder()
+        self.result = None
+
+        self.stdout = buffer.OutputBuffer(max_memory)
+        self.stderr = buffer.OutputBuffer(max_memory)
         self.deferreds = []
         self.timeout = timeout
         self.command_args = command_args
@@ -358,6 +1092,14 @@ class CommandRunnerProcess(ProcessProtocol):
         self.flush_later_forced = None
         self.message = message
 
+        # Delta streaming: offsets and checksums of the output already sent
+        self.delta = getattr(message, 'stream_mode', None) == STREAM_DELTA
+        self.seq = 0
+        self.stdout_sent = 0
+        self.stderr_sent = 0
+        self.stdout_sha1 = hashlib.sha1()
+        self.stderr_sha1 = hashlib.sha1()
+
     def connectionMade(self):
         log.debug("Process started.")
         self.timeout_dc = reactor.callLater(self.timeout, self.transport.signalProcess, 'KILL')
@@ -368,31 +1110,57 @@ class CommandRunnerProcess(ProcessProtocol):
         # And close stdin to signal we are done writing args.
         self.transport.closeStdin()
 
+    def childDataReceived(self, childFD, data):
+        if childFD == frames.RESULT_FD:
+            self.resultReceived(data)
+
+        else:
+            ProcessProtocol.childDataReceived(self, childFD, data)
+
+    def resultReceived(self, data):
+        try:
+            for frame in self.frame_decoder.feed(data):
+                self.result = frame
+
+        except frames.FrameError as e:
+            log.error("Invalid result received: %s" % e)
+            return
+
+        if self.result is not None:
+            # Output sent before the result is not part of it, stop flush callback
+            self.stderr.reset()
+            self.flush_callback = None
+
     def outReceived(self, data):
         log.debug("Out made: %s" % data)
 
-        if _FINAL_OUTPUT_STRING in data:
+        if self.framed:
+            if self.result is None:
+                self.stdout.write(data)
+
+        elif _FINAL_OUTPUT_STRING in data:
             for line in data.split("\n"):
                 if _FINAL_OUTPUT_STRING in line:
                     # Skip this line and stop flush callback
-                    self.stdout = self.stderr = ''
+                    self.stdout.reset()
+                    self.stderr.reset()
                     self.flush_callback = None
 
                 else:
-                    self.stdout += line
+                    self.stdout.write(line)
         else:
-            self.stdout += data
+            self.stdout.write(data)
 
         self._flush()
 
     def errReceived(self, data):
         log.debug("Err made: %s" % data)
-        self.stderr += data
+        self.stderr.write(data)
         self._flush()
 
     def _flush(self):
         if not self.flush_callback: return
-        total_out = len(self.stdout) + len(self.stderr)
+        total_out = self.stdout.length + self.stderr.length
 
         if total_out - self.last_send_data_size > FLUSH_MIN_LENGTH:
             curr_time = time()
@@ -400,15 +1168,65 @@ class CommandRunnerProcess(ProcessProtocol):
                 self.last_send_data_size = total_out
                 self.last_send_data_time = curr_time
 
-                log.debug("Scheduling a flush response: %s" % self.stdout)
+                log.debug("Scheduling a flush response: %i bytes" % total_out)
                 self._cancel_flush(self.flush_later_forced)
-                self.flush_later = reactor.callLater(1, self.flush_callback,
-                                                     (None, self.stdout, self.stderr, 0, total_out), self.message)
+                self.flush_later = reactor.callLater(1, self._send_flush)
 
         if not self.flush_later:
             self._cancel_flush(self.flush_later_forced)
-            self.flush_later_forced = reactor.callLater(FLUSH_TIME, self.flush_callback,
-                                                        (None, self.stdout, self.stderr, 0, total_out), self.message)
+            self.flush_later_forced = reactor.callLater(FLUSH_TIME, self._send_flush)
+
+    def _send_flush(self):
+        # Output is read when the flush is sent, not when it's scheduled
+        if not self.flush_callback: return
+        total_out = self.stdout.length + self.stderr.length
+
+        if not self.delta:
+            sent = self.flush_callback((None, self.stdout.getvalue(), self.stderr.getvalue(), 0, total_out),
+                                       self.message)
+            self._flush_refused(sent)
+            return
+
+        stdout = self.stdout.read(self.stdout_sent)
+        stderr = self.stderr.read(self.stderr_sent)
+        if not stdout and not stderr:
+            return
+
+        stream_info = {
+            'seq': self.seq,
+            'stdout_offset': self.stdout_sent,
+            'stderr_offset': self.stderr_sent,
+        }
+
+        sent = self.flush_callback((None, stdout, stderr, 0, total_out, stream_info), self.message)
+        if self._flush_refused(sent):
+            # Next flush starts from the same offsets
+            return
+
+        self.seq += 1
+        self.stdout_sent += len(stdout)
+        self.stderr_sent += len(stderr)
+        self.stdout_sha1.update(stdout)
+        self.stderr_sha1.update(stderr)
+
+    def _flush_refused(self, sent):
+        """ flush_callback returns False when it can't send now: retry later """
+        if sent is not False:
+            return False
+
+        self._cancel_flush(self.flush_later_forced)
+        self.flush_later_forced = reactor.callLater(FLUSH_TIME, self._send_flush)
+        return True
+
+    def _stream_summary(self):
+        """ Lets the receiver check the output it has rebuilt from deltas """
+        return {
+            'seq': self.seq,
+            'stdout_length': self.stdout_sent,
+            'stdout_sha1': self.stdout_sha1.hexdigest(),
+            'stderr_length': self.stderr_sent,
+            'stderr_sha1': self.stderr_sha1.hexdigest(),
+        }
 
     def _cancel_flush(self, flush_reactor):
         if flush_reactor:
@@ -441,15 +1259,40 @@ class CommandRunnerProcess(ProcessProtocol):
         if not self.timeout_dc.called:
             self.timeout_dc.cancel()
 
+        if self.framed and self.result is not None:
+            stdout = self.result
+
+        elif self.framed:
+            stdout = self._legacy_result(self.stdout.getvalue())
+
+        else:
+            stdout = self.stdout.getvalue()
+
+        stderr = self.stderr.getvalue()
+        self.stdout.close()
+        self.stderr.close()
+
+        result = (exit_code, stdout, stderr, self.timeout_dc.called)
+        if self.delta:
+            result += (0, self._stream_summary())
+
         for d in self.deferreds:
-            d.callback((exit_code, self.stdout, self.stderr,
-                        self.timeout_dc.called))
+            d.callback(result)
 
     def getDeferredResult(self):
         d = Deferred()
         self.deferreds.append(d)
         return d
 
+    @staticmethod
+    def _legacy_result(stdout):
+        """ Plugin without result fd support, look for the final output string """
+        index = stdout.rfind(_FINAL_OUTPUT_STRING)
+        if index < 0:
+            return stdout
+
+        return stdout[index + len(_FINAL_OUTPUT_STRING):].replace("\n", "")
+
 
 class IqMessage:
     """
@@ -467,9 +1310,82 @@ class IqMessage:
         </ecm_message>
     </iq>
 
+    BATCH FORMAT: several signed commands in one message, run concurrently
+    and answered with one result holding a <command> element per command
+    (id, name, retvalue, timed_out and its output):
+        <ecm_message version="1">
+            <batch>
+                <command id="1" name="command1" signature="XXXX"><args /></command>
+                <command id="2" name="command2" signature="XXXX"><args /></command>
+            </batch>
+        </ecm_message>
+
+    PIPELINE FORMAT: a DAG of signed commands. A step runs when the steps
+    in its depends attribute have succeeded, on_failure (stop, continue or
+    rollback, default for the pipeline: stop) applies when it fails and
+    rollback commands run in order after a step with the rollback policy
+    fails. Partial results carry each step state change (state attribute)
+    and the final one every step:
+        <ecm_message version="1">
+            <pipeline on_failure="stop">
+                <command id="src" name="source.run" signature="XXXX"><args /></command>
+                <command id="cfg" name="configfile.run" depends="src" signature="XXXX"><args /></command>
+                <command id="svc" name="service.control" depends="cfg" on_failure="rollback" signature="XXXX"><args /></command>
+                <rollback>
+                    <command id="undo" name="command3" signature="XXXX"><args /></command>
+                </rollback>
+            </pipeline>
+        </ecm_message>
+
+    PAYLOADS: an argument value "sha256:<hex>" is replaced by the base64
+    of the payload with that SHA-256 in the agent store. Missing payloads
+    are answered with retvalue 250 and {"missing": [<hex>, ...]} as
+    stdout; they are uploaded with store.upload (sha256, offset, total and
+    a base64 data chunk) and store.check lists the missing ones.
+
+    FILE TRANSFER: file.transfer (file, offset, length, chunk_size,
+    idle_timeout: fails when no chunk could be sent for that long) sends
+    the file as partial results holding one raw chunk each (seq and
+    stdout_offset attributes), the final result has the transferred
+    length and its SHA-256 (stdout_length, stdout_sha256).
+
+    RELAY: an agent with relay_listen set holds the XMPP session of the
+    agents connected to it. IQs for them are sent to the relay with their
+    bare JID as the relay attribute of ecm_message; their results come
+    from the relay with the same attribute. The relay presence lists them:
+        <relay xmlns="http://ecmanaged.net/protocol/relay"><agent jid="..." /></relay>
+
+    SESSIONS: session.nonce returns {"nonce": <hex>}, valid once within a
+    minute. session.open (nonce, ttl) returns {"session": <id>, "key":
+    <base64>, "expires": <unix time>}, the key being 32 random bytes
+    encrypted with the server public key (RSA-OAEP). Both must be RSA
+    signed. Later commands from the same sender with a session attribute
+    are signed with the base64 HMAC-SHA256 of the same text with that key;
+    unknown or expired sessions are answered with retvalue 248.
+    session.close (session) drops the key.
+
+    Optional command attributes:
+        deadline="<unix time>": (also on <batch> and <pipeline>) the command
+        is answered with retvalue 249 instead of run if it hasn't started
+        by then, and its timeout is capped to the time left.
+        stream="delta": partial results only carry the output produced since
+        the previous one (with seq, stdout_offset and stderr_offset) and the
+        final result adds the length and sha1 of the streamed output.
+
+    Results carry output as <gzip_stdout>/<gzip_stderr> (zlib + base64),
+    or as plain <stdout>/<stderr> text when plain_output is set (stream
+    compression active) and the output is valid XML text.
+
     """
 
     def __init__(self, elem=None):
+        self.plain_output = False
+        self.batch = None
+        self.pipeline = None
+        self.commands = []
+        self.deadline = None
+        self.session = None
+
         if elem:
             try:
                 if elem.name != 'iq':
@@ -495,12 +1411,24 @@ class IqMessage:
                     self.resource = None
 
                 el_command = el_ecm_message.firstChildElement()
+                self.deadline = parse_deadline(el_command.getAttribute('deadline'))
+
+                if el_command.name == 'batch':
+                    self._parse_batch(el_command)
+                    return
+
+                if el_command.name == 'pipeline':
+                    self._parse_pipeline(el_command)
+                    return
+
                 self.command = el_command['name']
 
                 el_args = el_command.firstChildElement()
                 self.command_args = el_args.attributes
 
                 self.signature = el_command['signature']
+                self.session = el_command.getAttribute('session')
+                self.stream_mode = el_command.getAttribute('stream')
 
             except Exception as e:
                 log.error("Error parsing IQ message: %s" % elem.toXml())
@@ -512,6 +1440,39 @@ class IqMessage:
             self.from_ = ''
             self.to = ''
             self.resource = ''
+            self.stream_mode = None
+
+    def _parse_batch(self, el_batch):
+        self.command = 'batch'
+        self.command_args = {}
+        self.signature = ''
+        self.stream_mode = None
+
+        self.batch = []
+        for index, el_command in enumerate(el_batch.elements()):
+            if el_command.name == 'command':
+                self.batch.append(BatchCommand(el_command, str(index)))
+
+    def _parse_pipeline(self, el_pipeline):
+        self._parse_batch(el_pipeline)
+        self.command = 'pipeline'
+        self.pipeline = True
+        self.on_failure = el_pipeline.getAttribute('on_failure', pipeline.STOP)
+
+        self.rollback = []
+        for el_rollback in el_pipeline.elements():
+            if el_rollback.name == 'rollback':
+                for index, el_command in enumerate(el_rollback.elements()):
+                    if el_command.name == 'command':
+                        self.rollback.append(BatchCommand(el_command, 'rollback%i' % index))
+
+    def output_length(self):
+        length = len(self.stdout) + len(self.stderr)
+        for command in self.commands:
+            if command.result:
+                length += len(command.result[1]) + len(command.result[2])
+
+        return length
 
     def toEtree(self):
         msg = Element(('jabber:client', 'iq'))
@@ -532,16 +1493,58 @@ class IqMessage:
             result['timed_out'] = self.timed_out
             result['partial'] = self.partial
 
-            # compress out
-            result.addElement('gzip_stdout').addContent(base64.b64encode(zlib.compress(self.stdout)))
-            result.addElement('gzip_stderr').addContent(base64.b64encode(zlib.compress(self.stderr)))
+            # Delta streaming offsets and checksums
+            for key in sorted(self.stream_info):
+                result[key] = str(self.stream_info[key])
+
+            self._add_output(result, 'stdout', self.stdout)
+            self._add_output(result, 'stderr', self.stderr)
+
+            for command in self.commands:
+                el_command = result.addElement('command')
+                el_command['id'] = command.id
+                el_command['name'] = command.command
+
+                if command.state:
+                    el_command['state'] = command.state
+
+                if command.result:
+                    (retvalue, stdout, stderr, timed_out) = command.result
+                    el_command['retvalue'] = str(retvalue)
+                    el_command['timed_out'] = str(timed_out)
+                    self._add_output(el_command, 'stdout', str(stdout))
+                    self._add_output(el_command, 'stderr', str(stderr))
 
         return msg
 
+    def _add_output(self, result, name, output):
+        if self.plain_output:
+            text = self._xml_text(output)
+            if text is not None:
+                result.addElement(name).addContent(text)
+                return
+
+        # compress out
+        result.addElement('gzip_' + name).addContent(base64.b64encode(zlib.compress(output)))
+
+    @staticmethod
+    def _xml_text(output):
+        """ Output as unicode, or None if it can't be sent as XML text """
+        try:
+            text = output.decode('utf-8')
+
+        except UnicodeDecodeError:
+            return None
+
+        if _XML_INVALID_CHARS.search(text):
+            return None
+
+        return text
+
     def toXml(self):
         return self.toEtree().toXml()
 
-    def toResult(self, retvalue, stdout, stderr, timed_out, partial=0):
+    def toResult(self, retvalue, stdout, stderr, timed_out, partial=0, stream_info=None):
         """ Converts a query message to a result message. """
         # Don't switch to/from if already is a result
         if self.type != 'result':
@@ -553,3 +1556,55 @@ class IqMessage:
         self.stderr = str(stderr)
         self.timed_out = str(timed_out)
         self.partial = str(partial)
+        self.stream_info = stream_info or {}
+
+
+def plugin_files(path):
+    """ Plugins (plugin_*) in path, compiled files of a .py plugin are not plugins """
+    filenames = sorted(os.listdir(path))
+    plugins = []
+    for filename in filenames:
+        if not filename.startswith('plugin_'):
+            continue
+
+        name, ext = os.path.splitext(filename)
+        if ext in ('.pyc', '.pyo') and name + '.py' in filenames:
+            continue
+
+        plugins.append(os.path.join(path, filename))
+    return plugins
+
+
+def parse_deadline(value):
+    """ deadline attribute (unix time) as a float, None if not set or invalid """
+    try:
+        return float(value) if value else None
+
+    except ValueError:
+        log.warn("Invalid deadline: %s" % value)
+        return None
+
+
+def expired_result(deadline):
+    return (_E_DEADLINE_EXPIRED, '', "Deadline expired %.1fs ago" % (time() - deadline), 0)
+
+
+class BatchCommand:
+    """ A command of a batch or pipeline message and its result """
+
+    def __init__(self, el_command, default_id):
+        self.id = el_command.getAttribute('id', default_id)
+        self.command = el_command['name']
+        self.signature = el_command['signature']
+        self.session = el_command.getAttribute('session')
+
+        el_args = el_command.firstChildElement()
+        self.command_args = el_args.attributes if el_args is not None else {}
+
+        # Pipeline steps
+        depends = el_command.getAttribute('depends', '')
+        self.depends = [depend.strip() for depend in depends.split(',') if depend.strip()]
+        self.on_failure = el_command.getAttribute('on_failure')
+        self.state = None
+
+        self.result = None
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from tempfile import TemporaryFile
+
+DEFAULT_MAX_MEMORY = 1024 ** 2
+
+
+class OutputBuffer:
+    """
+    Append only buffer for process output.
+    Data is kept as a list of chunks until max_memory bytes and moved to
+    a temporary file past that limit. Length is tracked on write.
+    """
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.length = 0
+        self._chunks = []
+        self._file = None
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.length += len(data)
+
+        if self._file:
+            self._file.seek(0, 2)
+            self._file.write(data)
+            return
+
+        self._chunks.append(data)
+        if self.length > self.max_memory:
+            self._spill()
+
+    def getvalue(self):
+        return self.read(0)
+
+    def read(self, offset=0):
+        """ Returns buffer content from offset to the end """
+        if offset >= self.length:
+            return ''
+
+        if self._file:
+            self._file.seek(offset)
+            return self._file.read()
+
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+
+        return self._chunks[0][offset:]
+
+    def reset(self):
+        self.close()
+        self.length = 0
+        self._chunks = []
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _spill(self):
+        self._file = TemporaryFile(prefix='ecagent_')
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks = []
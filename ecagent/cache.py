@@ -0,0 +1,242 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import simplejson as json
+from time import time
+from collections import OrderedDict
+
+# Local
+import ecagent.twlogging as log
+
+DEFAULT_MAX_SIZE = 1024 ** 2
+
+# Arguments that don't change a command result
+_IGNORED_ARGS = ('timeout',)
+
+
+def command_key(command, command_args, ignored_args=_IGNORED_ARGS):
+    """ Canonical key for a command and its arguments """
+    args = dict([(k, v) for k, v in command_args.items() if k not in ignored_args])
+    return command + ':' + json.dumps(args, sort_keys=True)
+
+
+class ResultCache:
+    """
+    LRU cache of successful command results. Each command has its own TTL
+    (no TTL: not cached) and the total size of cached output is capped.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._ttl = {}
+        self._entries = OrderedDict()
+
+    def set_ttl(self, command, ttl, override=True):
+        if override or command not in self._ttl:
+            self._ttl[command] = ttl
+
+    def ttl(self, command):
+        return self._ttl.get(command, 0)
+
+    def key(self, command, command_args):
+        return command_key(command, command_args)
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry and entry[0] > time():
+            # Move to the end: most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+        if entry:
+            self.size -= entry[1]
+
+        self.misses += 1
+        return None
+
+    def set(self, key, command, result):
+        (exit_code, stdout, stderr, timed_out) = result[:4]
+        ttl = self.ttl(command)
+
+        if not ttl or exit_code != 0 or timed_out:
+            return
+
+        size = len(key) + len(stdout) + len(stderr)
+        if size > self.max_size:
+            return
+
+        # Without the partial and stream fields of a delta stream run
+        self._remove(key)
+        self._entries[key] = (time() + ttl, size, result[:4])
+        self.size += size
+
+        # Evict least recently used entries
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+
+
+DEFAULT_DEDUP_TTL = 600
+DEFAULT_DEDUP_MAX_SIZE = 1024 ** 2
+DEFAULT_DEDUP_MAX_RUNNING = 900
+
+
+def _key_size(key):
+    return sum([len(part or '') for part in key])
+
+
+class DedupEntry:
+    def __init__(self, size):
+        self.running = True
+        self.received = time()
+        self.expires = None
+        self.size = size
+
+        # Duplicates received while running, answered when it finishes
+        self.waiting = 0
+
+        # Final result, None while running or if it was too large to keep
+        self.result = None
+
+
+class DedupWindow:
+    """
+    Recently received messages by (sender, IQ id, signature), so a
+    retransmitted message is never run twice: duplicates of a running
+    message wait for its result, duplicates of a finished one get its
+    final result again. Finished entries expire after ttl seconds, running
+    ones are dropped after max_running seconds in case they never finish.
+    The size of entries is capped: the results of the least recently
+    finished messages are dropped first, then the oldest running messages.
+    """
+
+    def __init__(self, ttl=DEFAULT_DEDUP_TTL, max_size=DEFAULT_DEDUP_MAX_SIZE,
+                 max_running=DEFAULT_DEDUP_MAX_RUNNING):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_running = max_running
+        self.size = 0
+        self.duplicates = 0
+
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(sender, message_id, signature):
+        return sender, message_id, signature
+
+    def received(self, key):
+        """
+        Returns None for a new message (now running), or the entry of the
+        message it duplicates.
+        """
+        self._expire()
+
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = DedupEntry(_key_size(key))
+            self._entries[key] = entry
+            self.size += entry.size
+            self._trim()
+            return None
+
+        self.duplicates += 1
+        if entry.running:
+            entry.waiting += 1
+
+        return entry
+
+    def finished(self, key, result):
+        """
+        Keeps the final result of a message, returns the number of
+        duplicates waiting for it.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return 0
+
+        entry.running = False
+        entry.expires = time() + self.ttl
+
+        size = len(result) + entry.size
+        if size <= self.max_size:
+            entry.result = result
+            self.size += size - entry.size
+            entry.size = size
+
+        # Move to the end: most recently used
+        self._entries[key] = entry
+        self._trim()
+
+        return entry.waiting
+
+    def forget(self, key):
+        """ Drops a message whose result couldn't be sent: a retransmission runs it again """
+        self._remove(key)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'duplicates': self.duplicates,
+        }
+
+    def _expire(self):
+        # Finished entries are in finishing order
+        now = time()
+        for key in self._entries.keys():
+            entry = self._entries[key]
+            if entry.running:
+                if entry.received + self.max_running <= now:
+                    log.warn("Message %s from %s never finished, forgetting it" % (key[1], key[0]))
+                    self._remove(key)
+                continue
+
+            if entry.expires > now:
+                break
+
+            self._remove(key)
+
+    def _trim(self):
+        for running in (False, True):
+            for key in self._entries.keys():
+                if self.size <= self.max_size:
+                    return
+
+                if self._entries[key].running == running:
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry.size
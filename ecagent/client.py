@@ -17,18 +17,17 @@
 import logging as log
 
 # Twisted imports
-from twisted.internet.defer import DeferredSemaphore
 from twisted.words.xish.domish import Element
 
 # Local
 from core import BasicClient
+import startup
 
 
 class Client(BasicClient):
     def __init__(self, config, observers, resource='XMPPClient'):
         """
-        XMPP Client class with ConfigObj, presence,
-        concurrent message sending limit, and observers support.
+        XMPP Client class with ConfigObj, presence and observers support.
 
         @param config: ConfigObj from where to read client settings.
         @param observers: Iterable of ("resource", callback') tuples.
@@ -41,17 +40,25 @@ class Client(BasicClient):
 
         self._online_contacts = set()
 
-        if 'max_concurrent_messages' in config:
-            max_concurrent = config.as_int('max_concurrent_messages')
-        else:
-            max_concurrent = 10
-        self._concurrency_semaphore = DeferredSemaphore(max_concurrent)
-
         if 'max_delay' in config:
             max_delay = self.cfg.as_int('max_delay')
         else:
             max_delay = 60
 
+        if 'stream_compression' in config:
+            compression = config.as_bool('stream_compression')
+        else:
+            compression = True
+
+        if 'stream_management' in config:
+            stream_management = config.as_bool('stream_management')
+        else:
+            stream_management = True
+
+        # Connect through a relay agent instead of the XMPP server
+        relay_server = config.get('relay_server') or None
+        relay_secret = config.get('relay_secret', '')
+
         self._my_full_jid = '/'.join((config['user'], resource))
 
         BasicClient.__init__(self,
@@ -61,6 +68,10 @@ class Client(BasicClient):
                              my_observers,
                              resource=resource,
                              max_delay=max_delay,
+                             compression=compression,
+                             stream_management=stream_management,
+                             relay_server=relay_server,
+                             relay_secret=relay_secret,
         )
 
     def _onPossibleErrorIq(self, elem):
@@ -80,6 +91,7 @@ class Client(BasicClient):
         let's see who has (dis)connected.
         """
         log.debug('_onPresence')
+        startup.timer.end('presence')
         presence = XMPPPresence(elem)
         if presence.available:
             log.debug("%s is now available" % presence.sender)
@@ -97,6 +109,9 @@ class Client(BasicClient):
             return True
         return False
 
+    def online_contacts(self):
+        return set(self._online_contacts)
+
 
 class XMPPPresence:
     def __init__(self, elem=None):
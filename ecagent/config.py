@@ -14,15 +14,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import random
 import socket
+import simplejson as json
 
-from time import sleep
+from time import time
 from platform import node
 from configobj import ConfigObj
 
 # Twisted imports
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
 from twisted.web.client import getPage
 from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
@@ -33,6 +37,22 @@ import ecagent.twlogging as log
 
 _ECMANAGED_AUTH_URL = 'https://my.ecmanaged.com/agent/meta-data/uuid'
 _ECMANAGED_AUTH_URL_ALT = 'https://my.ecmanaged.com/agent/meta-data/uuid'
+_ECMANAGED_AUTH_TIMEOUT = 30
+
+# MAC lookups are cached in this file, next to the config file
+_MAC_CACHE_FILE = '_mac.cache'
+MAC_CACHE_TTL = 86400
+
+# UUID lookup retries: exponential backoff with jitter
+BOOTSTRAP_RETRIES = 30
+RETRY_DELAY = 5
+RETRY_MAX_DELAY = 20
+
+
+def retry_delay(attempt):
+    """ Seconds to wait before retry attempt (from 0), +-50% jitter """
+    delay = min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay * (0.5 + random.random())
 
 
 class SMConfigObj(ConfigObj):
@@ -46,7 +66,7 @@ class SMConfigObj(ConfigObj):
 
     @inlineCallbacks
     def check_uuid(self):
-        mac = self._get_mac()
+        mac = yield self._get_mac()
 
         # Always generate a new password if not is set
         if not self['XMPP']['password']:
@@ -59,15 +79,19 @@ class SMConfigObj(ConfigObj):
             else:
                 # Try to get uuid
                 uuid = None
-                for i in range(30):
+                for attempt in range(BOOTSTRAP_RETRIES):
                     try:
                         uuid = yield self._getUUID()
                         if uuid:
                             break
 
-                    except:
-                        pass
-                    sleep(20)
+                    except Exception as e:
+                        log.warn("Unable to get UUID: %s" % e)
+
+                    # Reactor keeps running while waiting
+                    delay = retry_delay(attempt)
+                    log.info("Retrying UUID lookup in %.1f seconds" % delay)
+                    yield deferLater(reactor, delay, lambda: None)
 
                 if not uuid:
                     log.error("ERROR: Could not obtain UUID. please set up XMPP manually in %s" % self.filename)
@@ -116,17 +140,19 @@ class SMConfigObj(ConfigObj):
         address = ''
         try:
             hostname = self._get_hostname()
-            address  = self._get_ip()
+
+            # Resolves my.ecmanaged.com
+            address = yield deferToThread(self._get_ip)
         except:
             pass
 
         auth_url = _ECMANAGED_AUTH_URL + "/?ipaddress=%s&hostname=%s" % (address, hostname)
         auth_url_alt = _ECMANAGED_AUTH_URL + "/?ipaddress=%s&hostname=%s" % (address, hostname)
 
-        auth_content = yield getPage(auth_url)
+        auth_content = yield getPage(auth_url, timeout=_ECMANAGED_AUTH_TIMEOUT)
 
         if not auth_content:
-            auth_content = yield getPage(auth_url_alt)
+            auth_content = yield getPage(auth_url_alt, timeout=_ECMANAGED_AUTH_TIMEOUT)
 
         for line in auth_content.splitlines():
             if line and line.startswith('uuid:'):
@@ -175,33 +201,38 @@ class SMConfigObj(ConfigObj):
     def _getStoredMAC(self):
         return self['XMPP']['mac']
 
+    @inlineCallbacks
     def _get_mac(self):
         """
-        Try to get a unique identified, Some providers may change mac on stop/start
-        Use a low timeout to speed up agent start when no meta-data url
+        Network mac, uuid.getnode may run ifconfig: looked up on a thread
+        and cached for mac_cache_ttl seconds.
         """
-        uuid = None
-        try:
-            import urllib
+        cache_file = os.path.join(os.path.dirname(os.path.abspath(self.filename)), _MAC_CACHE_FILE)
 
-            socket.setdefaulttimeout(2)
-            urlopen = urllib.urlopen("http://169.254.169.254/latest/meta-data/instance-id")
-            socket.setdefaulttimeout(10)
+        try:
+            f = open(cache_file, 'r')
+            cached = json.load(f)
+            f.close()
 
-            for line in urlopen.readlines():
-                if "i-" in line:
-                    uuid = hex(line)
-            urlopen.close()
+            if cached['expires'] > time():
+                returnValue(cached['mac'])
 
-        except:
+        except (IOError, ValueError, KeyError, TypeError):
             pass
 
-        # Use network mac
-        if not uuid:
-            from uuid import getnode
-            uuid = getnode()
+        from uuid import getnode
+        mac = yield deferToThread(getnode)
+
+        ttl = int(self['XMPP'].get('mac_cache_ttl', MAC_CACHE_TTL))
+        try:
+            f = open(cache_file, 'w')
+            json.dump({'mac': mac, 'expires': time() + ttl}, f)
+            f.close()
+
+        except IOError as e:
+            log.warn("Unable to write mac cache: %s" % e)
 
-        return uuid
+        returnValue(mac)
 
 
 class SimpleProcessProtocol(ProcessProtocol):
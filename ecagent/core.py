@@ -14,23 +14,200 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import zlib
+from time import time
 from random import random
 
 # Twisted imports
-from twisted.words.protocols.jabber import client, jid, xmlstream
+from twisted.words.protocols.jabber import client, jid, xmlstream, sasl
+from twisted.internet.defer import Deferred
 from twisted.words.xish.domish import Element
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from twisted.words.protocols.jabber.xmlstream import STREAM_END_EVENT
 from twisted.words.protocols.jabber.client import IQ
 
 # Local
 import twlogging as log
+import sm
+import relay
+import startup
+
+NS_COMPRESS_FEATURE = 'http://jabber.org/features/compress'
+NS_COMPRESS_PROTOCOL = 'http://jabber.org/protocol/compress'
+
+
+class CompressInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """
+    Stream compression (XEP-0138) initializer, zlib method only.
+    Not required: the stream stays uncompressed if the server doesn't
+    offer zlib or refuses it.
+    """
+
+    feature = (NS_COMPRESS_FEATURE, 'compression')
+
+    def __init__(self, xs, required=False):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs, required)
+        self._deferred = None
+
+    def start(self):
+        methods = [str(method) for method in self.xmlstream.features[self.feature].elements()
+                   if method.name == 'method']
+
+        if 'zlib' not in methods:
+            return None
+
+        self._deferred = Deferred()
+        self.xmlstream.addOnetimeObserver('/compressed', self.onCompressed)
+        self.xmlstream.addOnetimeObserver('/failure', self.onFailure)
+
+        compress = Element((NS_COMPRESS_PROTOCOL, 'compress'))
+        compress.addElement('method', content='zlib')
+        self.xmlstream.send(compress)
+        return self._deferred
+
+    def onCompressed(self, element):
+        self.xmlstream.removeObserver('/failure', self.onFailure)
+        log.info("XMPPClient stream compression enabled")
+
+        # Everything after <compressed/> goes through zlib, starting with a new stream
+        self.xmlstream.reset()
+        CompressedTransport.wrap(self.xmlstream)
+        self.xmlstream.sendHeader()
+        self._deferred.callback(xmlstream.Reset)
+
+    def onFailure(self, element):
+        self.xmlstream.removeObserver('/compressed', self.onCompressed)
+        log.warn("XMPPClient stream compression refused by server")
+        self._deferred.callback(None)
+
+
+class CompressedTransport:
+    """
+    Transport proxy compressing written data with a shared zlib stream
+    (synced on each write so it's sent right away).
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._compressor = zlib.compressobj()
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+    def write(self, data):
+        self._transport.write(self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    @classmethod
+    def wrap(cls, xs):
+        """ Compress everything xs sends and decompress everything it receives """
+        decompressor = zlib.decompressobj()
+        data_received = xs.dataReceived
+
+        xs.transport = cls(xs.transport)
+        xs.dataReceived = lambda data: data_received(decompressor.decompress(data))
+        xs.compressed = True
+
+
+# Send a newline after this many idle seconds to avoid server disconnect
+KEEP_ALIVE = 60
+
+
+class SendQueue:
+    """
+    Outbound stanzas, written to the stream once per reactor iteration
+    with a single transport write.
+    Registered as the transport (streaming) producer, so it's paused while
+    the transport buffer is above its high-water mark and senders can
+    skip optional data (partial results) until it drains.
+    """
+
+    def __init__(self):
+        self.xs = None
+        self.paused = False
+        self.last_write = time()
+
+        self._chunks = []
+        self._flush_dc = None
+
+    def attach(self, xs):
+        self.xs = xs
+        self.paused = False
+        xs.transport.registerProducer(self, True)
+
+    def detach(self):
+        self.xs = None
+        if self._flush_dc:
+            self._flush_dc.cancel()
+            self._flush_dc = None
+
+        # Stream management keeps (and replays) unacked stanzas
+        self._chunks = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self._chunks.append(data)
+        if not self._flush_dc:
+            self._flush_dc = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self._flush_dc = None
+        data, self._chunks = ''.join(self._chunks), []
+
+        # Detached: dropped as on detach, stream management replays them
+        if data and self.xs:
+            self.xs.send(data)
+            self.last_write = time()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.paused = True
+
 
 # Add registerAccount to XMPPAuthenticator
-class FixedXMPPAuthenticator(client.XMPPAuthenticator):
+_XMPPAuthenticator = client.XMPPAuthenticator
+
+
+class FixedXMPPAuthenticator(_XMPPAuthenticator):
     AUTH_FAILED_EVENT = "//event/client/xmpp/authfailed"
 
+    # Negotiate stream compression when offered
+    compression = True
+
+    # sm.StreamManager: enable or resume stream management when offered
+    stream_manager = None
+
+    def associateWithStream(self, xs):
+        _XMPPAuthenticator.associateWithStream(self, xs)
+        xs.compressed = False
+
+        if self.compression:
+            # Compression goes after authentication (XEP-0138)
+            self._insert_initializer(xs, sasl.SASLInitiatingInitializer, CompressInitializer(xs))
+
+        if self.stream_manager:
+            # Resume replaces bind and session, enable goes after them (XEP-0198)
+            self._insert_initializer(xs, client.BindInitializer,
+                                     sm.ResumeInitializer(xs, self.stream_manager), before=True)
+            self._insert_initializer(xs, client.SessionInitializer,
+                                     sm.EnableInitializer(xs, self.stream_manager))
+
+    @staticmethod
+    def _insert_initializer(xs, initializer_class, initializer, before=False):
+        for index, current in enumerate(xs.initializers):
+            if isinstance(current, initializer_class):
+                xs.initializers.insert(index if before else index + 1, initializer)
+                return
+
     def registerAccount(self, username=None, password=None):
         if username:
             self.jid.user = username
@@ -59,7 +236,9 @@ client.XMPPAuthenticator = FixedXMPPAuthenticator
 
 class BasicClient:
     def __init__(self, user, password, host, observers,
-                 resource="XMPPBasicClient", max_delay=60):
+                 resource="XMPPBasicClient", max_delay=60, compression=True,
+                 stream_management=True, max_unacked_size=sm.DEFAULT_MAX_UNACKED_SIZE,
+                 relay_server=None, relay_secret=''):
         """
         Basic XMPP Client class.
 
@@ -68,6 +247,12 @@ class BasicClient:
         @param host: XMPP server address.
         @param observers: Dictionary of observers.
         @param resource: Resource to use when sending messages by default.
+        @param compression: Negotiate zlib stream compression if offered.
+        @param stream_management: Use stream management and resumption if offered.
+        @param max_unacked_size: Bytes of unacked stanzas kept for replay.
+        @param relay_server: "host[:port]" of a relay agent to connect to
+                             instead of the XMPP server.
+        @param relay_secret: Secret of this agent at the relay (relay.agent_secret).
         """
 
         #use_http = False
@@ -76,7 +261,11 @@ class BasicClient:
         #self._factory = HTTPBindingStreamFactory(auth)
 
         self._xs = None
-        self._keep_alive_lc = None
+        self._keep_alive_dc = None
+        self._queue = SendQueue()
+
+        # Stream compression is active on the current stream
+        self.compressed = False
 
         self._user = user
         self._password = password
@@ -84,9 +273,22 @@ class BasicClient:
         self._port = 5222
 
         self._observers = observers
-        myJid = jid.JID('/'.join((user, resource)))
+        self.jid = jid.JID('/'.join((user, resource)))
+
+        self._sm = sm.StreamManager(self._queue.write, max_unacked_size)
+        self._relay_server = relay_server
 
-        self._factory = client.XMPPClientFactory(myJid, password)
+        if relay_server:
+            # Relayed agent: the relay holds the XMPP session
+            self._host, self._port = relay.parse_address(relay_server)
+            self._factory = relay.link_factory(self.jid.full(), relay_secret)
+
+        else:
+            self._factory = client.XMPPClientFactory(self.jid, password)
+            self._factory.authenticator.compression = compression
+
+            if stream_management:
+                self._factory.authenticator.stream_manager = self._sm
 
         self._factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self._connected)
         self._factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self._authd)
@@ -94,6 +296,10 @@ class BasicClient:
         self._factory.addBootstrap(xmlstream.INIT_FAILED_EVENT, self._failed_auth)
         self._factory.maxDelay = max_delay
 
+        # Reconnections don't go through _connect: time every attempt
+        self._factory_started_connecting = self._factory.startedConnecting
+        self._factory.startedConnecting = self._started_connecting
+
         #        if(use_http):
         #            connector = HTTPBClientConnector(str(url))
         #            connector.connect(f)
@@ -101,14 +307,22 @@ class BasicClient:
         #            connector = XMPPClientConnector(reactor, host, self._factory)
         #            connector.connect()
 
-        # Give time to load commands
-        reactor.callLater(3, self._connect)
+        # Connect while commands are loaded, they are queued until then
+        reactor.callLater(0, self._connect)
 
     def _connect(self):
         reactor.connectTCP(self._host, self._port, self._factory)
 
+    def _started_connecting(self, connector):
+        startup.timer.begin('connect')
+        self._factory_started_connecting(connector)
+
     def _failed_auth(self, error):
         """ overwrite in derivated class """
+        if self._relay_server:
+            log.error("Relay %s refused this agent: %s" % (self._relay_server, error))
+            return
+
         log.info("Auth failed, trying to autoregister")
         self._factory.authenticator.registerAccount(self._user.split('@')[0], self._password)
 
@@ -118,10 +332,16 @@ class BasicClient:
     def _stream_end(self, error):
         """ overwrite in derivated class """
         log.info("XMPPClient stream end: %s" % error)
+        self._sm.disconnected()
+        self._queue.detach()
 
     def _connected(self, xml_stream):
         log.info("XMPPClient connected")
+        startup.timer.end('connect')
+        startup.timer.begin('auth')
         self._xs = xml_stream
+        self.compressed = False
+        self._sm.connected(xml_stream)
 
     def _authd(self, xml_stream):
         """
@@ -130,35 +350,75 @@ class BasicClient:
         This method gets called when login has been successful.
         """
         log.info("XMPPClient authenticated")
+        startup.timer.end('auth')
+        self.compressed = getattr(xml_stream, 'compressed', False)
+
+        self._queue.attach(xml_stream)
 
-        #Keepalive: Send a newline every 60 seconds
+        #Keepalive: Send a newline after 60 idle seconds
         #to avoid server disconnect
-        self._keep_alive_lc = LoopingCall(self._xs.send, '\n')
-        self._keep_alive_lc.start(60)
-        self._xs.addObserver(STREAM_END_EVENT,
-                             lambda _: self._keep_alive_lc.stop())
+        self._stop_keep_alive()
+        self._keep_alive()
+        self._xs.addObserver(STREAM_END_EVENT, self._stop_keep_alive)
 
         for message, callable in self._observers:
             self._xs.addObserver(message, callable)
 
-        presence = Element(('jabber:client', 'presence'))
-        self._xs.send(presence)
+        # A resumed stream keeps presence and sends unacked stanzas by itself
+        if not self._sm.resumed:
+            startup.timer.begin('presence')
+            self.send_presence()
+
+        self._sm.authenticated()
+
+    def _keep_alive(self):
+        """ Deadline timer: sends are not slowed down by rescheduling it """
+        remaining = self._queue.last_write + KEEP_ALIVE - time()
+
+        if remaining <= 0:
+            self._queue.write('\n')
+            remaining = KEEP_ALIVE
+
+        self._keep_alive_dc = reactor.callLater(remaining, self._keep_alive)
+
+    def _stop_keep_alive(self, _=None):
+        if self._keep_alive_dc and self._keep_alive_dc.active():
+            self._keep_alive_dc.cancel()
+        self._keep_alive_dc = None
+
+    def writable(self):
+        """ False while disconnected or the transport buffer is full: skip optional sends """
+        return self._queue.xs is not None and not self._queue.paused
+
+    def presence(self):
+        """ overwrite in derivated class to add presence data """
+        return Element(('jabber:client', 'presence'))
+
+    def send_presence(self):
+        if not self._queue.xs:
+            # Not connected yet, presence is sent once authenticated
+            return
+
+        self._sm.send(self.presence().toXml())
 
     def _newid(self):
         return str(int(random() * (10 ** 31)))
 
     def send(self, elem):
-        log.debug('BasicClient.send: %s' % elem.toXml())
-        if not elem.getAttribute('id'):
-            log.debug('No message ID in message, creating one')
-            elem['id'] = self._newid()
-        d = self._xs.send(elem.toXml())
-
-        #Reset keepalive looping call timer
-        if self._keep_alive_lc.running:
-            self._keep_alive_lc.stop()
-            self._keep_alive_lc.start(60)
-        return d
+        """
+        @param elem: Element to send, or an already serialized one (string).
+        """
+        if isinstance(elem, basestring):
+            data = elem
+
+        else:
+            if not elem.getAttribute('id'):
+                log.debug('No message ID in message, creating one')
+                elem['id'] = self._newid()
+            data = elem.toXml()
+
+        log.debug('BasicClient.send: %s' % data)
+        self._sm.send(data)
 
     def debug(self, elem):
         """
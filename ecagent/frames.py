@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+
+# Plugins write their results on this fd as "<length>\n<payload>" frames
+# (see ECMPlugin._write_result), stdout is left for progress output.
+RESULT_FD = 3
+RESULT_FD_ENV = 'ECM_RESULT_FD'
+
+# Extra fds can't be passed to child processes on windows
+FRAMES_AVAILABLE = not sys.platform.startswith("win32")
+
+_MAX_HEADER_LENGTH = 20
+
+
+def child_fds():
+    return {0: 'w', 1: 'r', 2: 'r', RESULT_FD: 'r'}
+
+
+def framed_env(env):
+    env = dict(env)
+    env[RESULT_FD_ENV] = str(RESULT_FD)
+    return env
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for length prefixed frames.
+    Every received byte is looked at once: the header is searched for its
+    newline and the payload is only collected until it has the announced
+    length.
+    """
+
+    def __init__(self):
+        self._header = ''
+        self._length = None
+        self._chunks = []
+        self._size = 0
+
+    def feed(self, data):
+        """ Returns the list of frames completed by data """
+        frames = []
+
+        while data:
+            if self._length is None:
+                index = data.find('\n')
+                if index < 0:
+                    self._header += data
+                    if len(self._header) > _MAX_HEADER_LENGTH:
+                        raise FrameError("Invalid frame header")
+                    break
+
+                try:
+                    self._length = int(self._header + data[:index])
+
+                except ValueError:
+                    raise FrameError("Invalid frame header")
+
+                if self._length < 0:
+                    raise FrameError("Invalid frame length")
+
+                self._header = ''
+                data = data[index + 1:]
+
+            needed = self._length - self._size
+            if needed:
+                chunk = data[:needed]
+                data = data[needed:]
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+
+            if self._size == self._length:
+                frames.append(''.join(self._chunks))
+                self._length = None
+                self._chunks = []
+                self._size = 0
+
+        return frames
+
+
+class FrameError(Exception):
+    pass
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import sys
+import imp
+import inspect
+
+# Twisted imports
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+
+# Local
+import ecagent.twlogging as log
+
+_E_RUNNING_COMMAND = 253
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_THREADS = 4
+
+
+class InlineRunner:
+    """
+    Runs whitelisted read-only plugin commands inside the agent process.
+    The plugin class is imported once and its commands are called on a
+    bounded thread pool of their own, anything else keeps using a plugin
+    process.
+    A thread can't be interrupted: after a timeout its plugin gets no more
+    inline commands (they run in a process) until its late calls return.
+    """
+
+    def __init__(self, commands, timeout=DEFAULT_TIMEOUT, threads=DEFAULT_THREADS):
+        self.commands = set(commands)
+        self.timeout = timeout
+        self._plugins = {}
+
+        # Plugin filename: calls still running after their timeout
+        self._late = {}
+
+        self._pool = ThreadPool(0, max(threads, 1), 'ecagent-inline')
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def can_run(self, command, filename):
+        if command not in self.commands:
+            return False
+
+        if filename in self._late or sum(self._late.values()) >= self._pool.max:
+            return False
+
+        return self._get_plugin(filename) is not None
+
+    def run(self, command, command_args, filename, timeout=None):
+        plugin = self._get_plugin(filename)
+        timeout = min(timeout or self.timeout, self.timeout)
+
+        log.info("Running %s inline from %s (timeout: %i)" % (command, filename, timeout))
+        d = Deferred()
+        timeout_dc = reactor.callLater(timeout, self._timeout, d, command, filename)
+
+        td = deferToThreadPool(reactor, self._pool, plugin._call_command, command, command_args)
+        td.addCallbacks(self._finished, self._failed,
+                        callbackArgs=(d, timeout_dc, filename), errbackArgs=(d, timeout_dc, filename))
+        return d
+
+    def _finished(self, result, d, timeout_dc, filename):
+        if d.called:
+            # Already answered as timed out
+            self._returned(filename)
+            return
+
+        timeout_dc.cancel()
+        (exit_code, stdout) = result
+        d.callback((exit_code, stdout, '', 0))
+
+    def _failed(self, failure, d, timeout_dc, filename):
+        if d.called:
+            self._returned(filename)
+            return
+
+        timeout_dc.cancel()
+        d.callback((_E_RUNNING_COMMAND, '', "ERROR: %s" % failure.getErrorMessage(), 0))
+
+    def _timeout(self, d, command, filename):
+        log.warn("Inline command %s timed out, %s commands run in a process until it returns"
+                 % (command, filename))
+        self._late[filename] = self._late.get(filename, 0) + 1
+        d.callback((None, '', '', 1))
+
+    def _returned(self, filename):
+        """ A call answered as timed out has returned """
+        self._late[filename] -= 1
+        if not self._late[filename]:
+            del self._late[filename]
+            log.info("Running %s commands inline again" % filename)
+
+    def _get_plugin(self, filename):
+        try:
+            mtime = os.path.getmtime(filename)
+
+        except OSError:
+            return None
+
+        # Reload plugin when its file has been updated
+        if filename not in self._plugins or self._plugins[filename][0] != mtime:
+            self._plugins[filename] = (mtime, self._load_plugin(filename))
+
+        return self._plugins[filename][1]
+
+    @staticmethod
+    def _load_plugin(filename):
+        path = os.path.dirname(filename)
+        if path not in sys.path:
+            sys.path.append(path)
+
+        module_name = 'ecagent_inline_' + os.path.splitext(os.path.basename(filename))[0]
+
+        # Bytecode written next to the plugin would be found as another plugin
+        dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, True
+
+        try:
+            module = imp.load_source(module_name, filename)
+            classes = [obj for obj in vars(module).values()
+                       if inspect.isclass(obj) and obj.__module__ == module_name
+                       and issubclass(obj, module.ECMPlugin)]
+
+            # Platform dependant plugins define more than one class
+            if len(classes) != 1:
+                log.warn("Unable to load %s inline: %i plugin classes found" % (filename, len(classes)))
+                return None
+
+            log.info("[INIT] Loaded %s inline" % filename)
+            return classes[0]()
+
+        except Exception as e:
+            log.warn("Unable to load %s inline: %s" % (filename, e))
+            return None
+
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+
+# Twisted imports
+from twisted.internet.task import LoopingCall
+
+# Local
+import ecagent.twlogging as log
+
+NS_LOAD = 'http://ecmanaged.net/protocol/load'
+
+DEFAULT_INTERVAL = 30
+
+# Change since the published load needed to publish it again
+DEFAULT_COMMANDS_DELTA = 2
+DEFAULT_LOADAVG_DELTA = 0.5
+
+
+def loadavg():
+    """ 1 minute load average, None where it's not available """
+    try:
+        return os.getloadavg()[0]
+
+    except (AttributeError, OSError):
+        return None
+
+
+class LoadPublisher:
+    """
+    Publishes the agent load in its presence so dispatchers can route or
+    delay work:
+        <load xmlns="http://ecmanaged.net/protocol/load"
+              queued="0" running="2" free="8" loadavg="0.42" />
+    The load is sampled every interval seconds and published only when it
+    moved past the thresholds from the last published one (hysteresis):
+    commands_delta queued or running commands, loadavg_delta load average,
+    or the agent got saturated (no free slots) or got free slots again.
+
+    stats() returns the scheduler stats (queued, running, free),
+    publish() sends a presence, which gets the load from decorate().
+    """
+
+    def __init__(self, stats, publish, interval=DEFAULT_INTERVAL,
+                 commands_delta=DEFAULT_COMMANDS_DELTA, loadavg_delta=DEFAULT_LOADAVG_DELTA):
+        self.stats = stats
+        self.publish = publish
+        self.interval = interval
+        self.commands_delta = commands_delta
+        self.loadavg_delta = loadavg_delta
+
+        self.published = None
+        self._loop = LoopingCall(self._check)
+
+    def start(self):
+        if self.interval > 0 and not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def current(self):
+        stats = self.stats()
+        return {
+            'queued': stats['queued'],
+            'running': stats['running'],
+            'free': stats['free'],
+            'loadavg': loadavg(),
+        }
+
+    def decorate(self, presence):
+        """ Adds the current load to a presence """
+        self.published = load = self.current()
+
+        el_load = presence.addElement((NS_LOAD, 'load'))
+        for name in ('queued', 'running', 'free'):
+            el_load[name] = str(load[name])
+
+        if load['loadavg'] is not None:
+            el_load['loadavg'] = '%.2f' % load['loadavg']
+
+        return presence
+
+    def changed(self, load):
+        published = self.published
+        if published is None:
+            return True
+
+        if bool(load['free']) != bool(published['free']):
+            return True
+
+        for name in ('queued', 'running'):
+            if abs(load[name] - published[name]) >= self.commands_delta:
+                return True
+
+        if load['loadavg'] is not None and published['loadavg'] is not None:
+            return abs(load['loadavg'] - published['loadavg']) >= self.loadavg_delta
+
+        return False
+
+    def _check(self):
+        load = self.current()
+        if self.changed(load):
+            log.debug("Publishing load: %s" % load)
+            self.publish()
@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import sys
+import simplejson as json
+from base64 import b64encode
+from fnmatch import fnmatch
+
+# Twisted imports
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet.defer import maybeDeferred
+
+# Local
+import ecagent.twlogging as log
+
+_E_RUNNING_COMMAND = 253
+_E_COMMAND_NOT_DEFINED = 252
+
+DEFAULT_MODE = '0600'
+
+# Unix sockets are not available on windows
+LOCAL_API_AVAILABLE = not sys.platform.startswith("win32")
+
+
+class LocalRequest:
+    """ A command received on the local socket, passed as the message """
+
+    def __init__(self, request):
+        self.id = str(request.get('id', ''))
+        self.command = str(request['command'])
+        self.command_args = dict((str(key), value) for key, value in request.get('args', {}).items())
+        self.stream_mode = request.get('stream')
+        self.deadline = float(request['deadline']) if request.get('deadline') else None
+
+
+class LocalProtocol(LineOnlyReceiver):
+    """
+    One JSON request per line:
+        {"id": "1", "command": "system.info", "args": {}, "stream": "delta", "deadline": 1700000000}
+    answered with JSON lines carrying the same id: partial results while
+    the command runs ("partial" is the output length so far) and a final
+    one with "partial": 0. Output that isn't UTF-8 is base64 encoded and
+    flagged with "encoding": "base64".
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 16 * 1024 ** 2
+
+    def connectionMade(self):
+        self.paused = False
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self.paused = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.paused = True
+
+    def lineReceived(self, line):
+        try:
+            request = LocalRequest(json.loads(line))
+
+        except Exception as e:
+            log.warn("Invalid local request: %s" % e)
+            self._send_result(None, (_E_RUNNING_COMMAND, '', "ERROR: Invalid request: %s" % e, 0))
+            return
+
+        self.factory.run(request, self)
+
+    def flush(self, result, request):
+        """ Partial results are skipped while the client isn't reading """
+        if self.paused:
+            return False
+
+        self._send_result(request, result)
+
+    def finished(self, result, request):
+        self._send_result(request, result)
+
+    def failed(self, failure, request):
+        log.error("Local command %s failed: %s" % (request.command, failure.getErrorMessage()))
+        self._send_result(request, (_E_RUNNING_COMMAND, '', "ERROR: %s" % failure.getErrorMessage(), 0))
+
+    def _send_result(self, request, result):
+        if not self.transport.connected:
+            return
+
+        retvalue, stdout, stderr, timed_out = result[:4]
+        response = {
+            'id': request.id if request else None,
+            'retvalue': retvalue,
+            'timed_out': bool(timed_out),
+            'partial': result[4] if len(result) > 4 else 0,
+        }
+
+        if len(result) > 5 and result[5]:
+            response.update(result[5])
+
+        response.update(self._output('stdout', stdout))
+        response.update(self._output('stderr', stderr))
+        self.sendLine(json.dumps(response))
+
+    @staticmethod
+    def _output(name, output):
+        output = str(output)
+        try:
+            return {name: output.decode('utf-8')}
+
+        except UnicodeDecodeError:
+            return {name: b64encode(output), name + '_encoding': 'base64'}
+
+
+class LocalAPI(Factory):
+    """
+    Local command API on a unix socket: commands go through the same
+    CommandRunner as XMPP ones (scheduler, worker pools, caches and
+    store), without signatures. Access is controlled by the socket file
+    permissions (mode and group), commands can be limited to the
+    commands patterns.
+    """
+
+    protocol = LocalProtocol
+
+    def __init__(self, command_runner, path, mode=DEFAULT_MODE, group=None, commands=None):
+        self.command_runner = command_runner
+        self.path = path
+        self.mode = int(mode, 8)
+        self.group = group
+        self.commands = commands or []
+
+    def listen(self):
+        if not LOCAL_API_AVAILABLE:
+            log.warn("Local API is not available on this platform")
+            return None
+
+        log.info("Local API listening on %s" % self.path)
+        port = reactor.listenUNIX(self.path, self, mode=self.mode, wantPID=True)
+
+        if self.group:
+            import grp
+            os.chown(self.path, -1, grp.getgrnam(self.group).gr_gid)
+
+        return port
+
+    def allowed(self, command):
+        if not self.commands:
+            return True
+
+        for pattern in self.commands:
+            if fnmatch(command, pattern):
+                return True
+
+        return False
+
+    def run(self, request, protocol):
+        if not self.command_runner.loaded:
+            # Plugin discovery is still running
+            self.command_runner.when_ready().addCallback(lambda _: self.run(request, protocol))
+            return
+
+        command = request.command.replace('.', '_')
+        log.debug("Local command %s" % command)
+
+        if not self.allowed(command):
+            log.warn("Local command %s not allowed" % command)
+            protocol.finished((_E_COMMAND_NOT_DEFINED, '', "Command not allowed (%s)" % request.command, 0),
+                              request)
+            return
+
+        d = maybeDeferred(self.command_runner.run_command, command, request.command_args,
+                          protocol.flush, request, request.deadline)
+        d.addCallback(self._check_defined, request)
+        d.addCallbacks(protocol.finished, protocol.failed,
+                       callbackArgs=(request,), errbackArgs=(request,))
+
+    @staticmethod
+    def _check_defined(result, request):
+        if result is None:
+            return (_E_COMMAND_NOT_DEFINED, '', "Command not defined (%s)" % request.command, 0)
+
+        return result
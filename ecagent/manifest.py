@@ -0,0 +1,256 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import ast
+import hashlib
+import simplejson as json
+
+# Local
+import ecagent.twlogging as log
+
+_MANIFEST_VERSION = 2
+_BASE_PLUGIN = '__plugin.py'
+_BASE_CLASS = 'ECMPlugin'
+
+
+class PluginManifest:
+    """
+    Persisted map of plugin file -> commands (with argument names) and
+    their declared cache TTLs.
+    An entry is reused while the plugin file and the ECMPlugin base file
+    keep the same size/mtime or, if those changed, the same hash.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._dirty = False
+        self._entries = {}
+        self._base = {}
+
+        try:
+            if os.path.isfile(filename):
+                f = open(filename, 'r')
+                data = json.load(f)
+                f.close()
+
+                if data.get('version') == _MANIFEST_VERSION:
+                    self._entries = data.get('plugins', {})
+                    self._base = data.get('base', {})
+
+        except Exception as e:
+            log.warn("Unable to read plugin manifest %s: %s" % (filename, e))
+
+    def check_base(self, path):
+        """ Drop every entry if the ECMPlugin base file has changed """
+        base_file = os.path.join(path, _BASE_PLUGIN)
+        cached = self._base.get(base_file)
+        signature = self._signature(base_file, cached)
+
+        if not self._same(signature, cached):
+            if cached:
+                log.info("[INIT] %s has changed, rebuilding plugin manifest" % base_file)
+                self._entries = {}
+
+        if signature != cached:
+            self._base[base_file] = signature
+            self._dirty = True
+
+    def get(self, filename):
+        """ Returns cached plugin info for filename, or None if missing or stale """
+        entry = self._entries.get(filename)
+        if not entry:
+            return None
+
+        signature = self._signature(filename, entry['signature'])
+        if not self._same(signature, entry['signature']):
+            return None
+
+        if signature != entry['signature']:
+            # Touched but not modified
+            entry['signature'] = signature
+            self._dirty = True
+
+        return entry['info']
+
+    def set(self, filename, info):
+        self._entries[filename] = {
+            'signature': self._signature(filename),
+            'info': info,
+        }
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        try:
+            data = {
+                'version': _MANIFEST_VERSION,
+                'base': self._base,
+                'plugins': self._entries,
+            }
+            tmp_filename = self.filename + '.tmp'
+            f = open(tmp_filename, 'w')
+            json.dump(data, f)
+            f.close()
+
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+            self._dirty = False
+
+        except Exception as e:
+            log.warn("Unable to write plugin manifest %s: %s" % (self.filename, e))
+
+    @staticmethod
+    def _same(signature, cached):
+        return bool(signature and cached and signature[2] == cached[2])
+
+    @staticmethod
+    def _signature(filename, cached=None):
+        """
+        Returns [size, mtime, sha1] for filename. The hash is only computed
+        when size or mtime don't match the cached signature.
+        """
+        try:
+            st = os.stat(filename)
+
+        except OSError:
+            return None
+
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached
+
+        f = open(filename, 'rb')
+        digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+
+        return [st.st_size, st.st_mtime, digest]
+
+
+def inspect_plugin(filename):
+    """
+    Reads plugin commands without running the plugin.
+    Returns {'commands': {command: [args]}, 'cache_ttl': {command: ttl}}
+    or None when the plugin can't be inspected statically (not python,
+    platform dependant class, unknown base class...)
+    """
+    if os.path.splitext(filename)[1] not in ('.py', '.pyw'):
+        return None
+
+    try:
+        tree = _parse(filename)
+        run_classes = _get_run_classes(tree)
+
+        if not run_classes:
+            # Plugin is disabled, it lists no commands
+            return plugin_info({})
+
+        if len(run_classes) > 1:
+            return None
+
+        base_tree = _parse(os.path.join(os.path.dirname(filename), _BASE_PLUGIN))
+        base_class = _get_class(base_tree, _BASE_CLASS)
+        plugin_class = _get_class(tree, run_classes.pop())
+
+        if not base_class or not plugin_class:
+            return None
+
+        for base in plugin_class.bases:
+            if not isinstance(base, ast.Name) or base.id != _BASE_CLASS:
+                return None
+
+        commands = _get_commands(base_class)
+        commands.update(_get_commands(plugin_class))
+
+        cache_ttl = _get_attribute(base_class, 'cache_ttl', {})
+        cache_ttl.update(_get_attribute(plugin_class, 'cache_ttl', {}))
+
+        return plugin_info(commands, cache_ttl)
+
+    except Exception as e:
+        log.debug("Unable to inspect %s: %s" % (filename, e))
+        return None
+
+
+def plugin_info(commands, cache_ttl=None):
+    return {
+        'commands': commands,
+        'cache_ttl': cache_ttl or {},
+    }
+
+
+def _parse(filename):
+    f = open(filename, 'r')
+    source = f.read()
+    f.close()
+    return ast.parse(source, filename)
+
+
+def _get_run_classes(tree):
+    """ Class names of module level ClassName().run() calls """
+    classes = set()
+    nodes = list(tree.body)
+
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            continue
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr == 'run' and isinstance(node.func.value, ast.Call) \
+                and isinstance(node.func.value.func, ast.Name):
+            classes.add(node.func.value.func.id)
+
+        nodes.extend(ast.iter_child_nodes(node))
+
+    return classes
+
+
+def _get_class(tree, name):
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == name:
+            return node
+
+    return None
+
+
+def _get_commands(class_node):
+    commands = {}
+    for node in class_node.body:
+        if not isinstance(node, ast.FunctionDef) or not node.name.startswith('cmd_'):
+            continue
+
+        # Static methods are not listed by ECMPlugin._list_commands
+        decorators = [getattr(d, 'id', None) for d in node.decorator_list]
+        if 'staticmethod' in decorators:
+            continue
+
+        args = [getattr(arg, 'id', getattr(arg, 'arg', None)) for arg in node.args.args]
+        commands[node.name[4:]] = args[1:]
+
+    return commands
+
+
+def _get_attribute(class_node, name, default=None):
+    """ Value of a literal class attribute """
+    for node in class_node.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                and isinstance(node.targets[0], ast.Name) and node.targets[0].id == name:
+            return ast.literal_eval(node.value)
+
+    return default
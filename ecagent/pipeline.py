@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Twisted imports
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+# Local
+import ecagent.twlogging as log
+
+_E_RUNNING_COMMAND = 253
+
+# Failure policies
+STOP = 'stop'
+CONTINUE = 'continue'
+ROLLBACK = 'rollback'
+POLICIES = (STOP, CONTINUE, ROLLBACK)
+
+# Step states
+PENDING = 'pending'
+RUNNING = 'running'
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Pipeline:
+    """
+    Runs a DAG of steps: a step starts once every step it depends on has
+    finished successfully (exit code 0, not timed out), so independent
+    branches run in parallel.
+    A failed step applies its on_failure policy (or the pipeline one):
+        stop: no more steps are started
+        continue: only the steps depending on it are skipped
+        rollback: like stop, then the rollback steps run one after another
+    Steps have id, depends (list of ids), on_failure, state and result.
+    run_step(step) returns the step result (or a Deferred), progress(step)
+    is called on every state change.
+    """
+
+    def __init__(self, steps, run_step, on_failure=STOP, rollback=(), progress=None):
+        self.steps = list(steps)
+        self.rollback = list(rollback)
+        self.run_step = run_step
+        self.on_failure = on_failure
+        self.progress = progress
+
+        self._by_id = dict([(step.id, step) for step in self.steps])
+        self._stopped = False
+        self._rollback_needed = False
+        self._deferred = None
+
+        self._validate()
+
+    def run(self):
+        """ Returns a Deferred fired with True if every step succeeded """
+        self._deferred = Deferred()
+
+        for step in self.steps + self.rollback:
+            step.state = PENDING
+
+        self._start_ready()
+        self._check_done()
+        return self._deferred
+
+    def _validate(self):
+        if len(self._by_id) != len(self.steps):
+            raise PipelineError("Duplicated step id")
+
+        for step in self.steps:
+            for policy in (step.on_failure, self.on_failure):
+                if policy and policy not in POLICIES:
+                    raise PipelineError("Unknown failure policy: %s" % policy)
+
+            for depend in step.depends:
+                if depend not in self._by_id:
+                    raise PipelineError("Step %s depends on unknown step %s" % (step.id, depend))
+
+        # Remove steps without pending dependencies until none is left
+        pending = dict([(step.id, set(step.depends)) for step in self.steps])
+        while pending:
+            ready = [step_id for step_id, depends in pending.items() if not depends]
+            if not ready:
+                raise PipelineError("Dependency cycle between steps: %s" % ', '.join(sorted(pending)))
+
+            for step_id in ready:
+                del pending[step_id]
+
+            for depends in pending.values():
+                depends.difference_update(ready)
+
+    def _start_ready(self):
+        changed = True
+        while changed and not self._stopped:
+            changed = False
+
+            for step in self.steps:
+                if step.state != PENDING:
+                    continue
+
+                states = [self._by_id[depend].state for depend in step.depends]
+                if FAILED in states or SKIPPED in states:
+                    self._set_state(step, SKIPPED)
+                    changed = True
+
+                elif states.count(OK) == len(states):
+                    self._start(step)
+                    changed = True
+
+    def _start(self, step):
+        log.info("Pipeline step %s: running %s" % (step.id, step.command))
+        self._set_state(step, RUNNING)
+
+        d = maybeDeferred(self.run_step, step)
+        d.addBoth(self._finished, step)
+
+    def _finished(self, result, step):
+        self._set_result(step, result)
+
+        if step.state == FAILED:
+            policy = step.on_failure or self.on_failure
+            log.warn("Pipeline step %s failed (%s)" % (step.id, policy))
+
+            if policy != CONTINUE:
+                self._stopped = True
+                self._rollback_needed = self._rollback_needed or policy == ROLLBACK
+
+        self._start_ready()
+        self._check_done()
+
+    def _check_done(self):
+        if self._deferred.called or RUNNING in [step.state for step in self.steps]:
+            return
+
+        for step in self.steps:
+            if step.state == PENDING:
+                self._set_state(step, SKIPPED)
+
+        if self._rollback_needed:
+            self._rollback_needed = False
+            self._run_rollback(0)
+            return
+
+        self._deferred.callback([step.state for step in self.steps].count(OK) == len(self.steps))
+
+    def _run_rollback(self, index):
+        if index >= len(self.rollback):
+            self._deferred.callback(False)
+            return
+
+        step = self.rollback[index]
+        log.info("Pipeline rollback step %s: running %s" % (step.id, step.command))
+        self._set_state(step, RUNNING)
+
+        d = maybeDeferred(self.run_step, step)
+        d.addBoth(self._rolled_back, step, index)
+
+    def _rolled_back(self, result, step, index):
+        self._set_result(step, result)
+        self._run_rollback(index + 1)
+
+    def _set_result(self, step, result):
+        if isinstance(result, Failure):
+            result = (_E_RUNNING_COMMAND, '', "ERROR: %s" % result.getErrorMessage(), 0)
+
+        step.result = result
+        if result[0] == 0 and not result[3]:
+            self._set_state(step, OK)
+
+        else:
+            self._set_state(step, FAILED)
+
+    def _set_state(self, step, state):
+        step.state = state
+        if self.progress:
+            self.progress(step)
+
+
+class PipelineError(Exception):
+    pass
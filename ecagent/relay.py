@@ -0,0 +1,278 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import hmac
+import hashlib
+from collections import deque
+
+# Twisted imports
+from twisted.words.protocols.jabber import component, error, xmlstream
+from twisted.words.xish.domish import Element
+from twisted.internet import reactor
+
+# Local
+import ecagent.twlogging as log
+
+NS_RELAY = 'http://ecmanaged.net/protocol/relay'
+
+DEFAULT_PORT = 5270
+
+# Bytes queued for upstream per agent before reading from it is paused
+MAX_QUEUED_SIZE = 1024 ** 2
+
+# Stanzas sent upstream per reactor iteration, all agents together
+MAX_DRAIN_STANZAS = 100
+
+# Seconds to wait when the upstream connection can't take more data
+DRAIN_DELAY = 0.5
+
+# Presence updates for agents (dis)connecting are sent at most this often
+PRESENCE_DELAY = 1
+
+
+def parse_address(address, default_port=DEFAULT_PORT):
+    """ "host[:port]" to (host, port) """
+    host, _, port = address.strip().partition(':')
+    return host or '0.0.0.0', int(port or default_port)
+
+
+def agent_secret(secret, agent):
+    """
+    Link secret of a relayed agent: hex HMAC-SHA256 of its bare JID with
+    the relay secret, so each agent only knows its own
+    """
+    return hmac.new(secret, agent.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def link_factory(agent_jid, secret):
+    """ XML stream factory for an agent connecting to a relay """
+    return component.componentFactory(agent_jid, secret)
+
+
+class LinkAuthenticator(component.ListenComponentAuthenticator):
+    """ Checks the handshake with the secret of the agent the link claims to be """
+
+    def __init__(self, relay_secret):
+        component.ListenComponentAuthenticator.__init__(self, None)
+        self.relay_secret = relay_secret
+
+    def onHandshake(self, handshake):
+        self.secret = agent_secret(self.relay_secret, self.xmlstream.thisEntity.userhost())
+        component.ListenComponentAuthenticator.onHandshake(self, handshake)
+
+
+class RelayServer:
+    """
+    Relay (concentrator) mode: local agents connect to this agent with the
+    component protocol (XEP-0114 handshake with their agent_secret)
+    instead of keeping their own XMPP session, and their stanzas go through
+    the upstream session of client. An agent can't open a link for another
+    one without its secret.
+
+    IQs for a relayed agent are sent to this agent with the target bare JID
+    as the relay attribute of ecm_message; results from relayed agents are
+    sent upstream with the agent bare JID in that same attribute.
+    Upstream stanzas are queued per agent and sent round robin while the
+    upstream connection is writable, so a busy agent can't starve the
+    others; reading from an agent is paused while its queue is full.
+    Relayed agents are advertised in the presence of this agent.
+    """
+
+    def __init__(self, client, secret, max_queued_size=MAX_QUEUED_SIZE):
+        self.client = client
+        self.secret = secret
+        self.max_queued_size = max_queued_size
+
+        # Agent bare JID: link stream
+        self._links = {}
+        self._queues = {}
+        self._queued_size = {}
+
+        # Agent bare JID: link stream paused
+        self._paused = {}
+
+        # Agents with stanzas queued for upstream, in sending order
+        self._ready = deque()
+        self._drain_dc = None
+        self._presence_dc = None
+
+        self._factory = xmlstream.XmlStreamServerFactory(
+            lambda: LinkAuthenticator(self.secret))
+        self._factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self._onLinkAuthd)
+
+    def listen(self, address):
+        host, port = parse_address(address)
+        log.info("Relay listening on %s:%i" % (host, port))
+        return reactor.listenTCP(port, self._factory, interface=host)
+
+    def agents(self):
+        return sorted(self._links)
+
+    def route(self, elem):
+        """
+        Sends a relayed IQ to its agent.
+        Returns False if elem isn't for a relayed agent.
+        """
+        el_ecm_message = elem.firstChildElement()
+        if el_ecm_message is None or not el_ecm_message.hasAttribute('relay'):
+            return False
+
+        target = el_ecm_message['relay']
+        if not self.client.isOnline(elem.getAttribute('from')):
+            log.warn('Relayed IQ sender not in roster (%s), dropping message'
+                     % elem.getAttribute('from'))
+            return True
+
+        xs = self._links.get(target)
+
+        if xs is None:
+            log.warn("Relayed agent %s is not connected" % target)
+            if elem.getAttribute('type') in ('get', 'set'):
+                self.client.send(error.StanzaError('service-unavailable').toResponse(elem))
+            return True
+
+        elem['to'] = xs.thisEntity.full()
+        xs.send(elem)
+        return True
+
+    def decorate(self, presence):
+        """ Adds the relayed agents to a presence """
+        el_relay = presence.addElement((NS_RELAY, 'relay'))
+        for agent in self.agents():
+            el_relay.addElement('agent')['jid'] = agent
+
+        return presence
+
+    def onPresence(self, elem):
+        """ Upstream presence: relayed agents keep the same roster view """
+        for xs in self._links.values():
+            xs.send(elem)
+
+    def _onLinkAuthd(self, xs):
+        agent = xs.thisEntity.userhost()
+
+        previous = self._links.get(agent)
+        if previous is not None:
+            log.warn("Relayed agent %s connected again, closing previous link" % agent)
+            self._paused.pop(agent, None)
+            previous.transport.loseConnection()
+
+        log.info("Relayed agent %s connected" % agent)
+        self._links[agent] = xs
+
+        # Stanzas queued from a previous link are still sent
+        self._queues.setdefault(agent, deque())
+        self._queued_size.setdefault(agent, 0)
+
+        xs.addObserver('/iq', self._onAgentIq, xs=xs)
+        xs.addObserver(xmlstream.STREAM_END_EVENT, self._onLinkEnd, xs=xs)
+
+        for contact in self.client.online_contacts():
+            presence = Element(('jabber:client', 'presence'))
+            presence['from'] = contact
+            presence['to'] = xs.thisEntity.full()
+            xs.send(presence)
+
+        self._presence_changed()
+
+    def _onLinkEnd(self, reason, xs):
+        agent = xs.thisEntity.userhost()
+        if self._links.get(agent) is not xs:
+            return
+
+        log.info("Relayed agent %s disconnected" % agent)
+        del self._links[agent]
+        self._paused.pop(agent, None)
+
+        # Results already queued are sent, then _drain drops the queue
+        if not self._queues[agent]:
+            self._remove_queue(agent)
+
+        self._presence_changed()
+
+    def _onAgentIq(self, elem, xs):
+        agent = xs.thisEntity.userhost()
+
+        el_ecm_message = elem.firstChildElement()
+        if el_ecm_message is None or el_ecm_message.name != 'ecm_message':
+            log.warn("Dropping non agent IQ from relayed agent %s" % agent)
+            return
+
+        # The agent is known by its link, not by what it claims
+        elem['from'] = self.client.jid.full()
+        el_ecm_message['relay'] = agent
+
+        # Serialize as a stanza of the upstream stream
+        data = elem.toXml(defaultUri=elem.defaultUri)
+
+        self._queues[agent].append(data)
+        self._queued_size[agent] += len(data)
+
+        if self._queued_size[agent] > self.max_queued_size and agent not in self._paused \
+                and self._links.get(agent) is xs:
+            log.debug("Relayed agent %s queue is full, pausing" % agent)
+            self._paused[agent] = xs
+            xs.transport.pauseProducing()
+
+        if agent not in self._ready:
+            self._ready.append(agent)
+
+        self._schedule_drain(0)
+
+    def _schedule_drain(self, delay):
+        if not self._drain_dc:
+            self._drain_dc = reactor.callLater(delay, self._drain)
+
+    def _drain(self):
+        """ Sends queued stanzas upstream, one per agent per turn """
+        self._drain_dc = None
+
+        sent = 0
+        while self._ready and sent < MAX_DRAIN_STANZAS:
+            if not self.client.writable():
+                self._schedule_drain(DRAIN_DELAY)
+                return
+
+            agent = self._ready.popleft()
+            data = self._queues[agent].popleft()
+            self._queued_size[agent] -= len(data)
+            self.client.send(data)
+            sent += 1
+
+            if agent in self._paused and self._queued_size[agent] <= self.max_queued_size / 2:
+                self._paused.pop(agent).transport.resumeProducing()
+
+            if self._queues[agent]:
+                self._ready.append(agent)
+
+            elif agent not in self._links:
+                self._remove_queue(agent)
+
+        if self._ready:
+            self._schedule_drain(0)
+
+    def _remove_queue(self, agent):
+        del self._queues[agent]
+        del self._queued_size[agent]
+
+    def _presence_changed(self):
+        if not self._presence_dc:
+            self._presence_dc = reactor.callLater(PRESENCE_DELAY, self._send_presence)
+
+    def _send_presence(self):
+        self._presence_dc = None
+        self.client.send_presence()
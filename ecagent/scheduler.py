@@ -0,0 +1,166 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from time import time
+from fnmatch import fnmatch
+from collections import deque
+
+# Twisted imports
+from twisted.internet.defer import Deferred, maybeDeferred
+
+# Local
+import ecagent.twlogging as log
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITY_NAMES = ('high', 'normal', 'low')
+
+DEFAULT_MAX_CONCURRENT = 10
+DEFAULT_MAX_PER_PLUGIN = 4
+
+
+class CommandScheduler:
+    """
+    Runs commands in priority order (high, normal, low) and FIFO within a
+    priority class, limiting the total number of running commands, the
+    running commands per plugin and the slots low priority commands can use,
+    so monitoring commands are not starved by long deploys.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, max_per_plugin=DEFAULT_MAX_PER_PLUGIN,
+                 max_low=None, high_commands=(), low_commands=()):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_per_plugin = max(max_per_plugin, 1)
+
+        if max_low is None:
+            max_low = self.max_concurrent / 2
+        self.max_low = max(max_low, 1)
+
+        self.high_commands = list(high_commands)
+        self.low_commands = list(low_commands)
+
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._running = 0
+        self._running_low = 0
+        self._running_plugin = {}
+
+        self._wait_count = [0 for _ in PRIORITY_NAMES]
+        self._wait_total = [0.0 for _ in PRIORITY_NAMES]
+        self._wait_max = [0.0 for _ in PRIORITY_NAMES]
+
+    def priority(self, command):
+        for pattern in self.high_commands:
+            if fnmatch(command, pattern):
+                return PRIORITY_HIGH
+
+        for pattern in self.low_commands:
+            if fnmatch(command, pattern):
+                return PRIORITY_LOW
+
+        return PRIORITY_NORMAL
+
+    def submit(self, command, plugin, f, *args, **kwargs):
+        """
+        Queues f(*args, **kwargs) and returns a Deferred fired with its
+        result once it has been run.
+        """
+        job = _Job(command, plugin, self.priority(command), f, args, kwargs)
+        self._queues[job.priority].append(job)
+
+        self._dispatch()
+        return job.deferred
+
+    def stats(self):
+        retval = {
+            'running': self._running,
+            'queued': sum([len(queue) for queue in self._queues]),
+            'free': max(self.max_concurrent - self._running, 0),
+        }
+
+        for priority, name in enumerate(PRIORITY_NAMES):
+            count = self._wait_count[priority]
+            retval[name] = {
+                'queued': len(self._queues[priority]),
+                'wait_avg': count and self._wait_total[priority] / count,
+                'wait_max': self._wait_max[priority],
+            }
+
+        return retval
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent:
+            job = self._next_job()
+            if not job:
+                return
+
+            self._start(job)
+
+    def _next_job(self):
+        for priority, queue in enumerate(self._queues):
+            if priority == PRIORITY_LOW and self._running_low >= self.max_low:
+                continue
+
+            # First job in the class that doesn't exceed its plugin limit
+            for job in queue:
+                if self._running_plugin.get(job.plugin, 0) < self.max_per_plugin:
+                    queue.remove(job)
+                    return job
+
+        return None
+
+    def _start(self, job):
+        wait = time() - job.queued_at
+        self._wait_count[job.priority] += 1
+        self._wait_total[job.priority] += wait
+        self._wait_max[job.priority] = max(self._wait_max[job.priority], wait)
+
+        log.debug("Starting %s (priority: %s, waited: %.3fs, running: %i, queued: %i)"
+                  % (job.command, PRIORITY_NAMES[job.priority], wait, self._running,
+                     sum([len(queue) for queue in self._queues])))
+
+        self._running += 1
+        self._running_plugin[job.plugin] = self._running_plugin.get(job.plugin, 0) + 1
+        if job.priority == PRIORITY_LOW:
+            self._running_low += 1
+
+        d = maybeDeferred(job.f, *job.args, **job.kwargs)
+        d.addBoth(self._finished, job)
+
+    def _finished(self, result, job):
+        self._running -= 1
+        self._running_plugin[job.plugin] -= 1
+        if not self._running_plugin[job.plugin]:
+            del self._running_plugin[job.plugin]
+
+        if job.priority == PRIORITY_LOW:
+            self._running_low -= 1
+
+        job.deferred.callback(result)
+        self._dispatch()
+
+
+class _Job:
+    def __init__(self, command, plugin, priority, f, args, kwargs):
+        self.command = command
+        self.plugin = plugin
+        self.priority = priority
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time()
+        self.deferred = Deferred()
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import deque
+
+# Twisted imports
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+
+DEFAULT_THREADS = 2
+DEFAULT_MIN_SIZE = 64 * 1024
+
+
+class Serializer:
+    """
+    Runs CPU heavy message work (compression, encoding, signature checks,
+    XML serialization) on a bounded thread pool so large results don't
+    stall the reactor.
+    Jobs with the same key (IQ id) run one after another and their results
+    are delivered in submission order. Jobs smaller than min_size run on
+    the reactor thread, still after pending jobs for the same key.
+    """
+
+    def __init__(self, threads=DEFAULT_THREADS, min_size=DEFAULT_MIN_SIZE):
+        self.min_size = min_size
+        self._queues = {}
+
+        self._pool = ThreadPool(0, max(threads, 1), 'ecagent-serializer')
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def submit(self, key, f, args=(), size=None):
+        """
+        Queues f(*args) and returns a Deferred fired with its result.
+        size: payload size in bytes, None to always use the thread pool.
+        """
+        d = Deferred()
+        queue = self._queues.setdefault(key, deque())
+        queue.append((f, args, size, d))
+
+        if len(queue) == 1:
+            self._run(key)
+
+        return d
+
+    def _run(self, key):
+        (f, args, size, d) = self._queues[key][0]
+
+        if size is not None and size < self.min_size:
+            job = maybeDeferred(f, *args)
+
+        else:
+            job = deferToThreadPool(reactor, self._pool, f, *args)
+
+        job.addBoth(self._finished, key, d)
+
+    def _finished(self, result, key, d):
+        # Caller callbacks (send) run before the next job for this key starts,
+        # jobs they submit are queued behind this one
+        d.callback(result)
+
+        queue = self._queues[key]
+        queue.popleft()
+
+        if queue:
+            self._run(key)
+
+        else:
+            del self._queues[key]
@@ -0,0 +1,162 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import hmac
+import hashlib
+import base64
+from time import time
+
+try:
+    from Crypto.Cipher import PKCS1_OAEP
+    OAEP_AVAILABLE = True
+
+except ImportError:
+    OAEP_AVAILABLE = False
+
+# Local
+import ecagent.twlogging as log
+
+DEFAULT_TTL = 3600
+MAX_TTL = 86400
+MAX_SESSIONS = 100
+
+NONCE_TTL = 60
+MAX_NONCES = 100
+
+# Bytes
+KEY_LENGTH = 32
+
+
+def _compare_digest(a, b):
+    """ Constant time comparison (hmac.compare_digest is python >= 2.7.7) """
+    if len(a) != len(b):
+        return False
+
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+
+    return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def sign(key, text):
+    """ base64 HMAC-SHA256 of text, the signature of session commands """
+    return base64.b64encode(hmac.new(key, text, hashlib.sha256).digest())
+
+
+class SessionKeys:
+    """
+    Short lived symmetric keys for HMAC-SHA256 checked commands.
+    session.nonce hands out a single use nonce, and an RSA signed
+    session.open carrying it gets a key generated here and sent back
+    encrypted with the server public key (RSA-OAEP): key material never
+    travels in clear, and a captured session.open can't be replayed.
+    Later commands from the same sender with a session attribute are
+    signed with HMAC-SHA256 of the same text the RSA signature covers,
+    which is checked in microseconds instead of an RSA verify.
+    """
+
+    def __init__(self, max_ttl=MAX_TTL, max_sessions=MAX_SESSIONS, max_nonces=MAX_NONCES):
+        self.max_ttl = max_ttl
+        self.max_sessions = max_sessions
+        self.max_nonces = max_nonces
+
+        # (sender bare JID, session id): (expires, key)
+        self._sessions = {}
+
+        # (sender bare JID, nonce): expires
+        self._nonces = {}
+
+    def nonce(self, sender):
+        """ Returns a nonce for the next session.open of sender """
+        self._expire_nonces()
+        if len(self._nonces) >= self.max_nonces:
+            oldest = min(self._nonces, key=self._nonces.get)
+            del self._nonces[oldest]
+
+        nonce = os.urandom(16).encode('hex')
+        self._nonces[(sender, nonce)] = time() + NONCE_TTL
+        return nonce
+
+    def open(self, sender, nonce, public_key, ttl=DEFAULT_TTL):
+        """
+        Consumes the nonce and returns (session id, key encrypted with
+        public_key as base64, expiration time)
+        """
+        expires = self._nonces.pop((sender, nonce), None)
+        if expires is None or expires <= time():
+            raise SessionError("Unknown or expired nonce")
+
+        if ttl <= 0:
+            raise SessionError("Invalid ttl %i" % ttl)
+
+        if not OAEP_AVAILABLE or public_key is None:
+            raise SessionError("RSA-OAEP not available")
+
+        key = os.urandom(KEY_LENGTH)
+        encrypted_key = base64.b64encode(PKCS1_OAEP.new(public_key).encrypt(key))
+
+        self._expire()
+        if len(self._sessions) >= self.max_sessions:
+            # Drop the session closest to expire
+            oldest = min(self._sessions, key=lambda session: self._sessions[session][0])
+            del self._sessions[oldest]
+
+        session_id = os.urandom(8).encode('hex')
+        expires = time() + min(ttl, self.max_ttl)
+        self._sessions[(sender, session_id)] = (expires, key)
+        log.info("Session %s opened for %s (ttl: %i)" % (session_id, sender, min(ttl, self.max_ttl)))
+        return session_id, encrypted_key, expires
+
+    def close(self, sender, session_id):
+        return self._sessions.pop((sender, session_id), None) is not None
+
+    def verify(self, sender, session_id, text, signature):
+        """ Returns None if the session is unknown or has expired """
+        session = self._sessions.get((sender, session_id))
+        if session is None:
+            return None
+
+        expires, key = session
+        if expires <= time():
+            del self._sessions[(sender, session_id)]
+            return None
+
+        return compare_digest(sign(key, text), str(signature))
+
+    def stats(self):
+        self._expire()
+        return {'sessions': len(self._sessions)}
+
+    def _expire(self):
+        now = time()
+        for session, (expires, _) in self._sessions.items():
+            if expires <= now:
+                del self._sessions[session]
+
+    def _expire_nonces(self):
+        now = time()
+        for nonce, expires in self._nonces.items():
+            if expires <= now:
+                del self._nonces[nonce]
+
+
+class SessionError(Exception):
+    pass
@@ -0,0 +1,267 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import deque
+
+# Twisted imports
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish.domish import Element
+from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+
+# Local
+import twlogging as log
+
+NS_SM = 'urn:xmpp:sm:3'
+
+DEFAULT_MAX_UNACKED_SIZE = 8 * 1024 ** 2
+
+# Seconds to wait for more stanzas before requesting an ack
+ACK_DELAY = 1
+
+_STANZAS = ('iq', 'message', 'presence')
+_H_MODULO = 2 ** 32
+
+
+class StreamManager:
+    """
+    Stream management (XEP-0198) state, kept across connections.
+    Counts handled inbound stanzas, keeps sent stanzas until the server
+    acks them and replays them after a resumed (or new) session. Stanzas
+    sent while disconnected are queued for the next session.
+    The queue is capped at max_unacked_size bytes, oldest stanzas are
+    dropped past that.
+    Stanzas are written with write(data), sm elements straight to the stream.
+    """
+
+    def __init__(self, write, max_unacked_size=DEFAULT_MAX_UNACKED_SIZE):
+        self.write = write
+        self.max_unacked_size = max_unacked_size
+
+        self.xs = None
+        self.enabled = False
+        self.resumed = False
+
+        # Resumable session
+        self.session_id = None
+
+        self.inbound = 0
+        self.outbound = 0
+        self._unacked = deque()
+        self._unacked_size = 0
+        self._pending = []
+        self._ack_dc = None
+
+    def connected(self, xs):
+        self.xs = xs
+        self.enabled = False
+        self.resumed = False
+
+        for name in _STANZAS:
+            xs.addObserver('/' + name, self._onStanza, priority=100)
+
+        xs.addObserver("/r[@xmlns='%s']" % NS_SM, self._onAckRequest)
+        xs.addObserver("/a[@xmlns='%s']" % NS_SM, self._onAck)
+
+    def disconnected(self):
+        self.enabled = False
+        self._cancel_ack()
+
+        if self._unacked:
+            log.info("Stream closed with %i unacked stanzas" % len(self._unacked))
+
+    def authenticated(self):
+        """
+        Stream is ready. Sends stanzas left from the previous session, on a
+        resumed stream they were already sent again.
+        """
+        pending, self._pending = self._pending, []
+
+        if not self.enabled:
+            # Server without stream management: send them once
+            self.session_id = None
+            pending = self._take_unacked() + pending
+
+        if pending:
+            log.info("Sending %i stanzas left from the previous session" % len(pending))
+
+        for data in pending:
+            self.send(data)
+
+    def send(self, data):
+        """ Sends a serialized stanza, keeping it until acked """
+        if not self.enabled and not self.session_id:
+            # No stream management
+            self.write(data)
+            return
+
+        self.outbound = (self.outbound + 1) % _H_MODULO
+        self._queue(self.outbound, data)
+
+        if self.enabled:
+            self.write(data)
+            self._request_ack()
+
+    def onEnabled(self, element):
+        # New session: unacked stanzas are sent again after presence
+        self._pending.extend(self._take_unacked())
+
+        self.enabled = True
+        self.inbound = 0
+        self.outbound = 0
+
+        if element.getAttribute('resume') in ('true', '1'):
+            self.session_id = element.getAttribute('id')
+
+        else:
+            self.session_id = None
+
+        log.info("Stream management enabled (resumable: %s)" % bool(self.session_id))
+
+    def onResumed(self, element):
+        self.enabled = True
+        self.resumed = True
+
+        h = int(element.getAttribute('h', 0))
+        self._acked(h)
+
+        pending = self._take_unacked()
+        log.info("Stream %s resumed, sending %i unacked stanzas" % (self.session_id, len(pending)))
+
+        self.outbound = h
+        for data in pending:
+            self.send(data)
+
+    def onResumeFailed(self):
+        log.info("Unable to resume stream %s, starting a new session" % self.session_id)
+        self.session_id = None
+
+    def _onStanza(self, element):
+        if self.enabled:
+            self.inbound = (self.inbound + 1) % _H_MODULO
+
+    def _onAckRequest(self, element):
+        answer = Element((NS_SM, 'a'))
+        answer['h'] = str(self.inbound)
+        self.xs.send(answer)
+
+    def _onAck(self, element):
+        self._acked(int(element.getAttribute('h', 0)))
+
+    def _acked(self, h):
+        # Drop stanzas up to h (sequence numbers wrap at 2^32)
+        while self._unacked and (h - self._unacked[0][0]) % _H_MODULO < _H_MODULO / 2:
+            self._unacked_size -= len(self._unacked.popleft()[1])
+
+    def _take_unacked(self):
+        pending = [data for (h, data) in self._unacked]
+        self._unacked.clear()
+        self._unacked_size = 0
+        return pending
+
+    def _queue(self, h, data):
+        self._unacked.append((h, data))
+        self._unacked_size += len(data)
+
+        while self._unacked_size > self.max_unacked_size and len(self._unacked) > 1:
+            self._unacked_size -= len(self._unacked.popleft()[1])
+            log.warn("Unacked stanzas queue is full, dropping oldest stanza")
+
+    def _request_ack(self):
+        if not self._ack_dc:
+            self._ack_dc = reactor.callLater(ACK_DELAY, self._send_ack_request)
+
+    def _send_ack_request(self):
+        self._ack_dc = None
+        if self.enabled and self._unacked:
+            self.xs.send(Element((NS_SM, 'r')))
+
+    def _cancel_ack(self):
+        if self._ack_dc:
+            self._ack_dc.cancel()
+            self._ack_dc = None
+
+
+class ResumeInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """
+    Resumes the previous stream instead of binding a new resource.
+    Goes before the bind initializer, which is skipped on success.
+    """
+
+    feature = (NS_SM, 'sm')
+
+    def __init__(self, xs, manager):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs, False)
+        self.manager = manager
+        self._deferred = None
+
+    def start(self):
+        if not self.manager.session_id:
+            return None
+
+        self._deferred = Deferred()
+        self.xmlstream.addOnetimeObserver("/resumed[@xmlns='%s']" % NS_SM, self.onResumed)
+        self.xmlstream.addOnetimeObserver("/failed[@xmlns='%s']" % NS_SM, self.onFailed)
+
+        resume = Element((NS_SM, 'resume'))
+        resume['h'] = str(self.manager.inbound)
+        resume['previd'] = self.manager.session_id
+        self.xmlstream.send(resume)
+        return self._deferred
+
+    def onResumed(self, element):
+        self.xmlstream.removeObserver("/failed[@xmlns='%s']" % NS_SM, self.onFailed)
+
+        # Resource, session and stream management are kept from the resumed stream
+        self.xmlstream.initializers = [self]
+        self.manager.onResumed(element)
+        self._deferred.callback(None)
+
+    def onFailed(self, element):
+        self.xmlstream.removeObserver("/resumed[@xmlns='%s']" % NS_SM, self.onResumed)
+        self.manager.onResumeFailed()
+        self._deferred.callback(None)
+
+
+class EnableInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """ Enables stream management (with resumption) on a new session """
+
+    feature = (NS_SM, 'sm')
+
+    def __init__(self, xs, manager):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs, False)
+        self.manager = manager
+        self._deferred = None
+
+    def start(self):
+        self._deferred = Deferred()
+        self.xmlstream.addOnetimeObserver("/enabled[@xmlns='%s']" % NS_SM, self.onEnabled)
+        self.xmlstream.addOnetimeObserver("/failed[@xmlns='%s']" % NS_SM, self.onFailed)
+
+        enable = Element((NS_SM, 'enable'))
+        enable['resume'] = 'true'
+        self.xmlstream.send(enable)
+        return self._deferred
+
+    def onEnabled(self, element):
+        self.xmlstream.removeObserver("/failed[@xmlns='%s']" % NS_SM, self.onFailed)
+        self.manager.onEnabled(element)
+        self._deferred.callback(None)
+
+    def onFailed(self, element):
+        self.xmlstream.removeObserver("/enabled[@xmlns='%s']" % NS_SM, self.onEnabled)
+        log.warn("Stream management refused by server")
+        self._deferred.callback(None)
@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+from time import time
+
+# Local
+import ecagent.twlogging as log
+
+PHASES = ('config', 'uuid', 'certificate', 'plugins', 'connect', 'auth', 'presence')
+
+
+class StartupTimer:
+    """
+    Durations of the agent startup phases:
+        config: reading the config file
+        uuid: MAC and UUID checks (check_uuid)
+        certificate: loading the public key
+        plugins: plugin discovery, commands are queued until it ends
+        connect: TCP connection and stream start (runs along with plugins)
+        auth: stream negotiation and authentication
+        presence: from the initial presence to the first presence received
+    Phases are logged when they end and reported (in ms) by stats();
+    connect, auth and presence are measured again on reconnections.
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.total = None
+        self._begin = {}
+        self._end = {}
+
+    def begin(self, phase):
+        self._begin[phase] = time()
+        self._end.pop(phase, None)
+
+    def end(self, phase):
+        if phase not in self._begin or phase in self._end:
+            return
+
+        self._end[phase] = time()
+        log.info("Startup phase %s: %.3fs (%.3fs since start)"
+                 % (phase, self._end[phase] - self._begin[phase], self._end[phase] - self.started))
+
+        if phase == PHASES[-1] and self.total is None:
+            self.total = self._end[phase] - self.started
+            log.info("Startup finished in %.3fs" % self.total)
+
+    def ended(self, phase):
+        return phase in self._end
+
+    def stats(self):
+        phases = {}
+        for phase in PHASES:
+            if phase in self._end:
+                phases[phase] = int((self._end[phase] - self._begin[phase]) * 1000)
+
+            elif phase in self._begin:
+                # Still running
+                phases[phase] = None
+
+        retval = {'phases': phases}
+        if self.total is not None:
+            retval['total'] = int(self.total * 1000)
+
+        return retval
+
+
+# Started when the agent is loaded
+timer = StartupTimer()
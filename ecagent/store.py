@@ -0,0 +1,274 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import re
+import base64
+import hashlib
+from time import time
+from collections import OrderedDict
+
+# Local
+import ecagent.twlogging as log
+
+DEFAULT_MAX_SIZE = 256 * 1024 ** 2
+MAX_CHUNK_SIZE = 512 * 1024
+
+# Seconds an upload can go without chunks before it is dropped
+PART_MAX_AGE = 3600
+
+# Argument values referencing a stored payload
+REF_PREFIX = 'sha256:'
+
+_DIGEST_RE = re.compile('^[0-9a-f]{64}$')
+_PART_SUFFIX = '.part'
+
+
+class PayloadStore:
+    """
+    On disk content-addressed store for large command payloads (scripts,
+    recipes, config files), file name is the SHA-256 of the content.
+    Payloads are uploaded in chunks and hashed as they arrive. Least
+    recently used payloads are removed when the store, uploads included,
+    exceeds max_size; abandoned uploads are removed after PART_MAX_AGE.
+    Command arguments with a "sha256:<hex>" value are replaced by the
+    base64 of the stored payload (the encoding plugins expect).
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+
+        # digest -> size, least recently used first
+        self._entries = OrderedDict()
+
+        # digest -> _Part, uploads in progress
+        self._parts = {}
+        self._load()
+
+    def has(self, digest):
+        return digest.lower() in self._entries
+
+    def missing(self, command_args):
+        """ Digests referenced by command_args that are not stored """
+        return [digest for digest in self.references(command_args) if digest not in self._entries]
+
+    def resolve(self, command_args):
+        """
+        Returns (command_args, missing): references replaced with their
+        payload, or the list of missing digests.
+        """
+        references = self.references(command_args)
+        if not references:
+            return command_args, []
+
+        resolved = dict(command_args)
+        missing = []
+
+        for name, value in command_args.items():
+            digest = self._reference(value)
+            if not digest:
+                continue
+
+            payload = self.get(digest)
+            if payload is None:
+                missing.append(digest)
+
+            else:
+                resolved[name] = base64.b64encode(payload)
+
+        return resolved, missing
+
+    def references(self, command_args):
+        return [digest for digest in map(self._reference, command_args.values()) if digest]
+
+    def get(self, digest):
+        if digest not in self._entries:
+            return None
+
+        try:
+            f = open(self._filename(digest), 'rb')
+            payload = f.read()
+            f.close()
+
+        except IOError as e:
+            log.warn("Unable to read stored payload %s: %s" % (digest, e))
+            self._remove(digest)
+            return None
+
+        self._touch(digest)
+        return payload
+
+    def put_chunk(self, digest, offset, data, total):
+        """
+        Appends a chunk to the payload being uploaded.
+        Returns the bytes received so far (the payload is stored once it
+        has total bytes and matches its digest).
+        """
+        if not _DIGEST_RE.match(digest):
+            raise StoreError("Invalid digest: %s" % digest)
+
+        if digest in self._entries:
+            self._touch(digest)
+            return total
+
+        if len(data) > MAX_CHUNK_SIZE:
+            raise StoreError("Chunk too large (max: %i bytes)" % MAX_CHUNK_SIZE)
+
+        if total > self.max_size:
+            raise StoreError("Payload too large (max: %i bytes)" % self.max_size)
+
+        part = self._parts.get(digest)
+        if part is None:
+            part = self._parts[digest] = _Part()
+
+        if offset != part.size:
+            # Server resumes from the returned size
+            return part.size
+
+        if part.size + len(data) > total:
+            self._drop_part(digest)
+            raise StoreError("Payload larger than announced")
+
+        f = open(self._part_filename(digest), 'ab')
+        f.write(data)
+        f.close()
+        part.update(data)
+
+        if part.size == total:
+            self._complete(digest)
+
+        else:
+            self._evict()
+
+        return part.size
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'uploads': len(self._parts),
+        }
+
+    def _complete(self, digest):
+        part = self._parts.pop(digest)
+        part_filename = self._part_filename(digest)
+
+        if part.sha256.hexdigest() != digest:
+            os.remove(part_filename)
+            raise StoreError("Payload doesn't match its digest")
+
+        os.rename(part_filename, self._filename(digest))
+        self._entries[digest] = os.path.getsize(self._filename(digest))
+        self.size += self._entries[digest]
+        log.info("Stored payload %s (%i bytes)" % (digest, self._entries[digest]))
+
+        self._evict()
+
+    def _load(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        entries = []
+        for filename in os.listdir(self.path):
+            full_filename = os.path.join(self.path, filename)
+
+            if filename.endswith(_PART_SUFFIX):
+                # Interrupted upload
+                os.remove(full_filename)
+
+            elif _DIGEST_RE.match(filename):
+                st = os.stat(full_filename)
+                entries.append((st.st_mtime, filename, st.st_size))
+
+        for (mtime, digest, size) in sorted(entries):
+            self._entries[digest] = size
+            self.size += size
+
+        self._evict()
+
+    def _touch(self, digest):
+        self._entries[digest] = self._entries.pop(digest)
+
+        # mtime keeps the order across restarts
+        try:
+            os.utime(self._filename(digest), None)
+
+        except OSError:
+            pass
+
+    def _evict(self):
+        now = time()
+        for digest, part in self._parts.items():
+            if now - part.updated > PART_MAX_AGE:
+                log.info("Upload of payload %s abandoned (%i bytes)" % (digest, part.size))
+                self._drop_part(digest)
+
+        parts_size = sum([part.size for part in self._parts.values()])
+        while self.size + parts_size > self.max_size and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _drop_part(self, digest):
+        del self._parts[digest]
+
+        try:
+            os.remove(self._part_filename(digest))
+
+        except OSError:
+            pass
+
+    def _remove(self, digest):
+        self.size -= self._entries.pop(digest, 0)
+
+        try:
+            os.remove(self._filename(digest))
+
+        except OSError:
+            pass
+
+    def _filename(self, digest):
+        return os.path.join(self.path, digest)
+
+    def _part_filename(self, digest):
+        return self._filename(digest) + _PART_SUFFIX
+
+    @staticmethod
+    def _reference(value):
+        if isinstance(value, basestring) and value.startswith(REF_PREFIX):
+            digest = value[len(REF_PREFIX):].lower()
+            if _DIGEST_RE.match(digest):
+                return digest
+
+        return None
+
+
+class _Part:
+    """ Upload in progress, hashed as chunks arrive """
+
+    def __init__(self):
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.updated = time()
+
+    def update(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        self.updated = time()
+
+
+class StoreError(Exception):
+    pass
@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import hashlib
+import simplejson as json
+from time import time
+
+# Twisted imports
+from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+
+# Local
+import ecagent.twlogging as log
+
+_E_RUNNING_COMMAND = 253
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 1024 ** 2
+
+# Seconds to wait when the connection can't take more data
+RETRY_DELAY = 0.5
+
+# Seconds the connection can be unable to take a chunk before failing
+IDLE_TIMEOUT = 300
+
+# Same files plugins refuse to read (plugins/__plugin.py)
+PROTECTED_FILES = [
+    '/etc/shadow',
+]
+
+
+class FileTransfer:
+    """
+    Streams length bytes of a file from offset as partial results, one
+    chunk at a time: the next chunk is read once the previous one has been
+    queued for sending and the connection is writable, so memory use is
+    bounded by the chunk size whatever the file size.
+    send(result) sends a partial result; it returns False when it can't
+    send now (disconnected or congested), or a Deferred fired once the
+    result is queued. The transfer fails when no chunk could be sent for
+    idle_timeout seconds.
+    The final result has the transferred size and its SHA-256.
+    """
+
+    def __init__(self, filename, send, offset=0, length=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.filename = os.path.abspath(filename)
+        self.send = send
+        self.offset = offset
+        self.chunk_size = min(max(chunk_size, 1), MAX_CHUNK_SIZE)
+        self.idle_timeout = idle_timeout
+
+        if self.filename in PROTECTED_FILES:
+            raise TransferError("File is protected")
+
+        if not os.path.isfile(self.filename):
+            raise TransferError("%s doesn't exists" % self.filename)
+
+        self.size = os.path.getsize(self.filename)
+        if offset < 0 or offset > self.size:
+            raise TransferError("Invalid offset %i (file size: %i)" % (offset, self.size))
+
+        # Up to the current end of file, a growing file is not followed
+        self.length = self.size - offset
+        if length is not None:
+            self.length = min(max(length, 0), self.length)
+
+        self.sent = 0
+        self.seq = 0
+        self.sha256 = hashlib.sha256()
+
+        self._file = None
+        self._chunk = None
+        self._deferred = None
+        self._last_sent = None
+
+    def start(self):
+        """ Returns a Deferred fired with the final result """
+        log.info("Transferring %s (offset: %i, length: %i)" % (self.filename, self.offset, self.length))
+        self._file = open(self.filename, 'rb')
+        self._file.seek(self.offset)
+
+        self._deferred = Deferred()
+        self._last_sent = time()
+        self._next_chunk()
+        return self._deferred
+
+    def _next_chunk(self):
+        if self._chunk is None:
+            if self.sent >= self.length:
+                self._finished()
+                return
+
+            try:
+                self._chunk = self._file.read(min(self.chunk_size, self.length - self.sent))
+
+            except IOError as e:
+                self._failed("Unable to read file: %s" % e)
+                return
+
+            if not self._chunk:
+                self._failed("File truncated at %i bytes" % (self.offset + self.sent))
+                return
+
+        stream_info = {
+            'seq': self.seq,
+            'stdout_offset': self.offset + self.sent,
+        }
+        queued = self.send((None, self._chunk, '', 0, self.sent + len(self._chunk), stream_info))
+
+        if queued is False:
+            if time() - self._last_sent >= self.idle_timeout:
+                self._failed("Unable to send for %i seconds" % self.idle_timeout)
+                return
+
+            # Disconnected or busy: send the same chunk later
+            reactor.callLater(RETRY_DELAY, self._next_chunk)
+            return
+
+        self._last_sent = time()
+        self.seq += 1
+        self.sent += len(self._chunk)
+        self.sha256.update(self._chunk)
+        self._chunk = None
+
+        if isinstance(queued, Deferred):
+            queued.addBoth(lambda _: reactor.callLater(0, self._next_chunk))
+
+        else:
+            reactor.callLater(0, self._next_chunk)
+
+    def _finished(self):
+        self._file.close()
+        log.info("Transferred %s (%i bytes)" % (self.filename, self.sent))
+
+        retval = {
+            'file': self.filename,
+            'size': self.size,
+            'offset': self.offset,
+            'length': self.sent,
+            'chunks': self.seq,
+            'sha256': self.sha256.hexdigest(),
+        }
+        stream_info = {
+            'seq': self.seq,
+            'stdout_length': self.sent,
+            'stdout_sha256': retval['sha256'],
+        }
+        self._deferred.callback((0, json.dumps(retval), '', 0, 0, stream_info))
+
+    def _failed(self, error):
+        self._file.close()
+        log.error("Transfer of %s failed: %s" % (self.filename, error))
+        self._deferred.callback((_E_RUNNING_COMMAND, '', "ERROR: %s" % error, 0))
+
+
+class TransferError(Exception):
+    pass
@@ -0,0 +1,286 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import simplejson as json
+import base64
+from collections import deque
+
+# Twisted imports
+from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.error import ProcessTerminated, ProcessDone
+
+# Local
+import ecagent.frames as frames
+import ecagent.twlogging as log
+
+_WORKER_COMMAND = '__worker__'
+_WORKER_OUTPUT_STRING = '[__worker_response__]'
+
+_RESPAWN_DELAY = 5
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_REQUESTS = 500
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+class WorkerPool:
+    """
+    Pool of long-lived plugin processes started in worker mode.
+    Commands are written to an idle worker stdin and answered with a single
+    response line, so the interpreter startup and plugin imports are paid
+    once per worker instead of once per command.
+    """
+
+    def __init__(self, filename, python_runner, env, size=DEFAULT_POOL_SIZE,
+                 max_requests=DEFAULT_MAX_REQUESTS, idle_timeout=DEFAULT_IDLE_TIMEOUT, min_workers=1):
+        self.filename = filename
+        self.env = env
+        self.size = max(size, 1)
+        self.max_requests = max_requests
+        self.idle_timeout = idle_timeout
+        self.min_workers = min(min_workers, self.size)
+
+        # -u: sets unbuffered output
+        self._command = python_runner
+        self._args = [python_runner, '-u', '-W ignore::DeprecationWarning', filename, _WORKER_COMMAND]
+
+        self._workers = set()
+        self._idle = []
+        self._queue = deque()
+        self._respawn_dc = None
+        self._stopped = False
+
+    def start(self):
+        log.info("[INIT] Starting worker pool for %s" % self.filename)
+        self._fill()
+
+    def stop(self):
+        self._stopped = True
+        if self._respawn_dc and self._respawn_dc.active():
+            self._respawn_dc.cancel()
+
+        for worker in list(self._workers):
+            worker.retire()
+
+    def run(self, command_name, command_args, timeout):
+        d = Deferred()
+        self._queue.append((command_name, command_args, timeout, d))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self._queue:
+            if self._idle:
+                worker = self._idle.pop()
+
+            elif len(self._workers) < self.size:
+                worker = self._spawn()
+
+            else:
+                log.debug("All workers busy for %s, %i queued" % (self.filename, len(self._queue)))
+                return
+
+            command_name, command_args, timeout, d = self._queue.popleft()
+            worker.execute(command_name, command_args, timeout, d)
+
+    def _spawn(self):
+        worker = WorkerProcess(self, frames.FRAMES_AVAILABLE)
+        self._workers.add(worker)
+
+        if worker.framed:
+            reactor.spawnProcess(worker, self._command, self._args,
+                                 env=frames.framed_env(self.env), childFDs=frames.child_fds())
+
+        else:
+            reactor.spawnProcess(worker, self._command, self._args, env=self.env)
+
+        return worker
+
+    def _fill(self):
+        self._respawn_dc = None
+        while not self._stopped and len(self._workers) < self.min_workers:
+            self._idle_worker(self._spawn())
+
+    def _idle_worker(self, worker):
+        self._idle.append(worker)
+        worker.idle_dc = reactor.callLater(self.idle_timeout, self._reap, worker)
+
+    def _release(self, worker):
+        """ Worker has answered its request """
+        if worker.requests >= self.max_requests:
+            log.debug("Recycling worker for %s after %i requests" % (self.filename, worker.requests))
+            self._retire(worker)
+            self._fill()
+
+        else:
+            self._idle_worker(worker)
+
+        self._dispatch()
+
+    def _reap(self, worker):
+        worker.idle_dc = None
+        if worker in self._idle and len(self._workers) > self.min_workers:
+            log.debug("Reaping idle worker for %s" % self.filename)
+            self._retire(worker)
+
+        elif worker in self._idle:
+            worker.idle_dc = reactor.callLater(self.idle_timeout, self._reap, worker)
+
+    def _retire(self, worker):
+        if worker in self._idle:
+            self._idle.remove(worker)
+        self._workers.discard(worker)
+        worker.retire()
+
+    def _ended(self, worker):
+        """ Worker process has exited """
+        if worker in self._idle:
+            self._idle.remove(worker)
+        self._workers.discard(worker)
+
+        if self._stopped:
+            return
+
+        if not worker.retired:
+            log.warn("Worker for %s died unexpectedly" % self.filename)
+
+        if len(self._workers) < self.min_workers and not self._respawn_dc:
+            self._respawn_dc = reactor.callLater(_RESPAWN_DELAY, self._fill)
+
+        self._dispatch()
+
+
+class WorkerProcess(ProcessProtocol):
+    def __init__(self, pool, framed=False):
+        # framed: responses come as frames on frames.RESULT_FD, else as
+        # lines starting with _WORKER_OUTPUT_STRING on stdout
+        self.framed = framed
+        self.frame_decoder = frames.FrameDecoder()
+
+        self.pool = pool
+        self.requests = 0
+        self.retired = False
+        self.idle_dc = None
+        self.timeout_dc = None
+        self.timed_out = 0
+        self.deferred = None
+        self.stdout = ''
+        self.stderr = ''
+
+    def execute(self, command_name, command_args, timeout, d):
+        self._cancel(self.idle_dc)
+        self.idle_dc = None
+
+        self.requests += 1
+        self.deferred = d
+        self.stdout = self.stderr = ''
+
+        log.info("Running %s from %s worker (timeout: %i)" % (command_name, self.pool.filename, timeout))
+        request = {'command': command_name, 'args': command_args}
+        self.transport.write(base64.b64encode(json.dumps(request)) + '\n')
+        self.timeout_dc = reactor.callLater(timeout, self._timeout)
+
+    def retire(self):
+        """ Closing stdin makes the worker finish its loop and exit """
+        self.retired = True
+        self._cancel(self.idle_dc)
+        try:
+            self.transport.closeStdin()
+
+        except:
+            pass
+
+    def childDataReceived(self, childFD, data):
+        if childFD == frames.RESULT_FD:
+            self.resultReceived(data)
+
+        else:
+            ProcessProtocol.childDataReceived(self, childFD, data)
+
+    def resultReceived(self, data):
+        try:
+            for frame in self.frame_decoder.feed(data):
+                if self.deferred:
+                    self._response(frame)
+
+        except frames.FrameError as e:
+            log.error("Invalid worker response: %s" % e)
+            self.retired = True
+            self.transport.signalProcess('KILL')
+
+    def outReceived(self, data):
+        if self.framed or not self.deferred:
+            return
+
+        self.stdout += data
+        while '\n' in self.stdout:
+            line, self.stdout = self.stdout.split('\n', 1)
+            if line.startswith(_WORKER_OUTPUT_STRING):
+                self._response(base64.b64decode(line[len(_WORKER_OUTPUT_STRING):]))
+                return
+
+    def errReceived(self, data):
+        log.debug("Worker err made: %s" % data)
+        if self.deferred:
+            self.stderr += data
+
+    def _response(self, data):
+        self._cancel(self.timeout_dc)
+        d, self.deferred = self.deferred, None
+
+        try:
+            response = json.loads(data)
+            result = (response['out'], response['stdout'], self.stderr + response['stderr'], 0)
+
+        except Exception as e:
+            result = (2, '', "Invalid worker response: %s" % e, 0)
+
+        self.pool._release(self)
+        d.callback(result)
+
+    def _timeout(self):
+        log.warn("Worker for %s timed out, killing it" % self.pool.filename)
+        self.timed_out = 1
+        self.retired = True
+        self.transport.signalProcess('KILL')
+
+    def processEnded(self, status):
+        log.debug("Worker process ended")
+        self._cancel(self.timeout_dc)
+        self._cancel(self.idle_dc)
+        self.pool._ended(self)
+
+        if self.deferred:
+            # Get command retval
+            t = type(status.value)
+            if t is ProcessDone:
+                exit_code = 0
+
+            elif t is ProcessTerminated:
+                exit_code = status.value.exitCode
+
+            else:
+                exit_code = 2
+
+            d, self.deferred = self.deferred, None
+            d.callback((exit_code, '', self.stderr, self.timed_out))
+
+    @staticmethod
+    def _cancel(delayed_call):
+        if delayed_call and delayed_call.active():
+            delayed_call.cancel()
@@ -23,6 +23,12 @@ _E_COMMAND_NOT_DEFINED = 252
 
 _FINAL_OUTPUT_STRING = '[__response__]'
 
+_WORKER_COMMAND = '__worker__'
+_WORKER_OUTPUT_STRING = '[__worker_response__]'
+
+# Agent reads results as "<length>\n<payload>" frames from this fd
+_RESULT_FD_ENV = 'ECM_RESULT_FD'
+
 PROTECTED_FILES = [
     '/etc/shadow',
 ]
@@ -33,13 +39,29 @@ import inspect
 import simplejson as json
 import __helper as ecm
 
-from base64 import b64decode
+from base64 import b64decode, b64encode
+
+# Don't pass the result fd to processes started by commands: neither its
+# number nor the fd itself (close it on exec, where fcntl is available)
+_RESULT_FD = os.environ.pop(_RESULT_FD_ENV, None)
+
+if _RESULT_FD:
+    try:
+        import fcntl
+        _flags = fcntl.fcntl(int(_RESULT_FD), fcntl.F_GETFD)
+        fcntl.fcntl(int(_RESULT_FD), fcntl.F_SETFD, _flags | fcntl.FD_CLOEXEC)
+
+    except (ImportError, IOError, OSError, ValueError):
+        pass
 
 sys.stdout.flush()
 sys.stderr.flush()
 
 
 class ECMPlugin:
+    # Seconds the agent may reuse a command result: {'command_name': ttl}
+    cache_ttl = {}
+
     def __init__(self, *argv, **kwargs):
         pass
 
@@ -47,6 +69,9 @@ class ECMPlugin:
         if len(sys.argv) == 1 or sys.argv[1] == '':
             return self._list_commands()
 
+        elif sys.argv[1] == _WORKER_COMMAND:
+            sys.exit(self._serve_commands())
+
         else:
             command_name = sys.argv[1]
             sys.exit(self._run_command(command_name))
@@ -94,11 +119,14 @@ class ECMPlugin:
             if member[0].startswith('cmd_') and inspect.ismethod(member[1]):
                 command_name = member[0][4:]
                 command_args = inspect.getargspec(member[1])[0][1:]
-                print command_name, command_args
+                if command_name in self.cache_ttl:
+                    print command_name, command_args, self.cache_ttl[command_name]
+                else:
+                    print command_name, command_args
 
     def _run_command(self, command_name):
         try:
-            command = getattr(self, 'cmd_' + command_name)
+            getattr(self, 'cmd_' + command_name)
 
         except:
             sys.stderr.write("Command not defined (%s)" % command_name)
@@ -109,11 +137,20 @@ class ECMPlugin:
         for line in sys.stdin: lines.append(line)
         command_args = json.loads(b64decode('\n'.join(lines)))
 
+        retval, output = self._call_command(command_name, command_args)
+        if not self._write_result(output):
+            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + output)
+        return retval
+
+    def _call_command(self, command_name, command_args):
+        """
+        Runs a command and returns its exit code and json output
+        """
+        command = getattr(self, 'cmd_' + command_name)
+
         try:
             # convert returned data to json
-            data = command(**command_args)
-            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + json.dumps(data))
-            return
+            return 0, json.dumps(command(**command_args))
 
         except Exception:
             exctype, value = sys.exc_info()[:2]
@@ -123,8 +160,55 @@ class ECMPlugin:
                 'out': _E_RUNNING_COMMAND,
                 'exception': 1
             }
-            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + json.dumps(data))
-            return _E_RUNNING_COMMAND
+            return _E_RUNNING_COMMAND, json.dumps(data)
+
+    def _serve_commands(self):
+        """
+        Worker mode: keeps this plugin loaded and runs one command per
+        line read from stdin (b64 json with command and args) until stdin
+        is closed. Each command is answered with a single response line.
+        """
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                return 0
+
+            try:
+                request = json.loads(b64decode(line))
+                command_name = request.get('command', '')
+                command_args = request.get('args', {})
+
+            except Exception:
+                continue
+
+            if hasattr(self, 'cmd_' + command_name):
+                retval, output = self._call_command(command_name, command_args)
+                response = {'out': retval, 'stdout': output, 'stderr': ''}
+
+            else:
+                response = {'out': _E_COMMAND_NOT_DEFINED, 'stdout': '',
+                            'stderr': "Command not defined (%s)" % command_name}
+
+            sys.stdout.flush()
+            if not self._write_result(json.dumps(response)):
+                sys.stdout.write("\n" + _WORKER_OUTPUT_STRING + b64encode(json.dumps(response)) + "\n")
+                sys.stdout.flush()
+
+    @staticmethod
+    def _write_result(output):
+        """
+        Writes output as a length prefixed frame on the result fd.
+        Returns False when the agent didn't open a result fd (windows)
+        """
+        if not _RESULT_FD:
+            return False
+
+        frame = "%d\n%s" % (len(output), output)
+        while frame:
+            written = os.write(int(_RESULT_FD), frame)
+            frame = frame[written:]
+
+        return True
 
     def _update_plugins(self):
         pass
@@ -52,6 +52,8 @@ from __plugin import ECMPlugin
 DEFAULT_COLLECTD_SOCK = '/var/run/collectd-unixsock'
 
 class ECMCollectd(ECMPlugin):
+    cache_ttl = {'collectd_get': 10}
+
     def cmd_collectd_get(self, *argv, **kwargs):
         sock_file = kwargs.get('sock_file', None)
         
@@ -219,4 +221,5 @@ class Collectd():
                          % (errno, errstr))
 
 
-ECMCollectd().run()
+if __name__ == '__main__':
+    ECMCollectd().run()
@@ -66,5 +66,6 @@ class ECMCommand(ECMPlugin):
 
         return retval
 
-ECMCommand().run()
+if __name__ == '__main__':
+    ECMCommand().run()
 
@@ -65,4 +65,5 @@ class ECMConfigfile(ECMPlugin):
         return ret
 
 
-ECMConfigfile().run()
+if __name__ == '__main__':
+    ECMConfigfile().run()
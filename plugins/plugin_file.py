@@ -127,4 +127,5 @@ class ECMFile(ECMPlugin):
             raise Exception('Unable to read file')
 
 
-ECMFile().run()
+if __name__ == '__main__':
+    ECMFile().run()
@@ -234,5 +234,6 @@ class ECMHaproxy(ECMPlugin):
         warnings.warn("Error restarting service: %s" % err)
         return False
 
-ECMHaproxy().run()
+if __name__ == '__main__':
+    ECMHaproxy().run()
 
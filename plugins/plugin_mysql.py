@@ -66,4 +66,5 @@ class ECMMysql(ECMPlugin):
             print "Error %d: %s" % (e.args[0], e.args[1])
 
 
-ECMMysql().run()
+if __name__ == '__main__':
+    ECMMysql().run()
@@ -122,4 +122,5 @@ class ECMNetwork(ECMPlugin):
             raise Exception("Unable to connect: %s" % e[1])
 
 
-ECMNetwork().run()
+if __name__ == '__main__':
+    ECMNetwork().run()
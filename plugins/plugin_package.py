@@ -142,5 +142,6 @@ class PkgRelation(object):
         return [[parse_rel(or_dep) for or_dep in or_deps] for or_deps in cnf]
 
 
-ECMPackage().run()
+if __name__ == '__main__':
+    ECMPackage().run()
 
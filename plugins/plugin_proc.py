@@ -206,4 +206,5 @@ class ECMProc(ECMPlugin):
         return False
 
 
-ECMProc().run()
+if __name__ == '__main__':
+    ECMProc().run()
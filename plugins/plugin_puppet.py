@@ -228,4 +228,5 @@ class ECMPuppet(ECMPlugin):
         return bool(self._is_available())
 
 
-ECMPuppet().run()
+if __name__ == '__main__':
+    ECMPuppet().run()
@@ -175,4 +175,5 @@ class ECMSaltstack(ECMPlugin):
         return bool(self._is_available())
 
 
-ECMSaltstack().run()
+if __name__ == '__main__':
+    ECMSaltstack().run()
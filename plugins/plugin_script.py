@@ -67,4 +67,5 @@ class ECMScript(ECMPlugin):
         return ecm.format_output(out, stdout, stderr)
 
 
-ECMScript().run()
+if __name__ == '__main__':
+    ECMScript().run()
@@ -32,6 +32,8 @@ SVC_TIMEOUT = 120
 
 # noinspection PyUnusedLocal,PyUnusedLocal,PyUnusedLocal
 class ECMLinux(ECMPlugin):
+    cache_ttl = {'service_runlevel': 60}
+
     def cmd_service_control(self, *argv, **kwargs):
         """Syntax: service.control daemon action <force: 0/1>"""
 
@@ -123,6 +125,8 @@ class ECMLinux(ECMPlugin):
 
 
 class ECMWindows(ECMPlugin):
+    cache_ttl = {'service_runlevel': 60}
+
     def cmd_service_control(self, *argv, **kwargs):
         """Syntax: service.control daemon action"""
 
@@ -322,9 +326,10 @@ class StatFetcher(object):
         return disk_bytes_transferred
 
 # Load class based on platform()
-if sys.platform.startswith("win32"):
-    ws = __import__("win32service")
-    ECMWindows().run()
+if __name__ == '__main__':
+    if sys.platform.startswith("win32"):
+        ws = __import__("win32service")
+        ECMWindows().run()
 
-else:
-    ECMLinux().run()
+    else:
+        ECMLinux().run()
@@ -426,4 +426,5 @@ class Deploy:
         return
 
 
-ECMSource().run()
+if __name__ == '__main__':
+    ECMSource().run()
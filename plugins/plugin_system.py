@@ -25,6 +25,13 @@ import __helper as ecm
 
 
 class ECMSystem(ECMPlugin):
+    cache_ttl = {
+        'system_hostname': 60,
+        'system_uname': 300,
+        'system_info': 60,
+        'system_disk_partitions': 300,
+    }
+
     def cmd_agent_ping(self, *argv, **kwargs):
         """ Is this agent available? """
         return True
@@ -236,4 +243,5 @@ class ECMSystem(ECMPlugin):
                 return '%.1f%s' % (value, s)
 
 
-ECMSystem().run()
+if __name__ == '__main__':
+    ECMSystem().run()
@@ -0,0 +1,133 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import types
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial import unittest
+from twisted.words.xish.domish import Element
+
+import ecagent.agent as agent
+import ecagent.cache as cache
+
+
+class FakeSerializer:
+    def submit(self, key, f, args=(), size=None):
+        return succeed(f(*args))
+
+
+class FakeRunner:
+    loaded = True
+
+    def __init__(self):
+        self.runs = []
+        self.expired = []
+
+    def run_command(self, command, command_args, flush_callback=None, message=None, deadline=None):
+        d = Deferred()
+        self.runs.append(d)
+        return d
+
+    def _expired_result(self, command, deadline):
+        self.expired.append(command)
+        return agent.expired_result(deadline)
+
+
+def command_iq(message_id='1', deadline=None):
+    iq = Element(('jabber:client', 'iq'))
+    iq['type'] = 'set'
+    iq['id'] = message_id
+    iq['to'] = 'agent@example.com/ecm'
+    iq['from'] = 'server@example.com/ecm'
+    el_ecm_message = iq.addElement('ecm_message')
+    el_ecm_message['version'] = '1'
+    el_command = el_ecm_message.addElement('command')
+    el_command['name'] = 'system.load'
+    el_command['signature'] = 'signature'
+    if deadline:
+        el_command['deadline'] = str(deadline)
+    el_command.addElement('args')
+    return agent.IqMessage(iq)
+
+
+class AgentDedupTest(unittest.TestCase):
+    def setUp(self):
+        # Only the message handling state, no XMPP connection
+        self.agent = types.InstanceType(agent.SMAgentXMPP)
+        self.agent.public_key = None
+        self.agent.compressed = False
+        self.agent.command_runner = FakeRunner()
+        self.agent._serializer = FakeSerializer()
+        self.agent._dedup = cache.DedupWindow()
+        self.sent = []
+        self.agent.send = self.sent.append
+
+    def _entry(self):
+        return self.agent._dedup._entries[self.agent._dedup.key('server@example.com/ecm', '1', 'signature')]
+
+    def _finish(self, result):
+        self.agent.command_runner.runs[0].callback(result)
+
+    def test_retransmission_answered(self):
+        self.agent._processCommand(command_iq())
+        self._finish((0, 'out', '', 0))
+        self.agent._processCommand(command_iq())
+
+        self.assertEqual(len(self.agent.command_runner.runs), 1)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0], self.sent[1])
+
+    def test_timed_out_retransmission_answered(self):
+        self.agent._processCommand(command_iq())
+        self._finish((None, '', '', 1))
+        self.assertFalse(self._entry().running)
+
+        self.agent._processCommand(command_iq())
+        self.assertEqual(len(self.agent.command_runner.runs), 1)
+        self.assertEqual(len(self.sent), 2)
+        self.assertIn("timed_out='1'", self.sent[1])
+
+    def test_waiting_duplicate_answered(self):
+        self.agent._processCommand(command_iq())
+        self.agent._processCommand(command_iq())
+        self._finish((None, '', 'killed', 1))
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self._entry().waiting, 1)
+
+    def test_partial_result_not_final(self):
+        message = command_iq()
+        self.agent._processCommand(message)
+        self.agent._send((None, 'so far', '', 0, 100), message)
+
+        self.assertTrue(self._entry().running)
+        self._finish((0, 'done', '', 0))
+        self.assertFalse(self._entry().running)
+
+    def test_expired_answered_once_verified(self):
+        self.agent._processCommand(command_iq(deadline=1))
+
+        self.assertEqual(self.agent.command_runner.runs, [])
+        self.assertEqual(self.agent.command_runner.expired, ['system.load'])
+        self.assertIn("retvalue='249'", self.sent[0])
+
+    def test_expired_unverified_not_answered_as_expired(self):
+        self.agent.public_key = 'key'
+        self.agent._verify_message = lambda message: False
+        self.agent._processCommand(command_iq(deadline=1))
+
+        self.assertEqual(self.agent.command_runner.expired, [])
+        self.assertIn("retvalue='251'", self.sent[0])
@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.trial import unittest
+
+import ecagent.cache as cache
+
+KEY = cache.DedupWindow.key('server@example.com/ecm', '1', 'signature')
+OTHER_KEY = cache.DedupWindow.key('server@example.com/ecm', '2', 'signature')
+KEY_SIZE = len('server@example.com/ecm1signature')
+
+
+class CommandKeyTest(unittest.TestCase):
+    def test_argument_order(self):
+        self.assertEqual(cache.command_key('file_exist', {'a': '1', 'b': '2'}),
+                         cache.command_key('file_exist', {'b': '2', 'a': '1'}))
+
+    def test_timeout_ignored(self):
+        self.assertEqual(cache.command_key('file_exist', {'file': '/tmp', 'timeout': '5'}),
+                         cache.command_key('file_exist', {'file': '/tmp'}))
+        self.assertNotEqual(cache.command_key('file_exist', {'file': '/tmp', 'timeout': '5'}, ()),
+                            cache.command_key('file_exist', {'file': '/tmp'}, ()))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.ResultCache(max_size=100)
+        self.cache.set_ttl('system_load', 60)
+
+    def test_hit(self):
+        self.cache.set('system_load:{}', 'system_load', (0, '1.0', '', 0))
+        self.assertEqual(self.cache.get('system_load:{}'), (0, '1.0', '', 0))
+
+    def test_stream_fields_not_cached(self):
+        self.cache.set('system_load:{}', 'system_load', (0, '1.0', '', 0, 0, {'seq': 3}))
+        self.assertEqual(self.cache.get('system_load:{}'), (0, '1.0', '', 0))
+
+    def test_not_cached(self):
+        self.cache.set('no_ttl:{}', 'no_ttl', (0, 'out', '', 0))
+        self.cache.set('system_load:{"a": 1}', 'system_load', (1, 'out', '', 0))
+        self.cache.set('system_load:{"a": 2}', 'system_load', (0, 'out', '', 1))
+
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_expired(self):
+        self.cache.set('system_load:{}', 'system_load', (0, '1.0', '', 0))
+        self.cache._entries['system_load:{}'] = (0,) + self.cache._entries['system_load:{}'][1:]
+        self.assertIdentical(self.cache.get('system_load:{}'), None)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_max_size(self):
+        for i in range(10):
+            self.cache.set('system_load:%i' % i, 'system_load', (0, 'x' * 20, '', 0))
+
+        self.assertTrue(self.cache.stats()['size'] <= 100)
+        self.assertIdentical(self.cache.get('system_load:0'), None)
+        self.assertTrue(self.cache.get('system_load:9'))
+
+
+class DedupWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.dedup = cache.DedupWindow(ttl=60, max_size=1000)
+
+    def test_new_message(self):
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertIdentical(self.dedup.received(OTHER_KEY), None)
+        self.assertEqual(self.dedup.stats()['duplicates'], 0)
+
+    def test_duplicate_of_running(self):
+        self.dedup.received(KEY)
+        entry = self.dedup.received(KEY)
+        self.assertTrue(entry.running)
+
+        self.dedup.received(KEY)
+        self.assertEqual(self.dedup.finished(KEY, '<iq />'), 2)
+        self.assertEqual(self.dedup.stats()['duplicates'], 2)
+
+    def test_duplicate_of_finished(self):
+        self.dedup.received(KEY)
+        self.assertEqual(self.dedup.finished(KEY, '<iq />'), 0)
+
+        entry = self.dedup.received(KEY)
+        self.assertFalse(entry.running)
+        self.assertEqual(entry.result, '<iq />')
+        self.assertEqual(entry.waiting, 0)
+
+    def test_result_too_large(self):
+        self.dedup.received(KEY)
+        self.dedup.finished(KEY, 'x' * 2000)
+
+        entry = self.dedup.received(KEY)
+        self.assertFalse(entry.running)
+        self.assertIdentical(entry.result, None)
+        self.assertEqual(self.dedup.stats()['size'], KEY_SIZE)
+
+    def test_max_size(self):
+        self.dedup.received(KEY)
+        self.dedup.finished(KEY, 'x' * 600)
+        self.dedup.received(OTHER_KEY)
+        self.dedup.finished(OTHER_KEY, 'x' * 600)
+
+        # Least recently finished result dropped, the message is new again
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertEqual(self.dedup.received(OTHER_KEY).result, 'x' * 600)
+
+    def test_expire(self):
+        self.dedup.received(KEY)
+        self.dedup.received(OTHER_KEY)
+        self.dedup.finished(KEY, '<iq />')
+        self.dedup._entries[KEY].expires = 0
+
+        # Running entries never expire
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertTrue(self.dedup.received(OTHER_KEY).running)
+
+    def test_forget_running(self):
+        self.dedup.received(KEY)
+        self.dedup.received(KEY)
+        self.dedup.forget(KEY)
+
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertEqual(self.dedup.stats()['size'], KEY_SIZE)
+
+    def test_forget_finished(self):
+        self.dedup.received(KEY)
+        self.dedup.finished(KEY, '<iq />')
+        self.dedup.forget(KEY)
+
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertEqual(self.dedup.stats(), {'entries': 1, 'size': KEY_SIZE, 'duplicates': 0})
+
+    def test_finished_after_forget(self):
+        self.dedup.received(KEY)
+        self.dedup.forget(KEY)
+        self.assertEqual(self.dedup.finished(KEY, '<iq />'), 0)
+
+    def test_running_expire(self):
+        self.dedup.received(KEY)
+        self.dedup.received(KEY)
+        self.dedup._entries[KEY].received -= self.dedup.max_running
+
+        # Never finished: forgotten, a retransmission runs it
+        self.assertIdentical(self.dedup.received(KEY), None)
+        self.assertEqual(self.dedup.stats(), {'entries': 1, 'size': KEY_SIZE, 'duplicates': 1})
+
+    def test_running_size(self):
+        self.dedup.received(KEY)
+        self.assertEqual(self.dedup.stats()['size'], KEY_SIZE)
+
+        self.dedup.finished(KEY, '<iq />')
+        self.assertEqual(self.dedup.stats()['size'], KEY_SIZE + len('<iq />'))
+
+        self.dedup.forget(KEY)
+        self.assertEqual(self.dedup.stats()['size'], 0)
+
+    def test_max_size_running(self):
+        self.dedup.max_size = KEY_SIZE * 3
+        self.dedup.received(KEY)
+        self.dedup.finished(KEY, 'x')
+        for message_id in 'abc':
+            self.dedup.received(cache.DedupWindow.key('server@example.com/ecm', message_id, 'signature'))
+
+        # Finished results are dropped first, then the oldest running messages
+        self.assertEqual(self.dedup.stats()['entries'], 3)
+        self.assertFalse(KEY in self.dedup._entries)
+
+        self.dedup.received(cache.DedupWindow.key('server@example.com/ecm', 'd', 'signature'))
+        self.assertEqual(self.dedup.stats()['entries'], 3)
+        self.assertFalse(cache.DedupWindow.key('server@example.com/ecm', 'a', 'signature') in self.dedup._entries)
+        self.assertTrue(self.dedup.stats()['size'] <= self.dedup.max_size)
@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from ecagent import core
+from ecagent import startup
+
+
+class FakeTransport:
+    def __init__(self):
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+class FakeStream:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(core, 'reactor', self.clock)
+        self.xs = FakeStream()
+        self.queue = core.SendQueue()
+        self.queue.attach(self.xs)
+
+    def test_batched(self):
+        self.queue.write('<a/>')
+        self.queue.write(u'<b>\xe9</b>')
+        self.assertEqual(self.xs.sent, [])
+
+        self.clock.advance(0)
+        self.assertEqual(self.xs.sent, ['<a/><b>\xc3\xa9</b>'])
+
+        self.clock.advance(0)
+        self.assertEqual(len(self.xs.sent), 1)
+
+    def test_flush(self):
+        self.queue.write('<a/>')
+        self.queue.flush()
+        self.assertEqual(self.xs.sent, ['<a/>'])
+
+        # Nothing left for the scheduled flush
+        self.clock.advance(0)
+        self.assertEqual(self.xs.sent, ['<a/>'])
+
+    def test_pause_resume(self):
+        self.assertIs(self.xs.transport.producer, self.queue)
+
+        self.queue.pauseProducing()
+        self.assertTrue(self.queue.paused)
+
+        # Stanzas are still written, senders skip optional ones
+        self.queue.write('<a/>')
+        self.clock.advance(0)
+        self.assertEqual(self.xs.sent, ['<a/>'])
+
+        self.queue.resumeProducing()
+        self.assertFalse(self.queue.paused)
+
+    def test_detach(self):
+        self.queue.write('<a/>')
+        self.queue.detach()
+        self.queue.write('<b/>')
+        self.clock.advance(0)
+
+        self.assertEqual(self.xs.sent, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_attach_resumes(self):
+        self.queue.pauseProducing()
+        self.queue.detach()
+        self.queue.attach(self.xs)
+        self.assertFalse(self.queue.paused)
+
+
+class ConnectTimingTest(unittest.TestCase):
+    def setUp(self):
+        self.patch(core, 'reactor', Clock())
+        self.patch(startup, 'timer', startup.StartupTimer())
+        self.client = core.BasicClient('agent@example.com', 'secret', 'example.com', [])
+
+    def test_every_attempt_timed(self):
+        self.client._factory.startedConnecting(None)
+        startup.timer.end('connect')
+        self.assertTrue(startup.timer.ended('connect'))
+
+        # Reconnection from the factory, not through _connect
+        self.client._factory.startedConnecting(None)
+        self.assertFalse(startup.timer.ended('connect'))
+        self.assertEqual(startup.timer.stats()['phases']['connect'], None)
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.trial import unittest
+
+import ecagent.frames as frames
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = frames.FrameDecoder()
+
+    def test_frames(self):
+        self.assertEqual(self.decoder.feed('5\nhello3\nfoo'), ['hello', 'foo'])
+
+    def test_byte_by_byte(self):
+        received = []
+        for byte in '5\nhello0\n3\nfoo':
+            received.extend(self.decoder.feed(byte))
+
+        self.assertEqual(received, ['hello', '', 'foo'])
+
+    def test_partial_payload(self):
+        self.assertEqual(self.decoder.feed('11\nhello'), [])
+        self.assertEqual(self.decoder.feed(' worl'), [])
+        self.assertEqual(self.decoder.feed('d2\nok'), ['hello world', 'ok'])
+
+    def test_newlines_in_payload(self):
+        self.assertEqual(self.decoder.feed('3\na\nb'), ['a\nb'])
+
+    def test_invalid_header(self):
+        self.assertRaises(frames.FrameError, self.decoder.feed, 'x\n')
+
+    def test_negative_length(self):
+        self.assertRaises(frames.FrameError, self.decoder.feed, '-1\nabc')
+
+    def test_header_too_long(self):
+        self.assertRaises(frames.FrameError, self.decoder.feed, '1' * 30)
@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import tempfile
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial import unittest
+
+import ecagent.inline as inline
+
+
+class FakePlugin:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def _call_command(self, command, command_args):
+        if command == 'test_fail':
+            raise ValueError('failed')
+
+        if command == 'test_slow':
+            self.release.wait(10)
+
+        return 0, command_args.get('text', '')
+
+
+class InlineRunnerTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(prefix='plugin_', suffix='.py')
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+
+        self.plugin = FakePlugin()
+        self.addCleanup(self.plugin.release.set)
+
+        self.runner = inline.InlineRunner(['test_echo', 'test_fail', 'test_slow'], timeout=1, threads=2)
+        self.runner._plugins[self.filename] = (os.path.getmtime(self.filename), self.plugin)
+
+    @inlineCallbacks
+    def _returned(self):
+        """ Waits for the late calls of the plugin to return """
+        for _ in range(200):
+            if self.filename not in self.runner._late:
+                returnValue(True)
+
+            yield deferLater(reactor, 0.01, lambda: None)
+
+        returnValue(False)
+
+    def test_can_run(self):
+        self.assertTrue(self.runner.can_run('test_echo', self.filename))
+        self.assertFalse(self.runner.can_run('test_other', self.filename))
+        self.assertFalse(self.runner.can_run('test_echo', self.filename + '.missing'))
+
+    @inlineCallbacks
+    def test_run(self):
+        result = yield self.runner.run('test_echo', {'text': 'hello'}, self.filename)
+        self.assertEqual(result, (0, 'hello', '', 0))
+
+    @inlineCallbacks
+    def test_failed(self):
+        result = yield self.runner.run('test_fail', {}, self.filename)
+        self.assertEqual(result, (inline._E_RUNNING_COMMAND, '', 'ERROR: failed', 0))
+
+    @inlineCallbacks
+    def test_timeout(self):
+        result = yield self.runner.run('test_slow', {}, self.filename, timeout=0.1)
+        self.assertEqual(result, (None, '', '', 1))
+
+        # The plugin runs in a process until its late call returns
+        self.assertFalse(self.runner.can_run('test_echo', self.filename))
+
+        self.plugin.release.set()
+        returned = yield self._returned()
+        self.assertTrue(returned)
+        self.assertTrue(self.runner.can_run('test_echo', self.filename))
+
+    @inlineCallbacks
+    def test_late_calls_fill_the_pool(self):
+        fd, other = tempfile.mkstemp(prefix='plugin_', suffix='.py')
+        os.close(fd)
+        self.addCleanup(os.remove, other)
+        self.runner._plugins[other] = (os.path.getmtime(other), FakePlugin())
+
+        yield self.runner.run('test_slow', {}, self.filename, timeout=0.1)
+        self.assertTrue(self.runner.can_run('test_echo', other))
+
+        self.runner._late[self.filename] += 1
+        self.assertFalse(self.runner.can_run('test_echo', other))
+        self.runner._late[self.filename] -= 1
+
+        self.plugin.release.set()
+        returned = yield self._returned()
+        self.assertTrue(returned)
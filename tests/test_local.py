@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import stat
+import shutil
+import tempfile
+import simplejson as json
+
+from twisted.internet.defer import succeed
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from ecagent import local
+
+
+class FakeRunner:
+    loaded = True
+
+    def __init__(self):
+        self.runs = []
+
+    def run_command(self, command, command_args, flush_callback=None, message=None, deadline=None):
+        self.runs.append((command, command_args, deadline))
+        if command == 'unknown':
+            return None
+
+        return succeed((0, 'out', '', 0))
+
+
+class LocalProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = FakeRunner()
+        self.api = local.LocalAPI(self.runner, 'unused', commands=['system_*', 'unknown'])
+        self.protocol = self.api.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def _request(self, line):
+        self.protocol.dataReceived(line + '\n')
+        responses = [json.loads(response) for response in self.transport.value().splitlines()]
+        self.transport.clear()
+        return responses
+
+    def test_request(self):
+        request = {'id': 7, 'command': 'system.load', 'args': {'path': '/'}, 'deadline': '1700000000'}
+        responses = self._request(json.dumps(request))
+
+        self.assertEqual(self.runner.runs, [('system_load', {'path': '/'}, 1700000000.0)])
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0]['id'], '7')
+        self.assertEqual(responses[0]['retvalue'], 0)
+        self.assertEqual(responses[0]['stdout'], 'out')
+        self.assertEqual(responses[0]['partial'], 0)
+
+    def test_malformed(self):
+        for line in ('not json', '[]', '{"id": "1"}', '{"command": "system.load", "args": []}',
+                     '{"command": "system.load", "deadline": "soon"}'):
+            responses = self._request(line)
+
+            self.assertEqual(len(responses), 1, line)
+            self.assertEqual(responses[0]['id'], None)
+            self.assertEqual(responses[0]['retvalue'], local._E_RUNNING_COMMAND)
+            self.assertIn('Invalid request', responses[0]['stderr'])
+
+        self.assertEqual(self.runner.runs, [])
+
+    def test_line_too_long(self):
+        self.patch(local.LocalProtocol, 'MAX_LENGTH', 10)
+        self.protocol.dataReceived('{"command": "system.load"}\n')
+
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.runner.runs, [])
+
+    def test_not_allowed(self):
+        responses = self._request('{"id": "1", "command": "file.write"}')
+
+        self.assertEqual(self.runner.runs, [])
+        self.assertEqual(responses[0]['retvalue'], local._E_COMMAND_NOT_DEFINED)
+
+    def test_unknown(self):
+        responses = self._request('{"id": "1", "command": "unknown"}')
+        self.assertEqual(responses[0]['retvalue'], local._E_COMMAND_NOT_DEFINED)
+
+    def test_partial_skipped_while_paused(self):
+        request = local.LocalRequest({'id': '1', 'command': 'system.load'})
+        self.protocol.pauseProducing()
+        self.assertFalse(self.protocol.flush((None, 'so far', '', 0, 6), request))
+        self.assertEqual(self.transport.value(), '')
+
+        self.protocol.resumeProducing()
+        self.protocol.flush((None, 'so far', '', 0, 6), request)
+        self.assertEqual(json.loads(self.transport.value())['partial'], 6)
+
+    def test_binary_output(self):
+        request = local.LocalRequest({'id': '1', 'command': 'system.load'})
+        self.protocol.finished((0, '\xff', '', 0), request)
+
+        response = json.loads(self.transport.value())
+        self.assertEqual(response['stdout'], '/w==')
+        self.assertEqual(response['stdout_encoding'], 'base64')
+
+
+class LocalAPIListenTest(unittest.TestCase):
+    def setUp(self):
+        if not local.LOCAL_API_AVAILABLE:
+            raise unittest.SkipTest("Unix sockets are not available")
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_socket_mode(self):
+        filename = os.path.join(self.path, 'ecagent.sock')
+        port = local.LocalAPI(FakeRunner(), filename).listen()
+
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0600)
+        return port.stopListening()
@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest
+
+from ecagent import pipeline
+
+OK = (0, 'ok', '', 0)
+FAILED = (1, '', 'failed', 0)
+TIMED_OUT = (None, '', '', 1)
+
+
+class Step:
+    def __init__(self, step_id, depends=(), on_failure=None):
+        self.id = step_id
+        self.command = 'test.' + step_id
+        self.depends = list(depends)
+        self.on_failure = on_failure
+        self.state = None
+        self.result = None
+
+
+class PipelineValidationTest(unittest.TestCase):
+    def _pipeline(self, steps, on_failure=pipeline.STOP):
+        return pipeline.Pipeline(steps, lambda step: OK, on_failure)
+
+    def test_valid(self):
+        self._pipeline([Step('a'), Step('b', ['a']), Step('c', ['a']), Step('d', ['b', 'c'])])
+
+    def test_cycle(self):
+        steps = [Step('a'), Step('b', ['a', 'd']), Step('c', ['b']), Step('d', ['c'])]
+        e = self.assertRaises(pipeline.PipelineError, self._pipeline, steps)
+        self.assertIn('b, c, d', str(e))
+
+    def test_self_dependency(self):
+        self.assertRaises(pipeline.PipelineError, self._pipeline, [Step('a', ['a'])])
+
+    def test_unknown_dependency(self):
+        e = self.assertRaises(pipeline.PipelineError, self._pipeline, [Step('a'), Step('b', ['x'])])
+        self.assertIn('unknown step x', str(e))
+
+    def test_duplicated_id(self):
+        self.assertRaises(pipeline.PipelineError, self._pipeline, [Step('a'), Step('a')])
+
+    def test_unknown_policy(self):
+        self.assertRaises(pipeline.PipelineError, self._pipeline, [Step('a')], 'retry')
+        self.assertRaises(pipeline.PipelineError, self._pipeline, [Step('a', on_failure='retry')])
+
+
+class PipelineRunTest(unittest.TestCase):
+    def setUp(self):
+        # step id -> Deferred of the running step
+        self.running = {}
+        self.ran = []
+        self.results = []
+
+    def _run_step(self, step):
+        self.ran.append(step.id)
+        self.running[step.id] = Deferred()
+        return self.running[step.id]
+
+    def _start(self, steps, on_failure=pipeline.STOP, rollback=()):
+        p = pipeline.Pipeline(steps, self._run_step, on_failure, rollback)
+        p.run().addCallback(self.results.append)
+        return p
+
+    def _states(self, steps):
+        return [step.state for step in steps]
+
+    def test_parallel_branches(self):
+        steps = [Step('a'), Step('b', ['a']), Step('c', ['a']), Step('d', ['b', 'c'])]
+        self._start(steps)
+        self.assertEqual(self.ran, ['a'])
+
+        self.running['a'].callback(OK)
+        self.assertEqual(sorted(self.ran), ['a', 'b', 'c'])
+
+        self.running['b'].callback(OK)
+        self.assertNotIn('d', self.ran)
+        self.running['c'].callback(OK)
+        self.running['d'].callback(OK)
+
+        self.assertEqual(self.results, [True])
+        self.assertEqual(self._states(steps), [pipeline.OK] * 4)
+
+    def test_stop(self):
+        steps = [Step('a'), Step('b'), Step('c', ['a'])]
+        self._start(steps)
+        self.running['a'].callback(FAILED)
+
+        # Running steps finish, no more steps are started
+        self.assertEqual(self.results, [])
+        self.running['b'].callback(OK)
+
+        self.assertEqual(self.ran, ['a', 'b'])
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self._states(steps), [pipeline.FAILED, pipeline.OK, pipeline.SKIPPED])
+
+    def test_continue(self):
+        steps = [Step('a'), Step('b', ['a']), Step('c'), Step('d', ['c'])]
+        self._start(steps, pipeline.CONTINUE)
+        self.running['a'].callback(TIMED_OUT)
+        self.running['c'].callback(OK)
+        self.running['d'].callback(OK)
+
+        self.assertEqual(self.ran, ['a', 'c', 'd'])
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self._states(steps), [pipeline.FAILED, pipeline.SKIPPED, pipeline.OK, pipeline.OK])
+
+    def test_step_policy_overrides(self):
+        steps = [Step('a', on_failure=pipeline.CONTINUE), Step('b')]
+        self._start(steps)
+        self.running['a'].callback(FAILED)
+
+        self.assertEqual(self.ran, ['a', 'b'])
+        self.running['b'].callback(OK)
+        self.assertEqual(self.results, [False])
+
+    def test_rollback(self):
+        steps = [Step('a'), Step('b', ['a'])]
+        rollback = [Step('undo1'), Step('undo2')]
+        self._start(steps, pipeline.ROLLBACK, rollback)
+        self.running['a'].callback(OK)
+        self.running['b'].callback(FAILED)
+
+        # Rollback steps run one after another, even if one fails
+        self.assertEqual(self.ran, ['a', 'b', 'undo1'])
+        self.running['undo1'].callback(FAILED)
+        self.assertEqual(self.ran, ['a', 'b', 'undo1', 'undo2'])
+        self.running['undo2'].callback(OK)
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self._states(rollback), [pipeline.FAILED, pipeline.OK])
+
+    def test_no_rollback_on_success(self):
+        rollback = [Step('undo')]
+        self._start([Step('a')], pipeline.ROLLBACK, rollback)
+        self.running['a'].callback(OK)
+
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(self.results, [True])
+        self.assertEqual(self._states(rollback), [pipeline.PENDING])
+
+    def test_step_error(self):
+        steps = [Step('a')]
+        self._start(steps)
+        self.running['a'].errback(RuntimeError('boom'))
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual(steps[0].result[0], pipeline._E_RUNNING_COMMAND)
+        self.assertIn('boom', steps[0].result[2])
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import sys
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+import ecagent.agent as agent
+import ecagent.inline as inline
+
+PLUGINS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plugins')
+
+PLUGIN = """
+from __plugin import ECMPlugin
+
+class ECMTest(ECMPlugin):
+    def cmd_test_echo(self, *argv, **kwargs):
+        return kwargs.get('text')
+
+if __name__ == '__main__':
+    ECMTest().run()
+"""
+
+
+class PluginDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        with open(os.path.join(self.path, 'plugin_test.py'), 'w') as f:
+            f.write(PLUGIN)
+
+        sys.path.insert(0, PLUGINS_PATH)
+        self.addCleanup(sys.path.remove, PLUGINS_PATH)
+
+    def test_compiled_files_skipped(self):
+        for filename in ('plugin_test.pyc', 'plugin_test.pyo', '__plugin.py', 'other.py'):
+            open(os.path.join(self.path, filename), 'w').close()
+
+        self.assertEqual(agent.plugin_files(self.path), [os.path.join(self.path, 'plugin_test.py')])
+
+    def test_other_plugins_kept(self):
+        filenames = ['plugin_compiled.pyc', 'plugin_script.sh', 'plugin_test.py', 'plugin_window.pyw']
+        for filename in filenames:
+            open(os.path.join(self.path, filename), 'a').close()
+
+        self.assertEqual(agent.plugin_files(self.path), [os.path.join(self.path, filename) for filename in filenames])
+
+    def test_inline_load_writes_no_bytecode(self):
+        self.patch(sys, 'dont_write_bytecode', False)
+        runner = inline.InlineRunner(['test_echo'])
+        self.assertTrue(runner.can_run('test_echo', os.path.join(self.path, 'plugin_test.py')))
+        self.assertFalse(sys.dont_write_bytecode)
+        self.assertEqual(os.listdir(self.path), ['plugin_test.py'])
+        self.assertEqual(agent.plugin_files(self.path), [os.path.join(self.path, 'plugin_test.py')])
@@ -0,0 +1,221 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish.domish import Element
+
+import ecagent.relay as relay
+
+AGENT = 'agent@example.com'
+SECRET = 'secret'
+
+
+class FakeClient:
+    def __init__(self):
+        self.jid = JID('relay@example.com/ecm')
+        self.sent = []
+        self.presences = 0
+        self.is_writable = True
+
+    def isOnline(self, jid):
+        return True
+
+    def online_contacts(self):
+        return []
+
+    def writable(self):
+        return self.is_writable
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def send_presence(self):
+        self.presences += 1
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+        self.connected = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def loseConnection(self):
+        self.connected = False
+
+
+class FakeLink:
+    def __init__(self, agent=AGENT):
+        self.thisEntity = JID(agent + '/ecm')
+        self.transport = FakeTransport()
+        self.observers = {}
+        self.sent = []
+
+    def addObserver(self, event, observer, **kwargs):
+        self.observers[event] = (observer, kwargs)
+
+    def send(self, elem):
+        self.sent.append(elem)
+
+    def receive(self, elem):
+        observer, kwargs = self.observers['/iq']
+        observer(elem, **kwargs)
+
+    def end(self):
+        observer, kwargs = self.observers[xmlstream.STREAM_END_EVENT]
+        observer(None, **kwargs)
+
+
+def result(text='x' * 10):
+    iq = Element(('jabber:client', 'iq'))
+    iq['type'] = 'result'
+    iq.addElement('ecm_message').addContent(text)
+    return iq
+
+
+class RelayServerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(relay, 'reactor', self.clock)
+        self.client = FakeClient()
+        self.relay = relay.RelayServer(self.client, SECRET, max_queued_size=20)
+
+    def _connect(self, agent=AGENT):
+        link = FakeLink(agent)
+        self.relay._onLinkAuthd(link)
+        return link
+
+    def test_results_sent_upstream(self):
+        link = self._connect()
+        link.receive(result())
+        self.clock.advance(0)
+
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertIn("relay='%s'" % AGENT, self.client.sent[0])
+
+    def test_full_queue_pauses_link(self):
+        self.client.is_writable = False
+        link = self._connect()
+        for _ in range(3):
+            link.receive(result())
+
+        self.assertTrue(link.transport.paused)
+
+        self.client.is_writable = True
+        self.clock.advance(relay.DRAIN_DELAY)
+        self.assertEqual(len(self.client.sent), 3)
+        self.assertFalse(link.transport.paused)
+
+    def test_reconnect_keeps_queue(self):
+        self.client.is_writable = False
+        previous = self._connect()
+        for _ in range(3):
+            previous.receive(result())
+
+        link = self._connect()
+        self.assertFalse(previous.transport.connected)
+
+        # The previous link ending doesn't touch the new one
+        previous.end()
+        self.assertEqual(self.relay.agents(), [AGENT])
+
+        self.client.is_writable = True
+        self.clock.advance(relay.DRAIN_DELAY)
+        self.assertEqual(len(self.client.sent), 3)
+        self.assertFalse(link.transport.paused)
+
+        # And the new link is paused when its queue fills up
+        self.client.is_writable = False
+        for _ in range(3):
+            link.receive(result())
+
+        self.assertTrue(link.transport.paused)
+        self.client.is_writable = True
+        self.clock.advance(relay.DRAIN_DELAY)
+        self.assertEqual(len(self.client.sent), 6)
+        self.assertFalse(link.transport.paused)
+
+    def test_disconnect_sends_queued(self):
+        self.client.is_writable = False
+        link = self._connect()
+        link.receive(result())
+        link.receive(result())
+        link.end()
+        self.assertEqual(self.relay.agents(), [])
+
+        self.client.is_writable = True
+        self.clock.advance(relay.DRAIN_DELAY)
+        self.assertEqual(len(self.client.sent), 2)
+        self.assertEqual(self.relay._queues, {})
+        self.assertEqual(self.relay._queued_size, {})
+
+    def test_round_robin(self):
+        self.client.is_writable = False
+        first = self._connect()
+        second = self._connect('other@example.com')
+        for _ in range(2):
+            first.receive(result())
+
+        second.receive(result())
+        self.client.is_writable = True
+        self.clock.advance(relay.DRAIN_DELAY)
+
+        self.assertEqual([AGENT in data for data in self.client.sent], [True, False, True])
+
+    def test_route(self):
+        link = self._connect()
+        iq = Element(('jabber:client', 'iq'))
+        iq['type'] = 'set'
+        iq['from'] = 'server@example.com/ecm'
+        iq.addElement('ecm_message')['relay'] = AGENT
+
+        self.assertTrue(self.relay.route(iq))
+        self.assertEqual(link.sent, [iq])
+        self.assertEqual(iq['to'], link.thisEntity.full())
+
+        link.end()
+        self.assertTrue(self.relay.route(iq))
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertIn('service-unavailable', self.client.sent[0].toXml())
+
+
+class LinkAuthenticatorTest(unittest.TestCase):
+    def _handshake(self, agent, secret):
+        authd = []
+        xs = xmlstream.XmlStream(relay.LinkAuthenticator(SECRET))
+        xs.addObserver(xmlstream.STREAM_AUTHD_EVENT, lambda xs: authd.append(xs))
+        xs.makeConnection(StringTransport())
+        xs.dataReceived("<stream:stream xmlns='jabber:component:accept' "
+                        "xmlns:stream='http://etherx.jabber.org/streams' to='%s/ecm'>" % agent)
+        xs.dataReceived("<handshake>%s</handshake>" % xmlstream.hashPassword(xs.sid, unicode(secret)))
+        return bool(authd)
+
+    def test_agent_secret(self):
+        self.assertTrue(self._handshake(AGENT, relay.agent_secret(SECRET, AGENT)))
+
+    def test_relay_secret_refused(self):
+        self.assertFalse(self._handshake(AGENT, SECRET))
+
+    def test_other_agent_secret_refused(self):
+        self.assertFalse(self._handshake(AGENT, relay.agent_secret(SECRET, u'other@example.com')))
@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest
+
+import ecagent.scheduler as scheduler
+
+
+class CommandSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = scheduler.CommandScheduler(max_concurrent=2, max_per_plugin=1, max_low=1,
+                                                    high_commands=['agent_*'], low_commands=['packages_*'])
+        self.started = []
+        self.running = {}
+
+    def _submit(self, command, plugin='plugin_test.py'):
+        return self.scheduler.submit(command, plugin, self._command, command)
+
+    def _command(self, command):
+        self.started.append(command)
+        self.running[command] = Deferred()
+        return self.running[command]
+
+    def test_priority(self):
+        self.assertEqual(self.scheduler.priority('agent_ping'), scheduler.PRIORITY_HIGH)
+        self.assertEqual(self.scheduler.priority('packages_install'), scheduler.PRIORITY_LOW)
+        self.assertEqual(self.scheduler.priority('system_load'), scheduler.PRIORITY_NORMAL)
+
+    def test_max_concurrent(self):
+        for command, plugin in (('a', 'p1'), ('b', 'p2'), ('c', 'p3')):
+            self._submit(command, plugin)
+
+        self.assertEqual(self.started, ['a', 'b'])
+        self.assertEqual(self.scheduler.stats()['queued'], 1)
+
+        self.running['a'].callback(None)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+
+    def test_max_per_plugin(self):
+        self._submit('a', 'p1')
+        self._submit('b', 'p1')
+        self._submit('c', 'p2')
+
+        # b waits for its plugin, c runs
+        self.assertEqual(self.started, ['a', 'c'])
+        self.running['a'].callback(None)
+        self.assertEqual(self.started, ['a', 'c', 'b'])
+
+    def test_high_first(self):
+        self._submit('a', 'p1')
+        self._submit('b', 'p2')
+        self._submit('system_load', 'p3')
+        self._submit('agent_ping', 'p4')
+
+        self.running['a'].callback(None)
+        self.assertEqual(self.started[-1], 'agent_ping')
+
+    def test_max_low(self):
+        self._submit('packages_install', 'p1')
+        self._submit('packages_update', 'p2')
+        self._submit('system_load', 'p3')
+
+        # Only one low priority slot
+        self.assertEqual(self.started, ['packages_install', 'system_load'])
+
+    def test_result(self):
+        results = []
+        self._submit('a').addCallback(results.append)
+        self.running['a'].callback((0, 'out', '', 0))
+        self.assertEqual(results, [(0, 'out', '', 0)])
+        self.assertEqual(self.scheduler.stats()['running'], 0)
+
+    def test_failure_frees_slot(self):
+        failures = []
+        self._submit('a', 'p1').addErrback(failures.append)
+        self._submit('b', 'p2')
+        self._submit('c', 'p3')
+
+        self.running['a'].errback(ValueError('failed'))
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
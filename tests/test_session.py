@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+
+from twisted.trial import unittest
+
+import ecagent.session as session
+
+SENDER = 'server@example.com'
+TEXT = 'server@example.com::agent@example.com::system.info::'
+
+
+class SessionKeysTest(unittest.TestCase):
+    private_key = RSA.generate(1024)
+
+    def setUp(self):
+        self.sessions = session.SessionKeys()
+
+    def _open(self, ttl=session.DEFAULT_TTL):
+        nonce = self.sessions.nonce(SENDER)
+        session_id, encrypted_key, expires = self.sessions.open(SENDER, nonce, self.private_key.publickey(), ttl)
+        key = PKCS1_OAEP.new(self.private_key).decrypt(base64.b64decode(encrypted_key))
+        return session_id, key
+
+    def test_open_returns_encrypted_key(self):
+        session_id, key = self._open()
+        self.assertEqual(len(key), session.KEY_LENGTH)
+        self.assertTrue(self.sessions.verify(SENDER, session_id, TEXT, session.sign(key, TEXT)))
+
+    def test_bad_signature(self):
+        session_id, key = self._open()
+        self.assertFalse(self.sessions.verify(SENDER, session_id, TEXT + 'x', session.sign(key, TEXT)))
+        self.assertFalse(self.sessions.verify(SENDER, session_id, TEXT, session.sign('x' * 32, TEXT)))
+
+    def test_nonce_is_single_use(self):
+        nonce = self.sessions.nonce(SENDER)
+        self.sessions.open(SENDER, nonce, self.private_key.publickey())
+        self.assertRaises(session.SessionError, self.sessions.open, SENDER, nonce, self.private_key.publickey())
+
+    def test_nonce_bound_to_sender(self):
+        nonce = self.sessions.nonce(SENDER)
+        self.assertRaises(session.SessionError, self.sessions.open,
+                          'other@example.com', nonce, self.private_key.publickey())
+
+    def test_unknown_nonce(self):
+        self.assertRaises(session.SessionError, self.sessions.open, SENDER, None, self.private_key.publickey())
+        self.assertRaises(session.SessionError, self.sessions.open, SENDER, 'f' * 32, self.private_key.publickey())
+
+    def test_expired_nonce(self):
+        nonce = self.sessions.nonce(SENDER)
+        self.sessions._nonces[(SENDER, nonce)] = 0
+        self.assertRaises(session.SessionError, self.sessions.open, SENDER, nonce, self.private_key.publickey())
+
+    def test_max_nonces(self):
+        self.sessions.max_nonces = 2
+        for _ in range(5):
+            self.sessions.nonce(SENDER)
+
+        self.assertEqual(len(self.sessions._nonces), 2)
+
+    def test_unknown_session(self):
+        session_id, key = self._open()
+        self.assertIdentical(self.sessions.verify(SENDER, 'unknown', TEXT, session.sign(key, TEXT)), None)
+        self.assertIdentical(self.sessions.verify('other@example.com', session_id, TEXT,
+                                                  session.sign(key, TEXT)), None)
+
+    def test_expired_session(self):
+        session_id, key = self._open()
+        self.sessions._sessions[(SENDER, session_id)] = (0, key)
+        self.assertIdentical(self.sessions.verify(SENDER, session_id, TEXT, session.sign(key, TEXT)), None)
+        self.assertEqual(self.sessions.stats(), {'sessions': 0})
+
+    def test_close(self):
+        session_id, key = self._open()
+        self.assertTrue(self.sessions.close(SENDER, session_id))
+        self.assertFalse(self.sessions.close(SENDER, session_id))
+        self.assertIdentical(self.sessions.verify(SENDER, session_id, TEXT, session.sign(key, TEXT)), None)
+
+    def test_ttl(self):
+        self.sessions.max_ttl = 10
+        nonce = self.sessions.nonce(SENDER)
+        self.assertRaises(session.SessionError, self.sessions.open, SENDER, nonce, self.private_key.publickey(), 0)
+
+        session_id, key = self._open(3600)
+        self.assertTrue(self.sessions._sessions[(SENDER, session_id)][0] <= session.time() + 10)
+
+    def test_max_sessions(self):
+        self.sessions.max_sessions = 2
+        for _ in range(3):
+            self._open()
+
+        self.assertEqual(self.sessions.stats(), {'sessions': 2})
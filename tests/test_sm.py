@@ -0,0 +1,159 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+from ecagent import sm
+
+
+class FakeStream:
+    def __init__(self):
+        self.sent = []
+
+    def addObserver(self, *args, **kwargs):
+        pass
+
+    def send(self, element):
+        self.sent.append(element)
+
+
+def enabled(resume=True):
+    element = Element((sm.NS_SM, 'enabled'))
+    if resume:
+        element['resume'] = 'true'
+        element['id'] = 'session'
+    return element
+
+
+def resumed(h):
+    element = Element((sm.NS_SM, 'resumed'))
+    element['h'] = str(h)
+    return element
+
+
+class StreamManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(sm, 'reactor', self.clock)
+
+        self.written = []
+        self.manager = sm.StreamManager(self.written.append)
+        self.xs = FakeStream()
+        self._connect()
+
+    def _connect(self):
+        self.manager.connected(self.xs)
+        self.manager.onEnabled(enabled())
+        self.manager.authenticated()
+
+    def _unacked(self):
+        return [data for (h, data) in self.manager._unacked]
+
+    def test_acked_dropped(self):
+        for data in ('a', 'b', 'c'):
+            self.manager.send(data)
+
+        self.manager._acked(2)
+        self.assertEqual(self._unacked(), ['c'])
+
+        # Old ack: nothing else dropped
+        self.manager._acked(1)
+        self.assertEqual(self._unacked(), ['c'])
+
+    def test_ack_requested(self):
+        self.manager.send('a')
+        self.manager.send('b')
+        self.clock.advance(sm.ACK_DELAY)
+
+        self.assertEqual([element.name for element in self.xs.sent], ['r'])
+
+    def test_outbound_wraparound(self):
+        self.manager.outbound = sm._H_MODULO - 2
+        for data in ('a', 'b', 'c', 'd'):
+            self.manager.send(data)
+
+        self.assertEqual([h for (h, data) in self.manager._unacked], [sm._H_MODULO - 1, 0, 1, 2])
+
+        # Acks past the wrap drop the stanzas before it too
+        self.manager._acked(0)
+        self.assertEqual(self._unacked(), ['c', 'd'])
+        self.manager._acked(2)
+        self.assertEqual(self._unacked(), [])
+
+    def test_inbound_wraparound(self):
+        self.manager.inbound = sm._H_MODULO - 1
+        self.manager._onStanza(None)
+        self.assertEqual(self.manager.inbound, 0)
+
+        self.manager._onAckRequest(None)
+        self.assertEqual(self.xs.sent[0]['h'], '0')
+
+    def test_resume(self):
+        for data in ('a', 'b', 'c'):
+            self.manager.send(data)
+        self.manager.disconnected()
+
+        # Queued while disconnected, sent after the unacked ones
+        self.manager.send('d')
+        del self.written[:]
+
+        self.manager.connected(self.xs)
+        self.manager.onResumed(resumed(1))
+        self.manager.authenticated()
+
+        self.assertTrue(self.manager.resumed)
+        self.assertEqual(self.written, ['b', 'c', 'd'])
+        self.assertEqual(self.manager.outbound, 4)
+        self.assertEqual(self._unacked(), ['b', 'c', 'd'])
+
+    def test_resume_failed(self):
+        for data in ('a', 'b'):
+            self.manager.send(data)
+        self.manager.disconnected()
+        del self.written[:]
+
+        # New session: unacked stanzas are sent once authenticated
+        self.manager.connected(self.xs)
+        self.manager.onResumeFailed()
+        self.manager.onEnabled(enabled())
+        self.assertEqual(self.written, [])
+
+        self.manager.authenticated()
+        self.assertFalse(self.manager.resumed)
+        self.assertEqual(self.written, ['a', 'b'])
+        self.assertEqual(self.manager.outbound, 2)
+
+    def test_server_without_stream_management(self):
+        self.manager.send('a')
+        self.manager.disconnected()
+        del self.written[:]
+
+        self.manager.connected(self.xs)
+        self.manager.authenticated()
+        self.manager.send('b')
+
+        self.assertEqual(self.written, ['a', 'b'])
+        self.assertEqual(self._unacked(), [])
+
+    def test_max_unacked_size(self):
+        self.manager.max_unacked_size = 4
+        for data in ('aa', 'bb', 'cc'):
+            self.manager.send(data)
+
+        self.assertEqual(self._unacked(), ['bb', 'cc'])
+        self.assertEqual(self.manager._unacked_size, 4)
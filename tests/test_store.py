@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from twisted.trial import unittest
+
+from ecagent import store
+
+PAYLOAD = 'x' * 10
+DIGEST = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def digest(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+
+class PayloadStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        self.now = 1000
+        self.patch(store, 'time', lambda: self.now)
+        self.store = store.PayloadStore(self.path, 30)
+
+    def _put(self, payload):
+        return self.store.put_chunk(digest(payload), 0, payload, len(payload))
+
+    def test_chunks(self):
+        self.assertEqual(self.store.put_chunk(DIGEST, 0, PAYLOAD[:4], 10), 4)
+        self.assertFalse(self.store.has(DIGEST))
+        self.assertEqual(self.store.put_chunk(DIGEST, 4, PAYLOAD[4:], 10), 10)
+
+        self.assertTrue(self.store.has(DIGEST))
+        self.assertEqual(self.store.get(DIGEST), PAYLOAD)
+        self.assertEqual(os.listdir(self.path), [DIGEST])
+
+    def test_resume(self):
+        self.store.put_chunk(DIGEST, 0, PAYLOAD[:4], 10)
+
+        # Chunk already received, or one after a lost chunk: resume offset
+        self.assertEqual(self.store.put_chunk(DIGEST, 0, PAYLOAD[:4], 10), 4)
+        self.assertEqual(self.store.put_chunk(DIGEST, 8, PAYLOAD[8:], 10), 4)
+
+        self.assertEqual(self.store.put_chunk(DIGEST, 4, PAYLOAD[4:], 10), 10)
+        self.assertEqual(self.store.get(DIGEST), PAYLOAD)
+
+    def test_stored_payload_not_uploaded_again(self):
+        self._put(PAYLOAD)
+        self.assertEqual(self.store.put_chunk(DIGEST, 0, '', 10), 10)
+
+    def test_hash_mismatch(self):
+        self.store.put_chunk(DIGEST, 0, 'y' * 4, 10)
+        self.assertRaises(store.StoreError, self.store.put_chunk, DIGEST, 4, 'y' * 6, 10)
+
+        self.assertFalse(self.store.has(DIGEST))
+        self.assertEqual(os.listdir(self.path), [])
+
+        # Upload starts again from scratch
+        self.assertEqual(self.store.put_chunk(DIGEST, 0, PAYLOAD, 10), 10)
+        self.assertTrue(self.store.has(DIGEST))
+
+    def test_larger_than_announced(self):
+        self.assertRaises(store.StoreError, self.store.put_chunk, DIGEST, 0, PAYLOAD, 5)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_lru_eviction(self):
+        payloads = ['a' * 10, 'b' * 10, 'c' * 10]
+        for payload in payloads:
+            self._put(payload)
+
+        # Used: not the least recently used anymore
+        self.store.get(digest(payloads[0]))
+        self._put('d' * 10)
+
+        self.assertTrue(self.store.has(digest(payloads[0])))
+        self.assertFalse(self.store.has(digest(payloads[1])))
+        self.assertTrue(self.store.has(digest(payloads[2])))
+        self.assertEqual(self.store.size, 30)
+
+    def test_uploads_count_toward_max_size(self):
+        self._put('a' * 10)
+        self._put('b' * 10)
+        self.store.put_chunk(digest('c' * 20), 0, 'c' * 15, 20)
+
+        self.assertFalse(self.store.has(digest('a' * 10)))
+        self.assertTrue(self.store.has(digest('b' * 10)))
+
+    def test_abandoned_upload_removed(self):
+        self.store.put_chunk(DIGEST, 0, PAYLOAD[:4], 10)
+        self.now += store.PART_MAX_AGE + 1
+        self._put('a' * 10)
+
+        self.assertEqual(self.store.stats()['uploads'], 0)
+        self.assertEqual(os.listdir(self.path), [digest('a' * 10)])
+        self.assertEqual(self.store.put_chunk(DIGEST, 4, PAYLOAD[4:], 10), 0)
+
+    def test_interrupted_upload_removed_on_load(self):
+        self.store.put_chunk(DIGEST, 0, PAYLOAD[:4], 10)
+        self._put('a' * 10)
+
+        self.store = store.PayloadStore(self.path, 30)
+        self.assertEqual(os.listdir(self.path), [digest('a' * 10)])
+        self.assertEqual(self.store.put_chunk(DIGEST, 4, PAYLOAD[4:], 10), 0)
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from ecagent import transfer
+
+
+class FileTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(transfer, 'reactor', self.clock)
+        self.patch(transfer, 'time', self.clock.seconds)
+
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, 'x' * 10)
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+
+        self.writable = True
+        self.sent = []
+        self.results = []
+
+    def _send(self, result):
+        if not self.writable:
+            return False
+        self.sent.append(result)
+        return True
+
+    def _start(self, **kwargs):
+        file_transfer = transfer.FileTransfer(self.filename, self._send, chunk_size=4, **kwargs)
+        file_transfer.start().addCallback(self.results.append)
+        return file_transfer
+
+    def test_chunks(self):
+        self._start()
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+
+        self.assertEqual([result[1] for result in self.sent], ['xxxx', 'xxxx', 'xx'])
+        self.assertEqual(self.results[0][0], 0)
+
+    def test_waits_while_not_writable(self):
+        self._start()
+        self.writable = False
+        self.clock.advance(0)
+        self.clock.advance(transfer.RETRY_DELAY * 10)
+        self.assertEqual(len(self.sent), 1)
+
+        # Resumes with the chunk it could not send
+        self.writable = True
+        self.clock.advance(transfer.RETRY_DELAY)
+        self.clock.advance(0)
+        self.assertEqual([result[1] for result in self.sent], ['xxxx', 'xxxx', 'xx'])
+        self.assertEqual(self.results[0][0], 0)
+
+    def test_idle_timeout(self):
+        self._start(idle_timeout=5)
+        self.writable = False
+        for _ in range(20):
+            self.clock.advance(transfer.RETRY_DELAY)
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.results[0][0], transfer._E_RUNNING_COMMAND)
+        self.assertIn('5 seconds', self.results[0][2])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import sys
+import shutil
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+import ecagent.workers as workers
+
+PLUGINS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plugins')
+
+PLUGIN = """
+import time
+from __plugin import ECMPlugin
+
+class ECMTest(ECMPlugin):
+    def cmd_test_echo(self, *argv, **kwargs):
+        return kwargs.get('text')
+
+    def cmd_test_sleep(self, *argv, **kwargs):
+        time.sleep(30)
+
+if __name__ == '__main__':
+    ECMTest().run()
+"""
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        filename = os.path.join(path, 'plugin_test.py')
+        with open(filename, 'w') as f:
+            f.write(PLUGIN)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = PLUGINS_PATH
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+        self.pool = workers.WorkerPool(filename, sys.executable, env, size=1, min_workers=0)
+        self.pool.start()
+
+    @inlineCallbacks
+    def tearDown(self):
+        self.pool.stop()
+        for _ in range(500):
+            if not self.pool._workers:
+                break
+
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def test_run(self):
+        result = yield self.pool.run('test_echo', {'text': 'hello'}, 10)
+        self.assertEqual(result[:2], (0, '"hello"'))
+        self.assertEqual(result[3], 0)
+
+        # Same worker answers the next command
+        worker = list(self.pool._workers)[0]
+        result = yield self.pool.run('test_echo', {'text': 'again'}, 10)
+        self.assertEqual(result[1], '"again"')
+        self.assertEqual(worker.requests, 2)
+
+    @inlineCallbacks
+    def test_timeout(self):
+        result = yield self.pool.run('test_sleep', {}, 1)
+        self.assertEqual(result[1], '')
+        self.assertEqual(result[3], 1)
+        self.assertEqual(len(self.pool._workers), 0)
+
+        # A new worker is spawned for the next command
+        result = yield self.pool.run('test_echo', {'text': 'hello'}, 10)
+        self.assertEqual(result, (0, '"hello"', '', 0))
+
+    @inlineCallbacks
+    def test_queued(self):
+        first = self.pool.run('test_echo', {'text': 'first'}, 10)
+        second = self.pool.run('test_echo', {'text': 'second'}, 10)
+        self.assertEqual(len(self.pool._queue), 1)
+
+        result = yield first
+        self.assertEqual(result[1], '"first"')
+        result = yield second
+        self.assertEqual(result[1], '"second"')